@@ -0,0 +1,50 @@
+import argparse
+import os
+import logging
+from datetime import datetime
+
+from decouple import config
+
+from core.backfill import Backfill
+from core.mappers import basic_stats_mapper, conversion_stats_mapper
+from core.script import Script
+
+CWD = os.path.dirname(os.path.abspath(__file__))
+script = Script('backfill', CWD)
+logger = logging.getLogger(__name__)
+
+MAPPERS = {'basic': ('QUERY_BASIC_STATS', basic_stats_mapper),
+           'conversion': ('QUERY_CONVERSION_STATS', conversion_stats_mapper)}
+
+
+def parse_date(value):
+    return datetime.strptime(value, '%Y-%m-%d').date()
+
+
+# parse arguments from CLI
+parser = argparse.ArgumentParser(description="Load historical data, shard by shard. "
+                                             "Interrupted backfill continues from the first missing shard.")
+parser.add_argument('report', choices=MAPPERS, help='Which report to backfill')
+parser.add_argument('start', type=parse_date, help='First day, YYYY-MM-DD')
+parser.add_argument('end', type=parse_date, help='Last day (inclusive), YYYY-MM-DD')
+parser.add_argument('-s', '--shard', choices=('day', 'week'), default='day', help='Size of one shard')
+parser.add_argument('-c', '--concurrency', type=int, default=4, help='Shards running in DBM at once')
+parser.add_argument('--api-rate', type=float, default=1, help='Max DBM API calls per second')
+args = parser.parse_args()
+
+setting, mapper = MAPPERS[args.report]
+
+dbm = script.dbm()
+# tables are created if they don't exist. If they do, SQL Alchemy skips creation
+engine = script.engine()
+
+backfill = Backfill(dbm, engine, config(setting), mapper,
+                    concurrency=args.concurrency,
+                    api_rate=args.api_rate,
+                    timezone="Europe/Warsaw",
+                    batch_size=script.batch_size,
+                    sinks=script.sinks())
+results = backfill.run(args.start, args.end, shard=args.shard)
+logger.info("Loaded {} shards, {} rows.".format(len(results), sum(results.values())))
+
+script.finish()
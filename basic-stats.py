@@ -1,22 +1,23 @@
 import os
 import logging
-from time import sleep
 from datetime import datetime, timedelta
 
 from decouple import config
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
-from core.models import Base, MetaNames, BasicStats
-from core.util import DBMQuery, clean_date_value, clean_currency_value
+from core.loader import BulkLoader
+from core.mappers import DIMENSIONS, basic_stats_mapper
+from core.pipeline import load_report
+from core.rollups import ROLLUPS
+from core.sinks import open_sinks
+from core.script import Script
 
 CWD = os.path.dirname(os.path.abspath(__file__))
-logging.basicConfig(level=logging.INFO)
+script = Script('basic-stats', CWD)
 logger = logging.getLogger(__name__)
 
 # 1. run query with data from previous day
 daterange = datetime.today() - timedelta(days=1)
 
-dbm = DBMQuery(os.path.join(CWD, config('API_KEY_FILE')))
+dbm = script.dbm()
 query_id = config('QUERY_BASIC_STATS')
 
 logger.info("Running query {} with data from {}...".format(query_id, daterange))
@@ -24,73 +25,27 @@ dbm.run_query(query_id, 'CUSTOM_DATES', start_date=daterange, end_date=daterange
 
 # -----------------------------------------------------------------------------------
 # 2. Fetch report from DBM API
-# check if query is still running (exception RuntimeWarning). If not, proceed.
+# wait until fresh report is ready, checking less often the longer query runs
+logger.info("Waiting for report...")
+dbm.wait_for_report(query_id)
 logger.info("Downloading report...")
-
-while True:
-    try:
-        report = dbm.download_query(query_id, type='dict')
-        logger.info("Downloaded!")
-        break
-    except RuntimeWarning:
-        logger.info("Query is still running, waiting 1 minute...")
-        sleep(60)
-        continue
+# report is read from local cache if this run was already downloaded
+report = dbm.download_query(query_id, type='stream', footer_column=basic_stats_mapper.footer)
 
 # -----------------------------------------------------------------------------------
 # 3. save report data to SQL
-db_uri = config('DB_URI')
-logger.info("Connecting to DB: {}".format(db_uri))
-engine = create_engine(db_uri, echo=True)
-
-# create all tables if they don't exist. If they do, SQL Alchemy skips creation
-Base.metadata.create_all(engine)
-
-# connect for inputing values
-Session = sessionmaker(bind=engine)
-session = Session()
-
-# add MetaNames first
-for row in report:
-    if row["Date"] != '':
-        # every csv report contains summary and metadata that we don't need.
-        # Fortunately, we can detect when summary row starts and disregard
-        # everything after that in our loop
-
-        # query database to check if our line items already exists
-        # if so, then skip
-        db_line_items = [x.line_item_id for x in session.query(MetaNames.line_item_id).all()]
-
-        if int(row['Line Item ID']) not in db_line_items:
-            rec_meta = MetaNames(advertiser_name = row['Advertiser'],
-                                 advertiser_id = row['Advertiser ID'],
-                                 order_name = row['Insertion Order'],
-                                 order_id = row['Insertion Order ID'],
-                                 line_item_name = row['Line Item'],
-                                 line_item_id = row['Line Item ID'])
-            session.add(rec_meta)
-        else:
-            # pass adding Line Item if it already exists in databas
-            logger.info("{} is already in database, skipping...".format(row['Line Item ID']))
-            pass
+# tables are created if they don't exist. If they do, SQL Alchemy skips creation
+engine = script.engine()
+sinks = script.sinks()
+loader = BulkLoader(engine, batch_size=script.batch_size)
 
-        # add BasicStats
-        rec_stats = BasicStats(date=clean_date_value(row['Date']),
-                               line_item_id=row['Line Item ID'],
-                               currency=row['Advertiser Currency'],
-                               impressions=row['Impressions'],
-                               viewable_impressions=row['Active View: Viewable Impressions'],
-                               clicks=row['Clicks'],
-                               total_conversions=row['Total Conversions'],
-                               post_click_conversions=row['Post-Click Conversions'],
-                               total_cost=clean_currency_value(row['Total Media Cost (Advertiser Currency)']),
-                               media_cost=clean_currency_value(row['Media Cost (Advertiser Currency)'])
-                               )
+# upsert all rows in one transaction, so re-running a day updates it instead of failing.
+# Line items are written only if they are new or got renamed since last load,
+# rollups are refreshed for affected advertisers and orders
+with open_sinks(sinks, query_id) as writers, engine.begin() as connection:
+    counts = load_report(loader, connection, report, basic_stats_mapper, DIMENSIONS, rollups=ROLLUPS,
+                         writers=writers)
 
-        session.add(rec_stats)
-    else:
-        # break iteration if we reach csv summary row
-        logger.info("Reached csv file's metadata, breaking loop.")
-        break
+logger.info("Saved rows: {}".format(counts))
 
-session.commit()
+script.finish()
@@ -0,0 +1,55 @@
+"""
+Micro-benchmark of core.util cleaning functions against their previous implementations.
+Run from repository root: python -m benchmarks.clean_values
+"""
+import re
+import random
+from datetime import datetime
+from timeit import timeit
+
+from core.util import clean_currency_value, clean_currency_values, clean_date_value, clean_date_values
+
+ROWS = 100000
+
+
+def legacy_clean_date_value(str):
+    try:
+        return datetime.strptime(str, '%Y/%m/%d')
+    except ValueError:
+        try:
+            return datetime.strptime(str, '%Y-%m-%d')
+        except ValueError:
+            try:
+                return datetime.strptime(str, '%Y.%m.%d')
+            except ValueError:
+                return datetime.strptime(str, '%Y/%d/%m')
+
+
+def legacy_clean_currency_value(str):
+    pattern = re.compile('[^.0-9]+')
+    return float(re.sub(pattern, '', str))
+
+
+def report(name, legacy, current):
+    print("{:<28} {:>10.3f} us {:>10.3f} us {:>8.1f}x".format(
+        name, legacy / ROWS * 1e6, current / ROWS * 1e6, legacy / current))
+
+
+if __name__ == '__main__':
+    # daily report: a few distinct dates, mostly distinct money values
+    dates = [random.choice(['2018-01-0{}'.format(day) for day in range(1, 8)]) for _ in range(ROWS)]
+    money = ['PLN{:,.2f}'.format(random.uniform(0, 100000)) for _ in range(ROWS)]
+
+    print("{:<28} {:>13} {:>13} {:>9}".format("per call", "legacy", "current", "speedup"))
+    report("clean_date_value",
+           timeit(lambda: [legacy_clean_date_value(x) for x in dates], number=1),
+           timeit(lambda: [clean_date_value(x) for x in dates], number=1))
+    report("clean_date_values",
+           timeit(lambda: [legacy_clean_date_value(x) for x in dates], number=1),
+           timeit(lambda: clean_date_values(dates), number=1))
+    report("clean_currency_value",
+           timeit(lambda: [legacy_clean_currency_value(x) for x in money], number=1),
+           timeit(lambda: [clean_currency_value(x) for x in money], number=1))
+    report("clean_currency_values",
+           timeit(lambda: [legacy_clean_currency_value(x) for x in money], number=1),
+           timeit(lambda: clean_currency_values(money), number=1))
@@ -0,0 +1,177 @@
+"""
+Local stand-ins for DBM API and Google Cloud Storage, so the whole pipeline can be run offline.
+LocalDBMQuery is a DBMQuery whose API client answers from memory and whose reports
+are served over HTTP from a local directory by LocalStorage.
+"""
+import os
+import threading
+import time
+from functools import partial
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+
+from core.util import DBMQuery
+
+
+class QuietHandler(SimpleHTTPRequestHandler):
+
+    def log_message(self, format, *args):
+        pass
+
+
+class LocalStorage():
+    """
+    HTTP server of report files in directory, in a background thread.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), partial(QuietHandler, directory=directory))
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def url(self, name):
+        return 'http://127.0.0.1:{}/{}'.format(self.server.server_port, name)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class LocalRequest():
+
+    def __init__(self, function, **kwargs):
+        self.function = partial(function, **kwargs)
+
+    def execute(self):
+        return self.function()
+
+
+class LocalBatch():
+    """
+    Batch request of LocalService, answers every request through callback like BatchHttpRequest.
+    """
+
+    def __init__(self, service, callback=None):
+        self.service = service
+        self.callback = callback
+        self.requests = []
+
+    def add(self, request, callback=None, request_id=None):
+        self.requests.append((str(len(self.requests)) if request_id is None else request_id, request, callback))
+
+    def execute(self):
+        with self.service.lock:
+            self.service.batches += 1
+        for request_id, request, callback in self.requests:
+            response, exception = None, None
+            try:
+                response = request.execute()
+            except Exception as error:
+                exception = error
+            callback = callback or self.callback
+            if callback is not None:
+                callback(request_id, response, exception)
+
+
+class LocalService():
+    """
+    In-memory replacement of Google's API client for DBM queries.
+    Query runs for `delay` seconds, then its latest report is `reports[query_id]` in storage.
+    """
+
+    def __init__(self, storage, reports, delay=0, page_size=100):
+        self.storage = storage
+        self.reports = reports
+        self.delay = delay
+        self.page_size = page_size
+        self.finish_times = {}
+        self.calls = 0
+        self.batches = 0
+        self.created = 0
+        self.lock = threading.Lock()
+
+    def queries(self):
+        return self
+
+    def new_batch_http_request(self, callback=None):
+        return LocalBatch(self, callback)
+
+    def listqueries(self, pageToken=None):
+        return LocalRequest(self._list, offset=int(pageToken or 0))
+
+    def createquery(self, body):
+        return LocalRequest(self._create, body=body)
+
+    def runquery(self, queryId, body):
+        return LocalRequest(self._run, query_id=str(queryId))
+
+    def getquery(self, queryId):
+        return LocalRequest(self._get, query_id=str(queryId))
+
+    def deletequery(self, queryId):
+        return LocalRequest(self._delete, query_id=str(queryId))
+
+    def _create(self, body):
+        with self.lock:
+            self.calls += 1
+            self.created += 1
+            query_id = 'local-{}'.format(self.created)
+        return {'queryId': query_id, 'metadata': body.get('metadata', {})}
+
+    def _list(self, offset):
+        with self.lock:
+            self.calls += 1
+        query_ids = sorted(self.reports)
+        response = {'queries': [self._query(query_id) for query_id in query_ids[offset:offset + self.page_size]]}
+        if offset + self.page_size < len(query_ids):
+            response['nextPageToken'] = str(offset + self.page_size)
+        return response
+
+    def _delete(self, query_id):
+        with self.lock:
+            self.calls += 1
+        self.finish_times.pop(query_id, None)
+        return {}
+
+    def _run(self, query_id):
+        with self.lock:
+            self.calls += 1
+        self.finish_times[query_id] = time.time() + self.delay
+        return {}
+
+    def _get(self, query_id):
+        with self.lock:
+            self.calls += 1
+        if query_id not in self.reports:
+            return {}
+        return self._query(query_id)
+
+    def _query(self, query_id):
+        finish_time = self.finish_times.get(query_id, 0)
+        return {'queryId': query_id,
+                'metadata': {'title': 'Local query {}'.format(query_id),
+                             'dataRange': 'PREVIOUS_DAY',
+                             'running': time.time() < finish_time,
+                             'latestReportRunTimeMs': str(int(finish_time * 1000)),
+                             'googleCloudStoragePathForLatestReport': self.storage.url(self.reports[query_id])}}
+
+
+class LocalDBMQuery(DBMQuery):
+    """
+    DBMQuery without credentials, talking to LocalService.
+    """
+
+    def __init__(self, storage, reports, delay=0, history_file=None, cache=None, query_list_dir=None):
+        """
+        :param storage: LocalStorage
+        :param reports: dict {query ID: report file name in storage directory}
+        :param delay: seconds every query runs
+        :param query_list_dir: directory of cached query listing, not cached if None
+        """
+        super().__init__(None, history_file=history_file, cache=cache, query_list_dir=query_list_dir,
+                         discovery_cache_dir=None)
+        self.client = LocalService(storage, {str(key): os.path.basename(value) for key, value in reports.items()},
+                                   delay)
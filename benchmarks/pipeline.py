@@ -0,0 +1,186 @@
+"""
+End-to-end throughput of report pipeline on synthetic report, offline.
+Stages: DBM API (run and wait), download from storage, parse, clean (mapper) and load into SQLite.
+Each stage reports rows/sec and its peak RSS.
+Run from repository root: python -m benchmarks.pipeline --rows 1000000
+Save results with --save and compare later runs with --baseline to catch regressions.
+"""
+import argparse
+import json
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+from sqlalchemy import create_engine
+
+from benchmarks.local_dbm import LocalDBMQuery, LocalStorage
+from benchmarks.reports import write_report
+from core.cache import ReportCache
+from core.columnar import parse_columns
+from core.loader import BulkLoader
+from core.mappers import DIMENSIONS, MAPPINGS
+from core.models import Base
+from core.pipeline import load_report
+from core.rollups import ROLLUPS
+from core.util import iter_report_rows
+
+# synthetic report -> mapping from core/mappings.yaml
+REPORT_MAPPINGS = {'basic': 'basic_stats', 'conversion': 'conversion_stats'}
+
+QUERY_ID = '1'
+
+
+def reset_peak_rss():
+    """
+    Reset peak RSS of process, so it can be measured per stage. Linux only.
+    :return: True if peak was reset
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as file:
+            file.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def peak_rss():
+    """
+    Returns peak resident memory of process in MB, since last reset_peak_rss where supported.
+    """
+    try:
+        with open('/proc/self/status') as file:
+            for line in file:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    # kB on Linux, bytes on macOS
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss / 1024 ** 2 if sys.platform == 'darwin' else maxrss / 1024
+
+
+def stage(results, name, rows, function):
+    """
+    Run and measure stage.
+    :param results: dict collecting {stage name: measurements}
+    :param function: callable() -> number of rows processed, None to use `rows`
+    """
+    reset_peak_rss()
+    started = time.perf_counter()
+    processed = function()
+    seconds = time.perf_counter() - started
+    processed = rows if processed is None else processed
+
+    results[name] = {'seconds': seconds, 'rows': processed, 'rows_per_sec': processed / seconds if seconds else 0,
+                     'peak_rss_mb': peak_rss()}
+    print("{:<18} {:>10} {:>10.2f} s {:>14,.0f} {:>10.1f} MB".format(
+        name, processed, seconds, results[name]['rows_per_sec'], results[name]['peak_rss_mb']))
+
+
+def run(args, directory):
+    """
+    :return: dict {stage name: {seconds, rows, rows_per_sec, peak_rss_mb}}
+    """
+    results = {}
+    mapping = MAPPINGS[REPORT_MAPPINGS[args.report]]
+    mapper, transform = mapping.row_mapper(), mapping.batch_transform()
+    report = os.path.join(directory, 'storage', 'report.csv')
+    os.makedirs(os.path.dirname(report))
+
+    print("{:<18} {:>10} {:>12} {:>14} {:>13}".format("stage", "rows", "time", "rows/sec", "peak RSS"))
+    stage(results, 'generate', args.rows, lambda: write_report(
+        report, args.report, args.rows, args.line_items, args.advertisers, args.conversions) and None)
+
+    with LocalStorage(os.path.dirname(report)) as storage:
+        dbm = LocalDBMQuery(storage, {QUERY_ID: report}, delay=args.api_delay,
+                            cache=ReportCache(os.path.join(directory, 'cache')))
+
+        def api():
+            dbm.run_query(QUERY_ID, 'PREVIOUS_DAY')
+            dbm.wait_for_report(QUERY_ID, initial_delay=args.api_delay)
+            # no rows are read, only time matters
+            return 0
+
+        stage(results, 'api', 0, api)
+        stage(results, 'download', args.rows, lambda: dbm.cache_report(QUERY_ID) and None)
+
+    path = dbm.cache.latest(QUERY_ID)
+    stage(results, 'parse', None, lambda: sum(1 for _ in iter_report_rows(dbm.cache.read(path))))
+    stage(results, 'parse and clean', None,
+          lambda: sum(1 for row in iter_report_rows(dbm.cache.read(path)) if mapper(row)))
+
+    def columnar():
+        rows = 0
+        for batch in parse_columns(dbm.cache.read(path), mapping.column_types(), footer_column=mapping.footer,
+                                   skip=mapping.skip):
+            transform(batch)
+            rows += len(batch)
+        return rows
+
+    stage(results, 'columnar', None, columnar)
+
+    engine = create_engine('sqlite:///' + os.path.join(directory, 'benchmark.db'))
+    Base.metadata.create_all(engine)
+    loader = BulkLoader(engine, batch_size=args.batch_size)
+    rollups = ROLLUPS if args.rollups else ()
+
+    def load():
+        with engine.begin() as connection:
+            load_report(loader, connection, iter_report_rows(dbm.cache.read(path)), mapper, DIMENSIONS,
+                        rollups=rollups)
+
+    stage(results, 'load', args.rows, load)
+    # the same report again, rows are compared with stored ones and skipped
+    stage(results, 'reload unchanged', args.rows, load)
+    return results
+
+
+def regressions(results, baseline, tolerance):
+    """
+    Returns stages which are slower than in baseline by more than tolerance.
+    :param tolerance: e.g. 0.2 for 20%
+    :return: list of messages
+    """
+    messages = []
+    for name, measured in results.items():
+        if name in baseline and measured['rows'] and \
+                measured['rows_per_sec'] < baseline[name]['rows_per_sec'] * (1 - tolerance):
+            messages.append("{}: {:,.0f} rows/sec, baseline {:,.0f}".format(
+                name, measured['rows_per_sec'], baseline[name]['rows_per_sec']))
+    return messages
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--report', choices=sorted(REPORT_MAPPINGS), default='basic', help='Which report to generate')
+    parser.add_argument('--rows', type=int, default=1000000, help='Data rows in report')
+    parser.add_argument('--line-items', type=int, default=5000, help='Line items reported every day')
+    parser.add_argument('--advertisers', type=int, default=50, help='Advertisers of line items')
+    parser.add_argument('--conversions', type=int, default=10, help='Conversions of every line item')
+    parser.add_argument('--batch-size', type=int, default=1000, help='Rows per INSERT statement')
+    parser.add_argument('--api-delay', type=float, default=0, help='Seconds every query runs in local DBM')
+    parser.add_argument('--rollups', action='store_true', help='Refresh rollups after load')
+    parser.add_argument('--save', help='Write results to JSON file')
+    parser.add_argument('--baseline', help='JSON file from --save to compare results with')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='Allowed slowdown against baseline')
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    try:
+        results = run(args, directory)
+    finally:
+        shutil.rmtree(directory)
+
+    if args.save:
+        with open(args.save, 'w') as file:
+            json.dump(results, file, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as file:
+            messages = regressions(results, json.load(file), args.tolerance)
+        for message in messages:
+            print("Regression in {}".format(message))
+        sys.exit(1 if messages else 0)
@@ -0,0 +1,105 @@
+"""
+Latency of common queries on stats tables, without and with indexes from core.models.
+Synthetic dataset is generated into SQLite file by default, any DB_URI can be given instead.
+Run from repository root: python -m benchmarks.query_latency --rows 2000000
+"""
+import argparse
+import os
+import random
+import tempfile
+import time
+from datetime import date, timedelta
+
+from sqlalchemy import create_engine, text
+from sqlalchemy.schema import CreateIndex, DropIndex
+
+from core.loader import chunked
+from core.models import Base, BasicStats, MetaNames
+
+INSERT_BATCH_SIZE = 10000
+
+QUERIES = {
+    'line item history': ('SELECT date, impressions, clicks, total_cost FROM dbm_basic_stats '
+                          'WHERE line_item_id = :line_item_id ORDER BY date'),
+    'advertiser month': ('SELECT SUM(s.impressions), SUM(s.total_cost) FROM dbm_basic_stats s '
+                         'JOIN dbm_meta_names m ON m.line_item_id = s.line_item_id '
+                         'WHERE m.advertiser_id = :advertiser_id AND s.date BETWEEN :start AND :end'),
+    'single day': 'SELECT COUNT(*), SUM(clicks) FROM dbm_basic_stats WHERE date = :start',
+}
+
+
+def generate(engine, rows, line_items, start=date(2016, 1, 1)):
+    """
+    Fill tables with `rows` daily stats of `line_items` line items, in 100 advertisers.
+    """
+    meta = [{'line_item_id': x, 'line_item_name': 'Line Item {}'.format(x), 'order_id': x // 10,
+             'order_name': 'Order', 'advertiser_id': x % 100, 'advertiser_name': 'Advertiser'}
+            for x in range(line_items)]
+    stats = ({'date': start + timedelta(days=x // line_items), 'line_item_id': x % line_items, 'currency': 'PLN',
+              'impressions': random.randint(0, 100000), 'viewable_impressions': 0, 'clicks': random.randint(0, 100),
+              'total_conversions': 0, 'post_click_conversions': 0,
+              'total_cost': round(random.uniform(0, 1000), 6), 'media_cost': 0} for x in range(rows))
+
+    with engine.begin() as connection:
+        connection.execute(MetaNames.__table__.insert(), meta)
+        for batch in chunked(stats, INSERT_BATCH_SIZE):
+            connection.execute(BasicStats.__table__.insert(), batch)
+
+    return start, start + timedelta(days=rows // line_items)
+
+
+def measure(engine, parameters, repeat):
+    """
+    :return: dict {query name: median latency in ms}
+    """
+    results = {}
+    with engine.connect() as connection:
+        for name, query in QUERIES.items():
+            timings = []
+            for params in parameters[:repeat]:
+                started = time.perf_counter()
+                connection.execute(text(query), **params).fetchall()
+                timings.append((time.perf_counter() - started) * 1000)
+            results[name] = sorted(timings)[len(timings) // 2]
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--rows', type=int, default=2000000, help='Rows of daily stats')
+    parser.add_argument('--line-items', type=int, default=2000, help='Line items reported every day')
+    parser.add_argument('--repeat', type=int, default=20, help='Runs of each query')
+    parser.add_argument('--db-uri', help='Empty database to use, temporary SQLite file by default')
+    args = parser.parse_args()
+
+    path = None
+    if args.db_uri is None:
+        path = os.path.join(tempfile.mkdtemp(), 'benchmark.db')
+        args.db_uri = 'sqlite:///' + path
+    engine = create_engine(args.db_uri)
+    Base.metadata.create_all(engine)
+
+    indexes = list(BasicStats.__table__.indexes) + list(MetaNames.__table__.indexes)
+    for index in indexes:
+        engine.execute(DropIndex(index))
+
+    print("Generating {} rows...".format(args.rows))
+    first, last = generate(engine, args.rows, args.line_items)
+    parameters = []
+    for _ in range(args.repeat):
+        day = first + timedelta(days=random.randint(0, (last - first).days))
+        parameters.append({'line_item_id': random.randrange(args.line_items), 'advertiser_id': random.randrange(100),
+                           'start': day, 'end': day + timedelta(days=30)})
+
+    without = measure(engine, parameters, args.repeat)
+    for index in indexes:
+        engine.execute(CreateIndex(index))
+    with_indexes = measure(engine, parameters, args.repeat)
+
+    print("{:<20} {:>15} {:>15} {:>9}".format("median latency", "no indexes", "indexes", "speedup"))
+    for name in QUERIES:
+        print("{:<20} {:>12.2f} ms {:>12.2f} ms {:>8.1f}x".format(
+            name, without[name], with_indexes[name], without[name] / with_indexes[name]))
+
+    if path:
+        os.remove(path)
@@ -0,0 +1,98 @@
+"""
+Generator of synthetic DBM csv reports with the columns read by core.mappers,
+summary row and metadata footer, as DBM writes them.
+"""
+import csv
+import random
+from datetime import date, timedelta
+
+BASIC_STATS_COLUMNS = ['Date', 'Advertiser', 'Advertiser ID', 'Insertion Order', 'Insertion Order ID', 'Line Item',
+                       'Line Item ID', 'Advertiser Currency', 'Impressions', 'Active View: Viewable Impressions',
+                       'Clicks', 'Total Conversions', 'Post-Click Conversions',
+                       'Total Media Cost (Advertiser Currency)', 'Media Cost (Advertiser Currency)']
+
+CONVERSION_STATS_COLUMNS = ['Date', 'Line Item', 'Line Item ID', 'DV360 Activity', 'DV360 Activity ID',
+                            'Total Conversions', 'Post-Click Conversions', 'CM Post-Click Revenue',
+                            'CM Post-View Revenue']
+
+REPORTS = {'basic': BASIC_STATS_COLUMNS, 'conversion': CONVERSION_STATS_COLUMNS}
+
+
+def money(currency, value):
+    return '{}{:,.2f}'.format(currency, value)
+
+
+def basic_stats_rows(rows, line_items, advertisers, start, random):
+    """
+    Returns generator of basic stats rows, every line item once per day.
+    """
+    for x in range(rows):
+        line_item, day = x % line_items, x // line_items
+        advertiser, order = line_item % advertisers, line_item // 10
+        impressions = random.randint(0, 100000)
+        cost = random.uniform(0, 5000)
+        yield ['{:%Y/%m/%d}'.format(start + timedelta(days=day)),
+               'Advertiser {}'.format(advertiser), str(1000 + advertiser),
+               'Order {}, "{}"'.format(order, advertiser), str(20000 + order),
+               'Line Item {} | Display, Retargeting'.format(line_item), str(300000 + line_item),
+               'PLN', str(impressions), str(impressions // 2), str(random.randint(0, impressions // 100)),
+               str(random.randint(0, 20)), str(random.randint(0, 5)),
+               money('PLN', cost * 1.2), money('PLN', cost)]
+
+
+def conversion_stats_rows(rows, line_items, conversions, start, random):
+    """
+    Returns generator of conversion rows, every conversion of every line item once per day,
+    with 'Total' row after conversions of each line item.
+    """
+    for x in range(rows):
+        conversion, line_item, day = x % conversions, (x // conversions) % line_items, x // (conversions * line_items)
+        yield ['{:%Y/%m/%d}'.format(start + timedelta(days=day)),
+               'Line Item {} | Display, Retargeting'.format(line_item), str(300000 + line_item),
+               'Activity {}'.format(conversion), str(4000000 + conversion),
+               '{:.1f}'.format(random.randint(0, 50)), '{:.1f}'.format(random.randint(0, 10)),
+               '{:.2f}'.format(random.uniform(0, 1000)), '{:.2f}'.format(random.uniform(0, 1000))]
+        if conversion == conversions - 1:
+            yield ['{:%Y/%m/%d}'.format(start + timedelta(days=day)),
+                   'Line Item {} | Display, Retargeting'.format(line_item), str(300000 + line_item),
+                   'Total', '', '0.0', '0.0', '0.00', '0.00']
+
+
+def write_report(path, report='basic', rows=100000, line_items=1000, advertisers=50, conversions=10,
+                 start=date(2018, 1, 1), seed=0):
+    """
+    Write synthetic report to file.
+    :param path: path to csv file
+    :param report: 'basic' (basic-stats.py) or 'conversion' (conversion-stats.py)
+    :param rows: number of data rows, excluding summary and 'Total' rows
+    :param line_items: line items reported every day
+    :param advertisers: advertisers line items belong to
+    :param conversions: conversion activities of every line item (conversion report)
+    :param start: first day of report, one day follows another when all line items are written
+    :param seed: seed of random metric values, the same seed gives the same report
+    :return: path
+    """
+    if report not in REPORTS:
+        raise ValueError("{} is not a valid report, use one of {}".format(report, sorted(REPORTS)))
+
+    generator = random.Random(seed)
+    columns = REPORTS[report]
+    if report == 'basic':
+        data = basic_stats_rows(rows, line_items, advertisers, start, generator)
+    else:
+        data = conversion_stats_rows(rows, line_items, conversions, start, generator)
+
+    with open(path, 'w', newline='', encoding='utf-8') as file:
+        writer = csv.writer(file, lineterminator='\n')
+        writer.writerow(columns)
+        writer.writerows(data)
+
+        # summary row has empty dimensions, followed by report metadata
+        writer.writerow(['' for _ in columns])
+        file.write('\n')
+        writer.writerow(['Report Time:', '{:%Y/%m/%d %I:%M %p}'.format(start)])
+        writer.writerow(['Date Range:', '{:%Y/%m/%d} to ...'.format(start)])
+        writer.writerow(['Group By:', 'Date, Line Item'])
+        writer.writerow(['MRC Accredited Metrics', 'Active View metrics are accredited only when ...'])
+
+    return path
@@ -1,41 +1,86 @@
 import argparse
+import json
 import os
+import shutil
+import sys
+from functools import partial
 
-import requests
-
-from core.util import DBMQuery
+from core.batch import DEFAULT_WORKERS, QueryBatch
+from core.cache import ReportCache, DEFAULT_MAX_SIZE
+from core.util import API_BATCH_SIZE, QUERY_LIST_TTL, DBMQuery
 
 # parse arguments from CLI
 parser = argparse.ArgumentParser(description="Set flags for your download")
 parser.add_argument('api_key', help="Path to API key in JSON")
 parser.add_argument('-l', '--list', action='store_true', help='List available queries')
+parser.add_argument('--title', help='List only queries with this text in title')
+parser.add_argument('--data-range', help='List only queries with this data range, e.g. PREVIOUS_DAY')
+state = parser.add_mutually_exclusive_group()
+state.add_argument('--running', dest='running', action='store_true', default=None, help='List only running queries')
+state.add_argument('--finished', dest='running', action='store_false', help='List only finished queries')
+parser.add_argument('--refresh', action='store_true',
+                    help='Fetch queries from DBM, listing is cached for {} minutes'.format(QUERY_LIST_TTL // 60))
 parser.add_argument('-d', '--download-report', type=int, nargs=1, help='Download report file based on query ID')
 parser.add_argument('-r', '--run-query', nargs=2, help='Run query ID (1) with data from date range (2).')
 parser.add_argument('-c', '--create-query', type=str, nargs=1, help='Create new Query from JSON file')
 parser.add_argument('--remove-query', nargs='*', help='Delete queries from DBM')
+parser.add_argument('--cache-dir', help='Directory of downloaded reports cache')
+parser.add_argument('--cache-size', type=int, default=DEFAULT_MAX_SIZE // 1024 ** 2,
+                    help='Max size of reports cache in MB')
+
+# batch commands for many queries at once, e.g. cli.py key.json run 1 2 3 --body queries/runquery_yesterday.json
+commands = parser.add_subparsers(dest='command', title='batch commands',
+                                 description='Manage many queries at once, see "<command> -h"')
+run_command = commands.add_parser('run', help='Run many queries')
+run_command.add_argument('query_ids', nargs='+', help='Query IDs')
+run_range = run_command.add_mutually_exclusive_group(required=True)
+run_range.add_argument('--daterange', help='Date range, e.g. PREVIOUS_DAY')
+run_range.add_argument('--body', help='JSON file with runquery body, e.g. queries/runquery_yesterday.json')
+create_command = commands.add_parser('create', help='Create queries from JSON files or directories of them')
+create_command.add_argument('paths', nargs='+', help='JSON files or directories')
+delete_command = commands.add_parser('delete', help='Delete many queries')
+delete_command.add_argument('query_ids', nargs='+', help='Query IDs')
+for command in (run_command, create_command, delete_command):
+    command.add_argument('-w', '--workers', type=int, default=DEFAULT_WORKERS, help='Batches sent at once')
+    command.add_argument('--batch-size', type=int, default=API_BATCH_SIZE,
+                         help='API requests in one HTTP request, 1 sends them one by one')
 args = parser.parse_args()
 
 DIR = os.path.dirname(os.path.abspath(__file__))
+cache = ReportCache(args.cache_dir or os.path.join(DIR, '.report-cache'), max_size=args.cache_size * 1024 ** 2)
 
 if os.path.exists(args.api_key):
-    dbm = DBMQuery(args.api_key)
+    dbm = DBMQuery(args.api_key, cache=cache)
 else:
     raise OSError("API key {} does not exist".format(args.api_key))
 
 if args.list:
     print("Listing queries...")
-    dbm.list_queries()
+    dbm.list_queries(args.title, args.data_range, args.running, max_age=0 if args.refresh else QUERY_LIST_TTL)
 
 if args.download_report:
     print("Downloading Query {}".format(args.download_report))
 
-    query = requests.get(dbm.get_query_url_to_file(args.download_report[0]))
     filename = str(args.download_report[0]) + '.csv'
+    os.makedirs(os.path.join(DIR, 'reports'), exist_ok=True)
+
+    def show_progress(downloaded, total, speed):
+        size = "{:.1f} / {:.1f} MB".format(downloaded / 1024 / 1024, total / 1024 / 1024) if total \
+            else "{:.1f} MB".format(downloaded / 1024 / 1024)
+        sys.stdout.write("\r{} ({:.2f} MB/s)".format(size, speed))
+        sys.stdout.flush()
 
     print("Saving file...")
-    with open(os.path.join(DIR, 'reports', filename), 'wb') as file:
-        file.write(query.content)
-    print("File saved!")
+    # report is downloaded only if this run of query is not cached yet
+    cached = dbm.cache_report(args.download_report[0], progress=show_progress)
+    target = os.path.join(DIR, 'reports', filename)
+    if os.path.exists(target):
+        os.remove(target)
+    try:
+        os.link(cached, target)
+    except OSError:
+        shutil.copyfile(cached, target)
+    print("\nFile saved!")
 
 if args.run_query:
     print("Preparing to run query.")
@@ -45,7 +90,42 @@ if args.create_query:
     print("Creating query.")
     dbm.create_query(args.create_query[0])
 
+
+def print_results(results, message):
+    """
+    Print result of every query of batch command.
+    :return: number of failed queries
+    """
+    failed = 0
+    for item, result in results.items():
+        if isinstance(result, Exception):
+            failed += 1
+            print("{} failed: {}".format(item, result))
+        else:
+            print(message.format(item))
+    return failed
+
+
+batch = QueryBatch(partial(DBMQuery, args.api_key, cache=cache),
+                   workers=getattr(args, 'workers', DEFAULT_WORKERS),
+                   batch_size=getattr(args, 'batch_size', API_BATCH_SIZE))
+failed = 0
+
 if args.remove_query:
-    for id in args.remove_query:
-        dbm.delete_query(id)
-        print("Removed Query ID {}".format(id))
+    failed += print_results(batch.delete(args.remove_query), "Removed Query ID {}")
+
+if args.command == 'run':
+    body = None
+    if args.body:
+        with open(args.body) as file:
+            body = json.load(file)
+    failed += print_results(batch.run(args.query_ids, daterange=args.daterange, body=body), "Running Query ID {}")
+
+if args.command == 'create':
+    failed += print_results(batch.create(args.paths), "Created query from {}")
+
+if args.command == 'delete':
+    failed += print_results(batch.delete(args.query_ids), "Removed Query ID {}")
+
+if failed:
+    sys.exit(1)
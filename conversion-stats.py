@@ -1,23 +1,24 @@
 import logging
 import os
 from datetime import datetime, timedelta
-from time import sleep
 
 from decouple import config
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
 
-from core.models import Base, ConversionPixels, ConversionPixelsMetaNames
-from core.util import DBMQuery, clean_date_value
+from core.loader import BulkLoader
+from core.mappers import DIMENSIONS, conversion_stats_mapper
+from core.pipeline import load_report
+from core.rollups import ROLLUPS
+from core.sinks import open_sinks
+from core.script import Script
 
 CWD = os.path.dirname(os.path.abspath(__file__))
-logging.basicConfig(level=logging.INFO)
+script = Script('conversion-stats', CWD)
 logger = logging.getLogger(__name__)
 
 # 1. run query with data from previous day
 daterange = datetime.today() - timedelta(days=1)
 
-dbm = DBMQuery(os.path.join(CWD, config('API_KEY_FILE')))
+dbm = script.dbm()
 query_id = config('QUERY_CONVERSION_STATS')
 
 logger.info("Running query {} with data from {}...".format(query_id, daterange))
@@ -25,59 +26,25 @@ dbm.run_query(query_id, 'CUSTOM_DATES', start_date=daterange, end_date=daterange
 
 # -----------------------------------------------------------------------------------
 # 2. Fetch report from DBM API
-# check if query is still running (exception RuntimeWarning). If not, proceed.
+# wait until fresh report is ready, checking less often the longer query runs
+logger.info("Waiting for report...")
+dbm.wait_for_report(query_id)
 logger.info("Downloading report...")
-
-while True:
-    try:
-        report = dbm.download_query(query_id, type='dict')
-        logger.info("Downloaded!")
-        break
-    except RuntimeWarning:
-        logger.info("Query is still running, waiting...")
-        sleep(30)
-        continue
+# report is read from local cache if this run was already downloaded
+report = dbm.download_query(query_id, type='stream', footer_column=conversion_stats_mapper.footer)
 
 # -----------------------------------------------------------------------------------
 # 3. save report data to SQL
-logger.info("Connecting to DB")
-engine = create_engine(config('DB_URI'), echo=True)
-
-# create all tables if they don't exist. If they do, SQL Alchemy skips creation
-Base.metadata.create_all(engine)
-
-# connect for inputing values
-Session = sessionmaker(bind=engine)
-session = Session()
-conversion_ids_from_db = [x.conversion_id for x in session.query(ConversionPixelsMetaNames).all()]
-
-for row in report:
-    if row["Date"] == '':
-        # every csv report contains summary and metadata that we don't need.
-        # Fortunately, we can detect when summary row starts and disregard
-        # everything after that in our loop
-        logger.info("Reached csv file's metadata, breaking loop.")
-        break
-
-    if row['DV360 Activity'] != 'Total':  # 'Total' in report is a sum of all LI conversions and not needed
-        if int(row['DV360 Activity ID']) not in conversion_ids_from_db:
-            record_meta = ConversionPixelsMetaNames(conversion_id=int(row['DV360 Activity ID']),
-                                                    conversion_name=row['DV360 Activity'])
-            conversion_ids_from_db.append(int(row['DV360 Activity ID']))
-        else:
-            record_meta = session.query(ConversionPixelsMetaNames).filter_by(
-                conversion_id=row['DV360 Activity ID']).first()
-            record_meta.conversion_name = row['DV360 Activity']
-        session.add(record_meta)
+# tables are created if they don't exist. If they do, SQL Alchemy skips creation
+engine = script.engine()
+sinks = script.sinks()
+loader = BulkLoader(engine, batch_size=script.batch_size)
 
-        record_stats = ConversionPixels(date=clean_date_value(row['Date']),
-                                        line_item_id=int(row['Line Item ID']),
-                                        conversion_id=int(row['DV360 Activity ID']),
-                                        total_conversions=int(float(row['Total Conversions'])),
-                                        post_click_conversions=int(float(row['Post-Click Conversions'])),
-                                        post_click_revenue=row['CM Post-Click Revenue'],
-                                        post_view_revenue=row['CM Post-View Revenue'])
+# upsert all rows in one transaction, conversion names are rewritten only if they are new or were renamed in DBM
+with open_sinks(sinks, query_id) as writers, engine.begin() as connection:
+    counts = load_report(loader, connection, report, conversion_stats_mapper, DIMENSIONS, rollups=ROLLUPS,
+                         writers=writers)
 
-        session.add(record_stats)
+logger.info("Saved rows: {}".format(counts))
 
-session.commit()
+script.finish()
@@ -0,0 +1,195 @@
+"""
+Sharded execution of DBM queries of many partner accounts, see accounts-sample.yaml.
+Every account has its own service account key, API quota and target database,
+so accounts run in separate processes, each with its own rate limit, and fail independently.
+"""
+import logging
+import multiprocessing
+import os
+import re
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+
+import yaml
+from sqlalchemy import create_engine
+
+from core.cache import ReportCache, DEFAULT_MAX_SIZE
+from core.loader import DEFAULT_BATCH_SIZE
+from core.mappers import basic_stats_mapper, conversion_stats_mapper
+from core.metrics import configure_logging, instrument_engine, metrics
+from core.models import Base
+from core.orchestrator import Job, Orchestrator
+from core.sinks import ParquetSink
+from core.util import DBMQuery
+
+logger = logging.getLogger(__name__)
+
+# report name in manifest -> row mapper
+REPORTS = {'basic': basic_stats_mapper,
+           'conversion': conversion_stats_mapper}
+
+# DBM API calls per second of one account, if manifest does not set it
+DEFAULT_API_RATE = 1
+
+# account names are used as directory names
+ACCOUNT_NAME = re.compile('^[A-Za-z0-9_.-]+$')
+
+# name: unique account name, credentials: path to service account key, db_uri: target database,
+# queries: list of (report name, query ID), api_rate: max API calls per second,
+# workers: reports loaded at once, parquet_dir: optional directory of core.sinks.ParquetSink
+Account = namedtuple('Account', ['name', 'credentials', 'db_uri', 'queries', 'api_rate', 'workers', 'parquet_dir'])
+
+
+def load_manifest(path):
+    """
+    Read accounts from YAML manifest. Relative paths are relative to manifest's directory.
+    :param path: path to YAML file, see accounts-sample.yaml
+    :return: list of Account
+    """
+    with open(path) as file:
+        spec = yaml.safe_load(file) or {}
+
+    directory = os.path.dirname(os.path.abspath(path))
+    defaults = {'api_rate': spec.get('api_rate', DEFAULT_API_RATE), 'workers': spec.get('workers', 4)}
+    accounts, names = [], set()
+
+    for number, account in enumerate(spec.get('accounts') or []):
+        name = str(account.get('name') or 'account-{}'.format(number + 1))
+        if not ACCOUNT_NAME.match(name):
+            raise ValueError("{}: {} is not a valid account name, use letters, digits, '.', '_' and '-'".format(
+                path, name))
+        for key in ('credentials', 'db_uri', 'queries'):
+            if not account.get(key):
+                raise ValueError("{}: account {} has no {}".format(path, name, key))
+        if name in names:
+            raise ValueError("{}: account {} is defined twice".format(path, name))
+        names.add(name)
+
+        queries = []
+        for report, query_ids in account['queries'].items():
+            if report not in REPORTS:
+                raise ValueError("{}: {} is not a valid report of account {}, use one of {}".format(
+                    path, report, name, tuple(REPORTS)))
+            queries.extend((report, str(query_id)) for query_id in
+                           (query_ids if isinstance(query_ids, list) else [query_ids]))
+
+        parquet_dir = account.get('parquet_dir')
+        accounts.append(Account(name=name,
+                                credentials=os.path.join(directory, account['credentials']),
+                                db_uri=account['db_uri'],
+                                queries=queries,
+                                api_rate=account.get('api_rate', defaults['api_rate']),
+                                workers=account.get('workers', defaults['workers']),
+                                parquet_dir=os.path.join(directory, parquet_dir) if parquet_dir else None))
+
+    if not accounts:
+        raise ValueError("{}: no accounts".format(path))
+    return accounts
+
+
+def run_account(account, run_kwargs, options):
+    """
+    Run and load all queries of one account with core.orchestrator.Orchestrator.
+    Runs in worker process of ShardedRunner, so it takes and returns only picklable data.
+    :param account: Account
+    :param run_kwargs: arguments of DBMQuery.run_query, e.g. {'daterange': 'PREVIOUS_DAY'}
+    :param options: dict of ShardedRunner options: timeout, batch_size, state_dir, cache_size
+    :return: ({query_id: {table name: number of rows written}}, core.metrics snapshot of account)
+    """
+    # worker process may run more than one account
+    metrics.reset()
+
+    state_dir = os.path.join(options['state_dir'], account.name)
+    os.makedirs(state_dir, exist_ok=True)
+    dbm = DBMQuery(account.credentials,
+                   history_file=os.path.join(state_dir, 'query-history.json'),
+                   cache=ReportCache(os.path.join(state_dir, 'report-cache'), max_size=options['cache_size']),
+                   api_rate=account.api_rate)
+
+    engine = create_engine(account.db_uri)
+    instrument_engine(engine)
+    try:
+        Base.metadata.create_all(engine)
+        jobs = [Job(query_id, REPORTS[report]) for report, query_id in account.queries]
+        sinks = [ParquetSink(account.parquet_dir)] if account.parquet_dir else []
+        orchestrator = Orchestrator(dbm, engine, jobs, workers=account.workers, timeout=options['timeout'],
+                                    batch_size=options['batch_size'], sinks=sinks)
+        results = orchestrator.run(**run_kwargs)
+    finally:
+        engine.dispose()
+
+    return results, metrics.snapshot()
+
+
+class ShardedRunner():
+    """
+    Runs every account in its own worker process, `processes` accounts at once. Accounts don't share
+    API quota, credentials or database, so total throughput grows with number of accounts.
+    Failure of one account, even a crash of its process, is recorded and does not stop the others.
+    Worker processes are spawned, not forked, so the main module of a script using it
+    has to be safe to import (see sharded-stats.py).
+    """
+
+    def __init__(self, accounts, processes=None, state_dir='.accounts', timeout=3600,
+                 batch_size=DEFAULT_BATCH_SIZE, cache_size=DEFAULT_MAX_SIZE, target=run_account, log_format='text'):
+        """
+        :param accounts: list of Account, e.g. from load_manifest
+        :param processes: accounts run at once, defaults to number of accounts
+        :param state_dir: directory of query history and report cache of every account
+        :param timeout: max seconds one query runs in DBM
+        :param batch_size: rows per INSERT statement
+        :param cache_size: max size of report cache of one account in bytes
+        :param target: function run for every account in worker process, see run_account
+        :param log_format: log format of worker processes, see core.metrics.configure_logging
+        """
+        self.accounts = list(accounts)
+        self.processes = processes or len(self.accounts)
+        self.target = target
+        self.log_format = log_format
+        self.options = {'state_dir': os.path.abspath(state_dir), 'timeout': timeout, 'batch_size': batch_size,
+                        'cache_size': cache_size}
+
+    def run(self, daterange, start_date=None, end_date=None, timezone='America/New_York'):
+        """
+        Run queries of all accounts. Arguments are passed to DBMQuery.run_query.
+        Stage metrics of accounts are added to process-wide core.metrics.
+        :return: dict {account name: {query_id: {table name: rows}} or exception of failed account}
+        """
+        run_kwargs = {'daterange': daterange, 'start_date': start_date, 'end_date': end_date, 'timezone': timezone}
+        results = {}
+
+        # threads only wait for worker processes
+        with ThreadPoolExecutor(max_workers=self.processes) as pool:
+            futures = {pool.submit(self._run_account, account, run_kwargs): account.name
+                       for account in self.accounts}
+
+            for future in as_completed(futures):
+                name = futures[future]
+                try:
+                    results[name], stages = future.result()
+                except Exception as exception:
+                    logger.exception("Account {} failed".format(name))
+                    results[name] = exception
+                    continue
+
+                for stage, totals in stages.items():
+                    metrics.add(stage, **totals)
+                logger.info("Account {} loaded: {}".format(name, results[name]))
+
+        return {account.name: results[account.name] for account in self.accounts}
+
+    def _run_account(self, account, run_kwargs):
+        # pool of its own, a worker which dies breaks only this account (BrokenProcessPool).
+        # Forking from this thread could copy a lock held by another thread, e.g. of core.metrics
+        with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn'),
+                                 initializer=configure_logging, initargs=(self.log_format,)) as pool:
+            return pool.submit(self.target, account, run_kwargs, self.options).result()
+
+    @staticmethod
+    def failed(results):
+        """
+        Returns names of failed accounts.
+        :param results: dict from run
+        :return: list of account names
+        """
+        return [name for name, result in results.items() if isinstance(result, Exception)]
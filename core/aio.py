@@ -0,0 +1,218 @@
+"""
+asyncio interface to DBM API, for driving hundreds of queries from one process.
+Google's API client is synchronous and not thread safe, so calls run in a pool of threads,
+each with its own DBMQuery. Credentials and discovery document are shared (see core.util).
+"""
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+from core.metrics import metrics
+from core.util import Backoff, DBMQuery, ReportParser, STREAM_CHUNK_SIZE, get_http_session
+
+# DBM API calls per second made by one AsyncDBMQuery
+DEFAULT_API_RATE = 5
+
+
+class AsyncRateLimiter():
+    """
+    Spaces calls evenly, so no more than `rate` calls per second are made.
+    """
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate
+        self.next_call = 0
+
+    async def wait(self):
+        """
+        Wait until next call is allowed.
+        """
+        now = time.monotonic()
+        delay = self.next_call - now
+        self.next_call = max(now, self.next_call) + self.interval
+
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+class AsyncDBMQuery():
+    """
+    The same methods as DBMQuery, but as coroutines. At most `concurrency` API calls are in flight
+    and no more than `rate` calls per second are started, to stay within API quota.
+    """
+
+    def __init__(self, auth_json, concurrency=10, rate=DEFAULT_API_RATE, downloads=10, factory=DBMQuery, **kwargs):
+        """
+        :param auth_json: path to API key in JSON
+        :param concurrency: max API calls in flight
+        :param rate: max API calls started per second
+        :param downloads: max report bodies read at once
+        :param factory: callable creating DBMQuery for worker thread
+        :param kwargs: passed to factory, e.g. history_file or cache
+        """
+        self.auth_json = auth_json
+        self.factory = partial(factory, auth_json, **kwargs)
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.limiter = AsyncRateLimiter(rate)
+        self.api_executor = ThreadPoolExecutor(max_workers=concurrency)
+        self.download_executor = ThreadPoolExecutor(max_workers=downloads)
+        self.local = threading.local()
+
+        # state shared by DBMQuery instances of all threads
+        self.primary = self.factory()
+        self.run_times = self.primary.run_times
+        # QueryHistory is thread safe
+        self.history = self.primary.history
+        self.cache = getattr(self.primary, 'cache', None)
+
+    def _dbm(self):
+        if not hasattr(self.local, 'dbm'):
+            dbm = self.factory()
+            dbm.run_times, dbm.history = self.run_times, self.history
+            self.local.dbm = dbm
+        return self.local.dbm
+
+    def _run(self, method, args, kwargs):
+        return getattr(self._dbm(), method)(*args, **kwargs)
+
+    async def _call(self, method, *args, **kwargs):
+        async with self.semaphore:
+            await self.limiter.wait()
+            loop = asyncio.get_event_loop()
+            return await loop.run_in_executor(self.api_executor, self._run, method, args, kwargs)
+
+    async def run_query(self, query_id, daterange, start_date=None, end_date=None, timezone='America/New_York'):
+        """
+        See DBMQuery.run_query
+        """
+        return await self._call('run_query', query_id, daterange, start_date=start_date, end_date=end_date,
+                                timezone=timezone)
+
+    async def create_query(self, file):
+        """
+        See DBMQuery.create_query
+        """
+        return await self._call('create_query', file)
+
+    async def get_query(self, query_id):
+        """
+        See DBMQuery.get_query
+        """
+        return await self._call('get_query', query_id)
+
+    async def get_query_url_to_file(self, query_id):
+        """
+        See DBMQuery.get_query_url_to_file
+        """
+        return await self._call('get_query_url_to_file', query_id)
+
+    async def fresh_report(self, query_id):
+        """
+        See DBMQuery.fresh_report
+        """
+        return await self._call('fresh_report', query_id)
+
+    async def delete_query(self, query_id):
+        """
+        See DBMQuery.delete_query
+        """
+        return await self._call('delete_query', query_id)
+
+    async def wait_for_report(self, query_id, timeout=3600, initial_delay=None, backoff=None):
+        """
+        See DBMQuery.wait_for_report, waiting does not block other queries.
+        :return: dict with query metadata
+        """
+        deadline = time.time() + timeout
+        backoff = backoff or Backoff()
+        if initial_delay is None:
+            initial_delay = 0.8 * self.primary.expected_duration(query_id)
+        await self._sleep(min(initial_delay, timeout))
+
+        while True:
+            metadata = await self.fresh_report(query_id)
+            if metadata:
+                return metadata
+
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                raise TimeoutError("Query ID {} did not finish in {} seconds".format(query_id, timeout))
+            await self._sleep(min(backoff.next(), remaining))
+
+    async def _sleep(self, seconds):
+        with metrics.timer('poll'):
+            await asyncio.sleep(seconds)
+
+    async def download_query(self, query_id, type='dict', footer_column='Date'):
+        """
+        See DBMQuery.download_query. For type='stream' use stream_query.
+        """
+        if type == 'stream':
+            return self.stream_query(query_id, footer_column=footer_column)
+
+        # report body is read in download thread, but API call inside still counts against limits
+        async with self.semaphore:
+            await self.limiter.wait()
+            loop = asyncio.get_event_loop()
+            return await loop.run_in_executor(self.download_executor, self._run, 'download_query', (query_id, type), {})
+
+    async def stream_query(self, query_id, chunk_size=STREAM_CHUNK_SIZE, encoding='utf-8', footer_column='Date'):
+        """
+        Read report in chunks in download threads and parse it in event loop as chunks arrive.
+        :param footer_column: column which is empty in summary rows, e.g. `footer` of row mapper
+        :return: async generator of OrderedDict rows
+        """
+        loop = asyncio.get_event_loop()
+        parser = ReportParser(encoding, footer_column)
+
+        if self.cache is not None:
+            path = await self._call('cache_report', query_id)
+            chunks, close = iter(self.cache.read(path, chunk_size)), None
+        else:
+            url = await self.get_query_url_to_file(query_id)
+            response = await loop.run_in_executor(self.download_executor,
+                                                  partial(get_http_session().get, url, stream=True))
+            response.raise_for_status()
+            chunks, close = response.iter_content(chunk_size), response.close
+
+        # bytes are counted only for reports read over network
+        size = 0
+        try:
+            while not parser.done:
+                chunk = await loop.run_in_executor(self.download_executor, next, chunks, None)
+                size += len(chunk) if chunk is not None else 0
+                rows = parser.feed(chunk) if chunk is not None else parser.close()
+                for row in rows:
+                    yield row
+                if chunk is None:
+                    break
+        finally:
+            if close:
+                metrics.add('download', calls=1, bytes=size)
+                close()
+
+    def close(self):
+        """
+        Stop worker threads.
+        """
+        self.api_executor.shutdown(wait=False)
+        self.download_executor.shutdown(wait=False)
+
+
+async def run_queries(dbm, query_ids, handler, daterange, **kwargs):
+    """
+    Run many queries at once and pass each report to handler as soon as it is ready.
+    :param dbm: AsyncDBMQuery
+    :param query_ids: QueryIDs in DBM
+    :param handler: coroutine function(query_id, async generator of rows)
+    :param daterange: passed to run_query together with kwargs
+    :return: list of handler results or exceptions, in order of query_ids
+    """
+    async def run(query_id):
+        await dbm.run_query(query_id, daterange, **kwargs)
+        await dbm.wait_for_report(query_id)
+        return await handler(query_id, dbm.stream_query(query_id))
+
+    return await asyncio.gather(*(run(query_id) for query_id in query_ids), return_exceptions=True)
@@ -0,0 +1,206 @@
+import logging
+import threading
+import time
+from collections import deque
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+
+from sqlalchemy import select
+
+from core.loader import BulkLoader, DEFAULT_BATCH_SIZE
+from core.mappers import DIMENSIONS
+from core.metrics import metrics
+from core.models import BackfillCheckpoint
+from core.pipeline import load_report, report_rows
+from core.rollups import ROLLUPS
+from core.sinks import open_sinks
+from core.util import Backoff, RateLimiter
+
+logger = logging.getLogger(__name__)
+
+SHARD_DAYS = {'day': 1, 'week': 7}
+
+# DBM API calls per second made by one backfill
+DEFAULT_API_RATE = 1
+
+
+def shard_dates(start, end, shard='day'):
+    """
+    Split date range into consecutive shards.
+    :param start: first day, datetime.date
+    :param end: last day (inclusive), datetime.date
+    :param shard: 'day' or 'week'
+    :return: list of (first day, last day) tuples
+    """
+    if shard not in SHARD_DAYS:
+        raise ValueError("{} is not a valid shard size, use one of {}".format(shard, tuple(SHARD_DAYS)))
+
+    shards = []
+    while start <= end:
+        shard_end = min(start + timedelta(days=SHARD_DAYS[shard] - 1), end)
+        shards.append((start, shard_end))
+        start = shard_end + timedelta(days=1)
+    return shards
+
+
+class Backfill():
+    """
+    Loads historical data of DBM query shard by shard. Every shard is loaded in its own transaction
+    together with its checkpoint, so interrupted backfill resumes from the first missing shard.
+    DBM runs one report per query at a time, so shards run in parallel on one-time copies
+    of the query which are deleted when backfill ends.
+    Rollups are refreshed once for days of loaded shards after all shards are committed,
+    parallel shards would recompute the same monthly groups.
+    """
+
+    def __init__(self, dbm, engine, query_id, mapper, concurrency=4, api_rate=DEFAULT_API_RATE,
+                 timeout=3600, timezone='America/New_York', batch_size=DEFAULT_BATCH_SIZE, sinks=(),
+                 rollups=ROLLUPS):
+        self.dbm = dbm
+        self.engine = engine
+        self.query_id = str(query_id)
+        self.mapper = mapper
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.timezone = timezone
+        self.loader = BulkLoader(engine, batch_size=batch_size)
+        # outputs written alongside database, e.g. core.sinks.ParquetSink
+        self.sinks = sinks
+        self.rollups = rollups
+        # tables written by loaded shards, their rollups are refreshed at the end
+        self.written_tables = set()
+
+        # API client is shared by all workers, it is neither thread safe nor free
+        self.api_lock = threading.Lock()
+        self.api_limiter = RateLimiter(api_rate)
+
+    def completed_shards(self):
+        """
+        Returns shards of this query which are already loaded.
+        :return: set of (first day, last day) tuples
+        """
+        table = BackfillCheckpoint.__table__
+        query = select([table.c.start_date, table.c.end_date]).where(table.c.query_id == self.query_id)
+        return {(row.start_date, row.end_date) for row in self.engine.execute(query)}
+
+    def run(self, start, end, shard='day'):
+        """
+        Load all shards of date range which are not loaded yet.
+        :param start: first day, datetime.date
+        :param end: last day (inclusive), datetime.date
+        :param shard: 'day' or 'week'
+        :return: dict {(first day, last day): number of rows written}
+        """
+        completed = self.completed_shards()
+        shards = [x for x in shard_dates(start, end, shard) if x not in completed]
+        logger.info("{} shards to load, {} already loaded".format(len(shards), len(completed)))
+        if not shards:
+            return {}
+
+        slots = [self.query_id]
+        queue = deque(shards)
+        results, failed = {}, []
+
+        def work(slot):
+            while True:
+                try:
+                    current = queue.popleft()
+                except IndexError:
+                    return
+                try:
+                    results[current] = self.load_shard(slot, *current)
+                except Exception:
+                    # shard stays without checkpoint and is retried when backfill is resumed
+                    logger.exception("Loading shard {} - {} failed".format(*current))
+                    failed.append(current)
+
+        try:
+            # every clone is deleted afterwards, even if cloning the next one fails
+            for number in range(min(self.concurrency, len(shards)) - 1):
+                slots.append(self._clone_query(number))
+            with ThreadPoolExecutor(max_workers=len(slots)) as pool:
+                for future in [pool.submit(work, slot) for slot in slots]:
+                    future.result()
+        finally:
+            for slot in slots[1:]:
+                self._call_api(self.dbm.delete_query, slot)
+
+        # also when some shards failed, loaded ones are not loaded again
+        self.refresh_rollups(results)
+
+        if failed:
+            raise RuntimeError("Loading shards {} failed, run backfill again to retry them".format(
+                ", ".join("{} - {}".format(*x) for x in sorted(failed))))
+
+        return results
+
+    def refresh_rollups(self, shards):
+        """
+        Recompute rollups of written tables for all days of shards in one transaction.
+        :param shards: iterable of (first day, last day) tuples
+        """
+        dates = set()
+        for start, end in shards:
+            dates.update(start + timedelta(days=x) for x in range((end - start).days + 1))
+        rollups = [x for x in self.rollups if x.source.name in self.written_tables]
+        if not dates or not rollups:
+            return
+
+        with metrics.timer('rollups'), self.engine.begin() as connection:
+            for rollup in rollups:
+                rollup.refresh_dates(connection, dates)
+        logger.info("Refreshed {} for {} days".format(", ".join(x.name for x in rollups), len(dates)))
+
+    def load_shard(self, slot, start, end):
+        """
+        Run query for one shard and load its report together with checkpoint.
+        :param slot: QueryID used to run this shard
+        :param start: first day of shard
+        :param end: last day of shard
+        :return: number of rows written
+        """
+        logger.info("Running shard {} - {} on query {}".format(start, end, slot))
+        self._call_api(self.dbm.run_query, slot, 'CUSTOM_DATES',
+                       start_date=datetime.combine(start, datetime.min.time()),
+                       end_date=datetime.combine(end, datetime.min.time()),
+                       timezone=self.timezone)
+
+        metadata = self._wait(slot)
+        rows = report_rows(self.dbm, slot, metadata, self.mapper.footer)
+
+        # Parquet partitions are replaced only after shard and its checkpoint are committed
+        with open_sinks(self.sinks, self.query_id) as writers, self.engine.begin() as connection:
+            counts = load_report(self.loader, connection, rows, self.mapper, DIMENSIONS, writers=writers)
+            written = sum(counts.values())
+            self.loader.upsert(BackfillCheckpoint, [dict(query_id=self.query_id, start_date=start, end_date=end,
+                                                         rows=written, completed_at=datetime.utcnow())],
+                               connection)
+
+        self.written_tables.update(table for table, count in counts.items() if count)
+        logger.info("Loaded shard {} - {}: {}".format(start, end, counts))
+        return written
+
+    def _wait(self, slot):
+        deadline = time.time() + self.timeout
+        backoff = Backoff()
+        with metrics.timer('poll'):
+            time.sleep(0.8 * self.dbm.expected_duration(slot))
+
+        while True:
+            metadata = self._call_api(self.dbm.fresh_report, slot)
+            if metadata:
+                return metadata
+            if time.time() >= deadline:
+                raise TimeoutError("Query ID {} did not finish in {} seconds".format(slot, self.timeout))
+            with metrics.timer('poll'):
+                time.sleep(min(backoff.next(), max(deadline - time.time(), 0)))
+
+    def _clone_query(self, number):
+        return self._call_api(self.dbm.clone_query, self.query_id,
+                              title="backfill {} #{}".format(self.query_id, number + 1))['queryId']
+
+    def _call_api(self, method, *args, **kwargs):
+        with self.api_lock:
+            self.api_limiter.wait()
+            return method(*args, **kwargs)
+
@@ -0,0 +1,108 @@
+"""
+Management of many DBM queries at once, e.g. a few hundred per-advertiser queries.
+"""
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from core.util import API_BATCH_SIZE
+
+# threads sending batch requests at once
+DEFAULT_WORKERS = 8
+
+
+def query_files(paths):
+    """
+    Returns JSON files from paths, directories are replaced with JSON files in them.
+    :param paths: paths to JSON files or directories
+    :return: list of paths
+    """
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(os.path.join(path, name) for name in sorted(os.listdir(path)) if name.endswith('.json'))
+        else:
+            files.append(path)
+    return files
+
+
+class QueryBatch():
+    """
+    Runs one operation on many queries. Requests are grouped into batch HTTP requests
+    (see DBMQuery.execute_batch) and batches are sent from a bounded pool of threads.
+    API client is not thread safe, so every thread has its own DBMQuery.
+    """
+
+    def __init__(self, factory, workers=DEFAULT_WORKERS, batch_size=API_BATCH_SIZE):
+        """
+        :param factory: callable() -> DBMQuery, e.g. functools.partial(DBMQuery, auth_json)
+        :param workers: max batches sent at once
+        :param batch_size: requests in one batch, 1 sends every request on its own
+        """
+        self.factory = factory
+        self.workers = workers
+        self.batch_size = batch_size
+        self.local = threading.local()
+
+    def run(self, query_ids, daterange=None, body=None, **kwargs):
+        """
+        Run queries, see DBMQuery.run_query.
+        :param query_ids: QueryIDs in DBM
+        :param daterange: passed to run_query_request together with kwargs
+        :param body: runquery body used as is instead of daterange, e.g. from queries/runquery_yesterday.json
+        :return: dict {query_id: json response from DBM or exception}
+        """
+        return self._map(lambda dbm, query_id: dbm.run_query_request(query_id, daterange, body=body, **kwargs),
+                         query_ids)
+
+    def create(self, paths):
+        """
+        Create queries from JSON files, see DBMQuery.create_query.
+        :param paths: JSON files or directories of them
+        :return: dict {path: json response from DBM or exception}
+        """
+        return self._map(lambda dbm, path: dbm.create_query_request(path), query_files(paths))
+
+    def delete(self, query_ids):
+        """
+        Delete queries, see DBMQuery.delete_query.
+        :param query_ids: QueryIDs in DBM
+        :return: dict {query_id: json response from DBM or exception}
+        """
+        return self._map(lambda dbm, query_id: dbm.delete_query_request(query_id), query_ids)
+
+    def _dbm(self):
+        if not hasattr(self.local, 'dbm'):
+            self.local.dbm = self.factory()
+        return self.local.dbm
+
+    def _send(self, build, items):
+        dbm = self._dbm()
+        results, requests = {}, {}
+        for item in items:
+            try:
+                requests[item] = build(dbm, item)
+            except Exception as exception:
+                results[item] = exception
+
+        if self.batch_size > 1:
+            results.update(dbm.execute_batch(requests, self.batch_size))
+            return results
+
+        for item, request in requests.items():
+            try:
+                results[item] = dbm._execute(request)
+            except Exception as exception:
+                results[item] = exception
+        return results
+
+    def _map(self, build, items):
+        items = list(items)
+        chunks = [items[offset:offset + self.batch_size] for offset in range(0, len(items), self.batch_size)]
+        results = {}
+
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            for chunk_results in pool.map(lambda chunk: self._send(build, chunk), chunks):
+                results.update(chunk_results)
+
+        return {item: results[item] for item in items}
@@ -0,0 +1,117 @@
+import mmap
+import os
+
+from core.util import STREAM_CHUNK_SIZE, download_to_file
+
+# 10 GB
+DEFAULT_MAX_SIZE = 10 * 1024 ** 3
+
+
+class ReportCache():
+    """
+    On-disk cache of downloaded DBM reports. Report of a query is identified by query ID
+    and its latestReportRunTimeMs, so a new run of query never hits stale file.
+    When cache grows over `max_size` bytes, least recently used reports are removed.
+    """
+
+    def __init__(self, directory, max_size=DEFAULT_MAX_SIZE):
+        self.directory = directory
+        self.max_size = max_size
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, query_id, run_time_ms):
+        """
+        Returns path of cached report, whether it exists or not.
+        :param query_id: QueryID in DBM
+        :param run_time_ms: latestReportRunTimeMs from DBMQuery.get_query
+        """
+        return os.path.join(self.directory, '{}-{}.csv'.format(query_id, run_time_ms))
+
+    def get(self, query_id, run_time_ms):
+        """
+        Returns path to cached report and marks it as recently used.
+        :param query_id: QueryID in DBM
+        :param run_time_ms: latestReportRunTimeMs from DBMQuery.get_query
+        :return: path, None if report is not cached
+        """
+        path = self.path(query_id, run_time_ms)
+        if not os.path.exists(path):
+            return None
+
+        os.utime(path)
+        return path
+
+    def latest(self, query_id):
+        """
+        Returns path to the newest cached report of query, without asking DBM API.
+        :param query_id: QueryID in DBM
+        :return: path, None if no report of query is cached
+        """
+        prefix = '{}-'.format(query_id)
+        run_times = [int(name[len(prefix):-len('.csv')]) for name in os.listdir(self.directory)
+                     if name.startswith(prefix) and name.endswith('.csv')]
+        return self.get(query_id, max(run_times)) if run_times else None
+
+    def fetch(self, query_id, run_time_ms, url, **kwargs):
+        """
+        Returns path to cached report, downloading it first if needed.
+        :param query_id: QueryID in DBM
+        :param run_time_ms: latestReportRunTimeMs from DBMQuery.get_query
+        :param url: URL to report file
+        :param kwargs: passed to core.util.download_to_file, e.g. progress
+        :return: path
+        """
+        path = self.get(query_id, run_time_ms)
+        if path is None:
+            path = download_to_file(url, self.path(query_id, run_time_ms), **kwargs)
+            self.evict(keep=path)
+        return path
+
+    def read(self, path, chunk_size=STREAM_CHUNK_SIZE):
+        """
+        Read cached report in chunks through memory map, see iter_file_chunks.
+        :param path: path from fetch, get or latest
+        :return: generator of memoryview
+        """
+        return iter_file_chunks(path, chunk_size)
+
+    def evict(self, keep=None):
+        """
+        Remove least recently used reports until cache fits in max_size.
+        Partial downloads are left alone, so they can be resumed.
+        :param keep: path which is never removed, e.g. report which is about to be read
+        """
+        reports = []
+        for name in os.listdir(self.directory):
+            if name.endswith('.csv'):
+                stat = os.stat(os.path.join(self.directory, name))
+                reports.append((stat.st_mtime, stat.st_size, os.path.join(self.directory, name)))
+
+        size = sum(report[1] for report in reports)
+        for mtime, report_size, path in sorted(reports):
+            if size <= self.max_size:
+                break
+            if path != keep:
+                os.remove(path)
+                size -= report_size
+
+
+def iter_file_chunks(path, chunk_size=STREAM_CHUNK_SIZE):
+    """
+    Read file through memory map in chunks, without copying it to Python bytes.
+    Chunks can be passed to core.util.iter_report_rows.
+    :param path: path to file, e.g. from ReportCache.fetch
+    :param chunk_size: size of chunk in bytes
+    :return: generator of memoryview
+    """
+    if os.path.getsize(path) == 0:
+        return
+
+    with open(path, 'rb') as file:
+        mapped = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    # map is not closed explicitly - consumer may still hold the last chunk,
+    # it is unmapped when the last view is garbage collected
+    view = memoryview(mapped)
+    for offset in range(0, len(view), chunk_size):
+        yield view[offset:offset + chunk_size]
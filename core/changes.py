@@ -0,0 +1,97 @@
+import hashlib
+from datetime import datetime
+from decimal import Decimal
+
+from sqlalchemy import Date, Integer, Numeric, select
+
+from core.loader import unique_columns
+
+
+def normalize(column, value):
+    """
+    Returns canonical text of value as it would be stored in column,
+    so values from report and from database hash the same, e.g. '100' and 100 in Integer column.
+    :param column: SQLAlchemy Column
+    :param value: value from report or database
+    :return: str
+    """
+    if value is None:
+        return ''
+    elif isinstance(column.type, Integer):
+        return str(int(float(value)))
+    elif isinstance(column.type, Numeric):
+        scale = column.type.scale or 0
+        return str(Decimal(str(value)).quantize(Decimal(1).scaleb(-scale)))
+    elif isinstance(column.type, Date):
+        return (value.date() if isinstance(value, datetime) else value).isoformat()
+    return str(value)
+
+
+class ChangeDetector():
+    """
+    Filters out rows which are already stored with the same values.
+    Each row is identified by columns of table's unique constraint, e.g. (date, line_item_id, conversion_id),
+    and compared by hash of all other columns. Stored rows are fetched once per date.
+    """
+
+    def __init__(self, model, connection):
+        self.table = model.__table__
+        self.connection = connection
+        self.keys = unique_columns(self.table)
+        self.metrics = [column for column in self.table.columns
+                        if not column.primary_key and column.name not in self.keys]
+
+        # key -> hash of metric values
+        self.hashes = {}
+        self.loaded_dates = set()
+        self.skipped = 0
+
+    def row_hash(self, row):
+        """
+        Returns hash of row's metric columns.
+        :param row: dict with column names as keys
+        :return: bytes
+        """
+        text = '\x1f'.join(normalize(column, row.get(column.name)) for column in self.metrics)
+        return hashlib.blake2b(text.encode('utf-8'), digest_size=16).digest()
+
+    def row_key(self, row):
+        return tuple(normalize(self.table.c[key], row[key]) for key in self.keys)
+
+    def is_changed(self, row):
+        """
+        Check if row is new or differs from stored one. Row is remembered as stored afterwards.
+        :param row: dict with column names as keys
+        :return: bool
+        """
+        self._load_date(row['date'] if 'date' in self.keys else None)
+
+        key, row_hash = self.row_key(row), self.row_hash(row)
+        if self.hashes.get(key) == row_hash:
+            self.skipped += 1
+            return False
+
+        self.hashes[key] = row_hash
+        return True
+
+    def filter(self, rows):
+        """
+        Returns generator of new and changed rows only.
+        :param rows: iterable of dicts with column names as keys
+        """
+        return (row for row in rows if self.is_changed(row))
+
+    def _load_date(self, value):
+        # None loads whole table, for tables without date in their key
+        value = value.date() if isinstance(value, datetime) else value
+        if value in self.loaded_dates:
+            return
+
+        columns = [self.table.c[key] for key in self.keys] + self.metrics
+        query = select(columns)
+        if value is not None:
+            query = query.where(self.table.c.date == value)
+        for stored in self.connection.execute(query):
+            stored = dict(stored)
+            self.hashes[self.row_key(stored)] = self.row_hash(stored)
+        self.loaded_dates.add(value)
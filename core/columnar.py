@@ -0,0 +1,213 @@
+"""
+Columnar parsing of DBM reports. Instead of building dict per row and cleaning every cell,
+report is read in batches of columns and each column is converted in bulk.
+Columns are NumPy arrays or pyarrow arrays if available, array.array / list otherwise.
+"""
+import csv
+from array import array
+from datetime import datetime
+
+from core.util import DATE_FORMATS, clean_currency_values, clean_date_value, iter_lines
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
+
+COLUMN_BATCH_SIZE = 64 * 1024
+
+# column types understood by parse_columns
+TYPES = ('str', 'int', 'float', 'currency', 'date')
+
+
+def default_backend():
+    if numpy is not None:
+        return 'numpy'
+    elif pyarrow is not None:
+        return 'arrow'
+    return 'array'
+
+
+class ColumnBatch():
+    """
+    Batch of report rows stored as columns: {column name: array of values}
+    """
+
+    def __init__(self, columns):
+        self.columns = columns
+
+    def __len__(self):
+        for values in self.columns.values():
+            return len(values)
+        return 0
+
+    def __getitem__(self, name):
+        return self.columns[name]
+
+    def to_pylist(self, name):
+        """
+        Returns column as list of Python objects, e.g. for database drivers.
+        :param name: column name
+        :return: list
+        """
+        values = self.columns[name]
+        if hasattr(values, 'tolist'):
+            values = values.tolist()
+        elif hasattr(values, 'to_pylist'):
+            values = values.to_pylist()
+        return list(values)
+
+    def rename(self, names):
+        """
+        Select and rename columns, e.g. report columns to model columns.
+        :param names: dict {new name: column name in this batch}
+        :return: ColumnBatch
+        """
+        return ColumnBatch({new: self.columns[old] for new, old in names.items()})
+
+    def rows(self):
+        """
+        Returns generator of dict rows with Python values.
+        """
+        names = list(self.columns)
+        for values in zip(*(self.to_pylist(name) for name in names)):
+            yield dict(zip(names, values))
+
+
+def parse_columns(chunks, types, encoding='utf-8', footer_column='Date', batch_size=COLUMN_BATCH_SIZE,
+                  backend=None, skip=None):
+    """
+    Parse DBM csv report from chunks of bytes into batches of typed columns, stopping at summary rows.
+    :param chunks: iterable of bytes, e.g. requests.Response.iter_content()
+    :param types: dict {column name: one of TYPES}; other columns are dropped
+    :param encoding: encoding of chunks
+    :param footer_column: column which is empty in summary rows
+    :param batch_size: number of rows in one batch
+    :param backend: 'numpy', 'arrow' or 'array', defaults to the best available
+    :param skip: dict {column name: value} of rows to drop before conversion, e.g. 'Total' rows
+    :return: generator of ColumnBatch
+    """
+    backend = backend or default_backend()
+    reader = csv.reader(iter_lines(chunks, encoding))
+    header = next(reader)
+    positions = [(name, header.index(name)) for name in types]
+    footer = header.index(footer_column)
+    skip = [(header.index(name), value) for name, value in (skip or {}).items()]
+    date_formats = {}
+
+    batch = []
+    for row in reader:
+        if row[footer] == '':
+            break
+        if skip and any(row[position] == value for position, value in skip):
+            continue
+        batch.append(row)
+        if len(batch) >= batch_size:
+            yield _convert(batch, positions, types, backend, date_formats)
+            batch = []
+
+    if batch:
+        yield _convert(batch, positions, types, backend, date_formats)
+
+
+def _convert(rows, positions, types, backend, date_formats):
+    columns = {}
+    for name, position in positions:
+        values = [row[position] for row in rows]
+        columns[name] = convert_column(values, types[name], backend, date_formats, name)
+    return ColumnBatch(columns)
+
+
+def convert_column(values, type, backend=None, date_formats=None, name=None):
+    """
+    Convert list of strings to typed column in one go.
+    :param values: list of str
+    :param type: one of TYPES
+    :param backend: 'numpy', 'arrow' or 'array', defaults to the best available
+    :param date_formats: dict {column name: detected format} shared between batches of one report
+    :param name: column name, key in date_formats
+    :return: array of values
+    """
+    backend = backend or default_backend()
+
+    if type == 'str':
+        return numpy.array(values, dtype=object) if backend == 'numpy' else \
+            pyarrow.array(values, type=pyarrow.string()) if backend == 'arrow' else values
+
+    elif type == 'currency':
+        return _floats(clean_currency_values(values), backend)
+
+    elif type == 'float':
+        return _floats(values, backend)
+
+    elif type == 'int':
+        if backend == 'numpy':
+            # values like '12.0' are accepted, as in int(float(value))
+            return numpy.array(values).astype(numpy.float64).astype(numpy.int64)
+        values = [int(float(value)) for value in values]
+        return pyarrow.array(values, type=pyarrow.int64()) if backend == 'arrow' else array('q', values)
+
+    elif type == 'date':
+        dates = parse_dates(values, date_formats, name)
+        if backend == 'numpy':
+            return numpy.array(dates, dtype='datetime64[D]')
+        return pyarrow.array(dates, type=pyarrow.date32()) if backend == 'arrow' else dates
+
+    raise ValueError("{} is not a valid column type, use one of {}".format(type, TYPES))
+
+
+def _floats(values, backend):
+    if backend == 'numpy':
+        return numpy.array(values).astype(numpy.float64)
+    values = [float(value) for value in values]
+    return pyarrow.array(values, type=pyarrow.float64()) if backend == 'arrow' else array('d', values)
+
+
+def detect_date_format(values):
+    """
+    Returns first of DATE_FORMATS which parses all values, None if there is no such format.
+    :param values: iterable of date strings
+    """
+    for format in DATE_FORMATS:
+        try:
+            for value in values:
+                datetime.strptime(value, format)
+            return format
+        except ValueError:
+            continue
+    return None
+
+
+def parse_dates(values, date_formats=None, name=None):
+    """
+    Parse date column. Report has only a few distinct dates, so each of them is parsed once
+    with format detected for the whole column.
+    :param values: list of date strings
+    :param date_formats: dict {column name: detected format} to reuse format between batches
+    :param name: column name, key in date_formats
+    :return: list of datetime.date
+    """
+    unique = set(values)
+    date_formats = {} if date_formats is None else date_formats
+    parsed = None
+
+    if date_formats.get(name):
+        try:
+            parsed = {value: datetime.strptime(value, date_formats[name]).date() for value in unique}
+        except ValueError:
+            pass
+
+    if parsed is None:
+        format = date_formats[name] = detect_date_format(unique)
+        if format is None:
+            # mixed formats, fall back to cleaning every distinct value separately
+            parsed = {value: clean_date_value(value).date() for value in unique}
+        else:
+            parsed = {value: datetime.strptime(value, format).date() for value in unique}
+
+    return [parsed[value] for value in values]
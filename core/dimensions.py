@@ -0,0 +1,74 @@
+from sqlalchemy import select
+
+from core.loader import unique_columns
+
+
+class DimensionCache():
+    """
+    In-memory index of dimension table (MetaNames, ConversionPixelsMetaNames).
+    Existing rows are loaded once and every lookup afterwards is a dict access,
+    instead of querying database for each report row.
+    """
+
+    def __init__(self, model, key=None):
+        self.model = model
+        self.table = model.__table__
+        self.key = key or unique_columns(self.table)[0]
+        self.columns = [column.name for column in self.table.columns if not column.primary_key]
+
+        # key value -> dict of cached column values
+        self.rows = {}
+        self.inserted = set()
+
+    def load(self, connection):
+        """
+        Fetch all existing rows of dimension table in a single query.
+        :param connection: SQLAlchemy connection, engine or session
+        :return: self
+        """
+        query = select([self.table.c[column] for column in self.columns])
+
+        self.rows = {row[self.key]: dict(row) for row in connection.execute(query)}
+        self.inserted = set()
+        return self
+
+    def __contains__(self, key):
+        return key in self.rows
+
+    def __len__(self):
+        return len(self.rows)
+
+    def get(self, key, default=None):
+        return self.rows.get(key, default)
+
+    def is_changed(self, row):
+        """
+        Check if row differs from cached one in any of columns present in row.
+        :param row: dict with column names as keys
+        :return: bool, True for rows missing in cache too
+        """
+        cached = self.rows.get(row[self.key])
+        if cached is None:
+            return True
+        return any(cached.get(column) != value for column, value in row.items())
+
+    def update(self, rows):
+        """
+        Split rows into new and changed ones and record them in cache.
+        Rows identical to cached values are skipped.
+        :param rows: iterable of dicts with column names as keys
+        :return: tuple (new rows, changed rows)
+        """
+        new, changed = [], []
+
+        for row in rows:
+            key = row[self.key]
+            if key not in self.rows:
+                new.append(row)
+                self.inserted.add(key)
+                self.rows[key] = dict(row)
+            elif self.is_changed(row):
+                changed.append(row)
+                self.rows[key].update(row)
+
+        return new, changed
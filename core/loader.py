@@ -0,0 +1,188 @@
+from itertools import islice
+
+from sqlalchemy import UniqueConstraint, bindparam
+from sqlalchemy.dialects import mysql, postgresql, sqlite
+
+DEFAULT_BATCH_SIZE = 1000
+
+# SQLite refuses statements with more bound parameters than this
+SQLITE_MAX_VARIABLES = 32766
+
+
+def chunked(iterable, size):
+    """
+    Split iterable into lists of at most `size` elements.
+    :param iterable: any iterable, e.g. generator of rows
+    :param size: maximum length of yielded list
+    :return: generator of lists
+    """
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def unique_columns(table):
+    """
+    Returns names of columns of the unique constraint used as conflict target for upserts.
+    Table with more unique constraints has to name one of them in its info,
+    e.g. __table_args__ = (..., {'info': {'upsert_key': 'unique_li_per_date'}})
+    :param table: SQLAlchemy Table
+    :return: tuple of column names
+    """
+    constraints = [constraint for constraint in table.constraints if isinstance(constraint, UniqueConstraint)]
+    name = table.info.get('upsert_key')
+
+    if name is not None:
+        constraints = [constraint for constraint in constraints if constraint.name == name]
+        if not constraints:
+            raise ValueError("Table {} has no unique constraint {} to upsert on".format(table.name, name))
+    elif len(constraints) > 1:
+        # table.constraints is a set, so "the first one" would differ between runs
+        raise ValueError("Table {} has {} unique constraints, name the one to upsert on in info['upsert_key']".format(
+            table.name, len(constraints)))
+    elif not constraints:
+        raise ValueError("Table {} has no unique constraint to upsert on".format(table.name))
+
+    return tuple(column.name for column in constraints[0].columns)
+
+
+class BulkLoader():
+    """
+    Writes report rows to SQL with chunked multi-row
+    INSERT ... ON DUPLICATE KEY UPDATE / ON CONFLICT statements.
+    Loading the same rows twice updates them instead of failing on unique constraints.
+    """
+
+    def __init__(self, engine, batch_size=DEFAULT_BATCH_SIZE):
+        self.engine = engine
+        self.batch_size = batch_size
+        self.dialect = engine.dialect.name
+        # (table name, columns, rows) -> statement with bound parameters, see upsert_columns
+        self._statements = {}
+
+    def upsert(self, model, rows, connection=None):
+        """
+        Insert or update rows in model's table.
+        :param model: declarative model from core.models, e.g. BasicStats
+        :param rows: iterable of dicts with column names as keys
+        :param connection: open connection; if None, new transaction is opened for this load
+        :return: number of rows sent to database
+        """
+        if connection is None:
+            with self.engine.begin() as connection:
+                return self.upsert(model, rows, connection)
+
+        table = model.__table__
+        keys = unique_columns(table)
+        count = 0
+
+        for batch in chunked(rows, self.batch_size):
+            for statement_rows in chunked(self._deduplicate(batch, keys), self._max_rows(batch[0])):
+                connection.execute(self._statement(table, keys, statement_rows))
+                count += len(statement_rows)
+
+        return count
+
+    def upsert_columns(self, model, batch, connection=None):
+        """
+        Insert or update rows given as columns, e.g. from core.columnar.parse_columns.
+        Values are bound column by column to statement built once per number of rows,
+        so no dict is built for any row.
+        :param model: declarative model from core.models, e.g. BasicStats
+        :param batch: core.columnar.ColumnBatch with model's column names
+        :param connection: open connection; if None, new transaction is opened for this load
+        :return: number of rows sent to database
+        """
+        if connection is None:
+            with self.engine.begin() as connection:
+                return self.upsert_columns(model, batch, connection)
+
+        if not len(batch):
+            return 0
+
+        table = model.__table__
+        keys = unique_columns(table)
+        names = tuple(batch.columns)
+        columns = self._deduplicate_columns([batch.to_pylist(name) for name in names],
+                                            [names.index(key) for key in keys])
+        size = len(columns[0])
+        step = self._max_rows(names)
+
+        for start in range(0, size, step):
+            count = min(step, size - start)
+            parameters = {}
+            for number, values in enumerate(columns):
+                parameters.update(('c{}_{}'.format(number, row), value)
+                                  for row, value in enumerate(values[start:start + count]))
+            connection.execute(self._column_statement(table, keys, names, count), parameters)
+
+        return size
+
+    def _max_rows(self, row):
+        if self.dialect == 'sqlite':
+            return max(1, min(self.batch_size, SQLITE_MAX_VARIABLES // len(row)))
+        return self.batch_size
+
+    @staticmethod
+    def _deduplicate_columns(columns, key_positions):
+        # the same as _deduplicate, the last value of key wins
+        last = {}
+        for index, key in enumerate(zip(*(columns[position] for position in key_positions))):
+            last[key] = index
+        if len(last) == len(columns[0]):
+            return columns
+        indexes = sorted(last.values())
+        return [[values[index] for index in indexes] for values in columns]
+
+    def _column_statement(self, table, keys, names, count):
+        key = (table.name, names, count)
+        if key not in self._statements:
+            rows = [{name: bindparam('c{}_{}'.format(number, row), type_=table.c[name].type)
+                     for number, name in enumerate(names)} for row in range(count)]
+            self._statements[key] = self._statement(table, keys, rows)
+        return self._statements[key]
+
+    @staticmethod
+    def _deduplicate(rows, keys):
+        # one statement can't touch the same row twice (Postgres raises), so the last value wins
+        unique = {}
+        for row in rows:
+            unique[tuple(row[key] for key in keys)] = row
+        return list(unique.values())
+
+    def _statement(self, table, keys, rows):
+        update_columns = [column for column in rows[0] if column not in keys]
+
+        if self.dialect == 'mysql':
+            statement = mysql.insert(table).values(rows)
+            if not update_columns:
+                # MySQL needs at least one assignment, re-assigning key is a no-op
+                update_columns = keys[:1]
+            return statement.on_duplicate_key_update(
+                {column: statement.inserted[column] for column in update_columns})
+
+        elif self.dialect == 'postgresql':
+            statement = postgresql.insert(table).values(rows)
+            if not update_columns:
+                return statement.on_conflict_do_nothing(index_elements=keys)
+            return statement.on_conflict_do_update(
+                index_elements=keys,
+                set_={column: statement.excluded[column] for column in update_columns})
+
+        elif self.dialect == 'sqlite':
+            if hasattr(sqlite, 'insert'):
+                statement = sqlite.insert(table).values(rows)
+                if not update_columns:
+                    return statement.on_conflict_do_nothing(index_elements=keys)
+                return statement.on_conflict_do_update(
+                    index_elements=keys,
+                    set_={column: statement.excluded[column] for column in update_columns})
+            # SQLAlchemy < 1.4 has no ON CONFLICT support for SQLite
+            return table.insert().prefix_with('OR REPLACE').values(rows)
+
+        else:
+            raise NotImplementedError("Upserts are not supported for {} dialect".format(self.dialect))
+
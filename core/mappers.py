@@ -0,0 +1,18 @@
+"""
+Row mappers translate one row of DBM csv report into rows of tables from core.models.
+Every mapper returns dict {model: dict of column values}; empty dict skips the row.
+Mappers are compiled from declarative mappings in core/mappings.yaml, see core.mapping.
+"""
+from core.mapping import load_mappings
+from core.models import MetaNames, ConversionPixelsMetaNames
+
+# tables with names of DBM entities, written only when new or renamed
+DIMENSIONS = (MetaNames, ConversionPixelsMetaNames)
+
+MAPPINGS = load_mappings()
+
+# basic stats report (dimension: Line Item) to MetaNames and BasicStats
+basic_stats_mapper = MAPPINGS['basic_stats'].row_mapper()
+
+# conversion report (dimensions: Line Item, DV360 Activity) to ConversionPixelsMetaNames and ConversionPixels
+conversion_stats_mapper = MAPPINGS['conversion_stats'].row_mapper()
@@ -0,0 +1,138 @@
+"""
+Declarative mappings of DBM reports to tables, see core/mappings.yaml.
+Mapping is compiled into one row mapper function (for core.pipeline.load_report)
+or into transform of column batches (for core.columnar.parse_columns).
+"""
+import os
+
+import yaml
+
+from core import models
+from core.columnar import TYPES
+from core.util import clean_currency_value, clean_date_value
+
+MAPPINGS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'mappings.yaml')
+
+
+def to_int(value):
+    # most values are plain integers, some are written as '12.0'
+    return int(value) if value.isdigit() else int(float(value))
+
+
+# cleaners of row mappers by column type, None keeps text as is
+CLEANERS = {'str': None, 'int': to_int, 'float': float, 'currency': clean_currency_value, 'date': clean_date_value}
+
+
+class Mapping():
+    """
+    Mapping of one report: {model: {model column: (report column, type)}}
+    """
+
+    def __init__(self, name, tables, footer='Date', skip=None):
+        """
+        :param name: report name, e.g. basic_stats
+        :param tables: dict {model name: {model column: report column or {column, type}}}
+        :param footer: column which is empty in summary rows
+        :param skip: dict {report column: value} of rows to skip
+        """
+        self.name = name
+        self.footer = footer
+        self.skip = skip or {}
+        self.tables = {}
+
+        for model_name, fields in tables.items():
+            model = getattr(models, model_name, None)
+            if model is None or not hasattr(model, '__table__'):
+                raise ValueError("{}: {} is not a model from core.models".format(name, model_name))
+
+            self.tables[model] = {}
+            for target, source in fields.items():
+                if isinstance(source, str):
+                    source = {'column': source}
+                column, type = source['column'], source.get('type', 'str')
+                if target not in model.__table__.c:
+                    raise ValueError("{}: {} has no column {}".format(name, model_name, target))
+                if type not in TYPES:
+                    raise ValueError("{}: {} is not a valid column type, use one of {}".format(name, type, TYPES))
+                self.tables[model][target] = (column, type)
+
+    def column_types(self):
+        """
+        Returns report columns read by mapping, e.g. for core.columnar.parse_columns.
+        :return: dict {report column: type}
+        """
+        types = {}
+        for fields in self.tables.values():
+            for column, type in fields.values():
+                if types.setdefault(column, type) != type:
+                    raise ValueError("{}: column {} is mapped as both {} and {}".format(
+                        self.name, column, types[column], type))
+        return types
+
+    def row_mapper(self):
+        """
+        Compile mapping into function, see core.mappers.
+        Generated code reads and cleans each report column once and builds rows of all tables in one expression.
+        :return: callable(row) -> {model: values}, its source code is in `source` attribute,
+                 this mapping in `mapping` and column empty in summary rows in `footer`
+        """
+        namespace = {'__builtins__': __builtins__}
+        lines = ['def {}_mapper(row):'.format(self.name)]
+        for column, value in self.skip.items():
+            lines.append('    if row[{!r}] == {!r}:'.format(column, value))
+            lines.append('        return {}')
+
+        # (report column, type) -> local variable
+        variables = {}
+        for fields in self.tables.values():
+            for column, type in fields.values():
+                if (column, type) not in variables:
+                    variable = variables[(column, type)] = 'v{}'.format(len(variables))
+                    if CLEANERS[type] is None:
+                        lines.append('    {} = row[{!r}]'.format(variable, column))
+                    else:
+                        namespace['clean_' + type] = CLEANERS[type]
+                        lines.append('    {} = clean_{}(row[{!r}])'.format(variable, type, column))
+
+        tables = []
+        for model, fields in self.tables.items():
+            namespace[model.__name__] = model
+            values = ', '.join('{!r}: {}'.format(target, variables[source]) for target, source in fields.items())
+            tables.append('{}: {{{}}}'.format(model.__name__, values))
+        lines.append('    return {{{}}}'.format(', '.join(tables)))
+
+        source = '\n'.join(lines) + '\n'
+        exec(compile(source, '<mapping {}>'.format(self.name), 'exec'), namespace)
+        mapper = namespace['{}_mapper'.format(self.name)]
+        mapper.source = source
+        mapper.mapping = self
+        mapper.footer = self.footer
+        return mapper
+
+    def batch_transform(self):
+        """
+        Compile mapping into transform of column batches from core.columnar.parse_columns,
+        parsed with types from column_types(), footer and skip of this mapping.
+        :return: callable(ColumnBatch) -> {model: ColumnBatch with model columns}
+        """
+        self.column_types()
+        names = {model: {target: column for target, (column, type) in fields.items()}
+                 for model, fields in self.tables.items()}
+
+        def transform(batch):
+            return {model: batch.rename(columns) for model, columns in names.items()}
+
+        return transform
+
+
+def load_mappings(path=MAPPINGS_FILE):
+    """
+    Read mappings from YAML file.
+    :param path: path to YAML file, defaults to core/mappings.yaml
+    :return: dict {report name: Mapping}
+    """
+    with open(path) as file:
+        spec = yaml.safe_load(file)
+
+    return {name: Mapping(name, report['tables'], footer=report.get('footer', 'Date'), skip=report.get('skip'))
+            for name, report in spec.items()}
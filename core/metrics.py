@@ -0,0 +1,201 @@
+"""
+Per-stage metrics of ETL runs: time, calls, rows, bytes and database round-trips.
+Stages are recorded in process-wide `metrics` and exported as structured log records
+or Prometheus textfile, read by node_exporter's textfile collector.
+
+Stages used by core:
+api - DBM API calls, poll - sleeping until reports are ready, download - report files (bytes),
+parse - waiting for report rows, clean - mapping rows to tables, upsert - writing batches (rows),
+merge - merging staged report into stored rows (see core.reconcile), sql - every statement on instrumented engine (queries).
+Stages may overlap, e.g. streamed report is downloaded while it is parsed and upsert includes sql.
+Time of stages run in many threads is summed over threads.
+"""
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+FIELDS = ('seconds', 'calls', 'rows', 'bytes', 'queries')
+
+METRIC_HELP = {'seconds': 'Time spent in stage of last run',
+               'calls': 'Number of times stage was entered in last run',
+               'rows': 'Rows processed by stage in last run',
+               'bytes': 'Bytes transferred by stage in last run',
+               'queries': 'Database round-trips of stage in last run'}
+
+
+class Metrics():
+    """
+    Thread-safe totals of stages: {stage: {seconds, calls, rows, bytes, queries}}
+    """
+
+    def __init__(self):
+        self.stages = {}
+        self.lock = threading.Lock()
+
+    def add(self, stage, seconds=0, calls=0, rows=0, bytes=0, queries=0):
+        """
+        Add values to totals of stage.
+        """
+        with self.lock:
+            totals = self.stages.setdefault(stage, dict.fromkeys(FIELDS, 0))
+            totals['seconds'] += seconds
+            totals['calls'] += calls
+            totals['rows'] += rows
+            totals['bytes'] += bytes
+            totals['queries'] += queries
+
+    @contextmanager
+    def timer(self, stage, **kwargs):
+        """
+        Context manager recording time of its block as one call of stage.
+        :param kwargs: other values added to stage, e.g. rows
+        """
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(stage, seconds=time.perf_counter() - started, calls=1, **kwargs)
+
+    def timed_iter(self, stage, iterable):
+        """
+        Returns generator of items of iterable, time spent producing them is recorded as stage
+        and every item is counted as row. Totals are added once, when generator is done.
+        """
+        seconds, rows = 0, 0
+        iterator = iter(iterable)
+        try:
+            while True:
+                started = time.perf_counter()
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+                finally:
+                    seconds += time.perf_counter() - started
+                rows += 1
+                yield item
+        finally:
+            self.add(stage, seconds=seconds, calls=1, rows=rows)
+
+    def snapshot(self):
+        """
+        Returns copy of totals.
+        :return: dict {stage: dict of values}
+        """
+        with self.lock:
+            return {stage: dict(totals) for stage, totals in self.stages.items()}
+
+    def reset(self):
+        with self.lock:
+            self.stages = {}
+
+    def export(self, logger, textfile=None, **labels):
+        """
+        Log one structured record per stage and write Prometheus textfile.
+        :param logger: logging.Logger, see JsonFormatter
+        :param textfile: path to .prom file, skipped if None
+        :param labels: labels of all metrics in textfile, e.g. job='basic-stats'
+        """
+        for stage, totals in sorted(self.snapshot().items()):
+            logger.info("Stage {}: {:.3f} s, {} calls, {} rows, {} bytes, {} queries".format(
+                stage, totals['seconds'], totals['calls'], totals['rows'], totals['bytes'], totals['queries']),
+                extra={'fields': dict(totals, stage=stage, **labels)})
+
+        if textfile:
+            write_textfile(textfile, self.snapshot(), labels)
+
+
+# process-wide metrics, used by core modules
+metrics = Metrics()
+
+
+def _labels(labels):
+    escaped = ('{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+               for name, value in sorted(labels.items()))
+    return '{' + ','.join(escaped) + '}'
+
+
+def write_textfile(path, stages, labels=None):
+    """
+    Write stages in Prometheus text format. File is replaced atomically,
+    so collector never reads half-written file.
+    :param path: path to .prom file
+    :param stages: dict {stage: dict of values}, e.g. from Metrics.snapshot
+    :param labels: dict of labels added to all metrics
+    """
+    labels = labels or {}
+    lines = []
+    for field in FIELDS:
+        name = 'dbm_stage_{}'.format(field)
+        lines.append('# HELP {} {}'.format(name, METRIC_HELP[field]))
+        lines.append('# TYPE {} gauge'.format(name))
+        for stage, totals in sorted(stages.items()):
+            lines.append('{}{} {}'.format(name, _labels(dict(labels, stage=stage)), totals[field]))
+
+    lines.append('# HELP dbm_last_run_timestamp_seconds When metrics were written')
+    lines.append('# TYPE dbm_last_run_timestamp_seconds gauge')
+    lines.append('dbm_last_run_timestamp_seconds{} {}'.format(_labels(labels), time.time()))
+
+    # one temporary file per writer, runs of different jobs may share textfile directory
+    temporary = '{}.{}.{}.tmp'.format(path, os.getpid(), threading.get_ident())
+    with open(temporary, 'w') as file:
+        file.write('\n'.join(lines) + '\n')
+    os.replace(temporary, path)
+
+
+def instrument_engine(engine, stage='sql', registry=None):
+    """
+    Record time and number of every statement executed by engine.
+    :param engine: sqlalchemy Engine
+    :param stage: stage name
+    :param registry: Metrics, defaults to process-wide metrics
+    """
+    from sqlalchemy import event
+
+    registry = registry or metrics
+
+    @event.listens_for(engine, 'before_cursor_execute')
+    def before_cursor_execute(connection, cursor, statement, parameters, context, executemany):
+        connection.info.setdefault('query_started', []).append(time.perf_counter())
+
+    @event.listens_for(engine, 'after_cursor_execute')
+    def after_cursor_execute(connection, cursor, statement, parameters, context, executemany):
+        started = connection.info['query_started'].pop()
+        registry.add(stage, seconds=time.perf_counter() - started, calls=1, queries=1)
+
+    return engine
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    Formats log records as one JSON object per line. Fields passed as `extra={'fields': {...}}`
+    are added to the object, e.g. stage metrics from Metrics.export.
+    """
+
+    def format(self, record):
+        data = {'time': self.formatTime(record), 'level': record.levelname, 'logger': record.name,
+                'message': record.getMessage()}
+        data.update(getattr(record, 'fields', {}))
+        if record.exc_info:
+            data['exception'] = self.formatException(record.exc_info)
+        return json.dumps(data, default=str)
+
+
+def configure_logging(format='text', level=logging.INFO):
+    """
+    Configure root logger of scripts.
+    :param format: 'text' or 'json' (one JSON object per line, for log collectors)
+    :param level: logging level
+    """
+    if format not in ('text', 'json'):
+        raise ValueError("{} is not a valid log format, use text or json".format(format))
+
+    handler = logging.StreamHandler()
+    if format == 'json':
+        handler.setFormatter(JsonFormatter())
+    else:
+        handler.setFormatter(logging.Formatter(logging.BASIC_FORMAT))
+    logging.basicConfig(level=level, handlers=[handler])
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, String, Date, Integer, Numeric, ForeignKey, UniqueConstraint
+from sqlalchemy import Column, String, Date, DateTime, Integer, Numeric, ForeignKey, Index, UniqueConstraint
 from sqlalchemy.ext.declarative import declarative_base
 
 Base = declarative_base()
@@ -21,7 +21,10 @@ class MetaNames(Base):
     line_item_name = Column(String(1000))
     line_item_id = Column(Integer)
 
-    __table_args__ = (UniqueConstraint('line_item_id'), )
+    # advertiser and order indexes serve rollup refreshes, see core.rollups
+    __table_args__ = (UniqueConstraint('line_item_id'),
+                      Index('index_meta_advertiser', 'advertiser_id'),
+                      Index('index_meta_order', 'order_id'))
 
 
 class BasicStats(Base):
@@ -45,7 +48,9 @@ class BasicStats(Base):
     total_cost = Column(Numeric(12, 6))
     media_cost = Column(Numeric(12, 6))
 
-    __table_args__ = (UniqueConstraint('date', 'line_item_id', name='unique_li_per_date'), )
+    # unique constraint serves loads of a day, line item index serves its history and joins with MetaNames
+    __table_args__ = (UniqueConstraint('date', 'line_item_id', name='unique_li_per_date'),
+                      Index('index_li_history', 'line_item_id', 'date'))
 
 
 class ConversionPixels(Base):
@@ -60,7 +65,9 @@ class ConversionPixels(Base):
     post_click_revenue = Column(Numeric(12, 6))
     post_view_revenue = Column(Numeric(12, 6))
 
-    __table_args__ = (UniqueConstraint('date', 'line_item_id', 'conversion_id', name='unique_conversion_per_day'), )
+    __table_args__ = (UniqueConstraint('date', 'line_item_id', 'conversion_id', name='unique_conversion_per_day'),
+                      Index('index_conversion_li_history', 'line_item_id', 'date'),
+                      Index('index_conversion_history', 'conversion_id', 'date'))
 
 
 class ConversionPixelsMetaNames(Base):
@@ -69,3 +76,83 @@ class ConversionPixelsMetaNames(Base):
     id = Column(Integer, primary_key=True)
     conversion_id = Column(Integer, unique=True)
     conversion_name = Column(String(250))
+
+
+class AdvertiserDailyStats(Base):
+    """
+    Rollup of BasicStats per advertiser and day, maintained by core.rollups
+    """
+    __tablename__ = 'dbm_rollup_advertiser_daily'
+
+    id = Column(Integer, primary_key=True)
+    date = Column(Date)
+    advertiser_id = Column(Integer)
+
+    impressions = Column(Integer)
+    viewable_impressions = Column(Integer)
+    clicks = Column(Integer)
+    total_conversions = Column(Integer)
+    post_click_conversions = Column(Integer)
+    total_cost = Column(Numeric(14, 6))
+    media_cost = Column(Numeric(14, 6))
+
+    __table_args__ = (UniqueConstraint('date', 'advertiser_id', name='unique_advertiser_per_date'), )
+
+
+class InsertionOrderMonthlyStats(Base):
+    """
+    Rollup of BasicStats per insertion order and month, maintained by core.rollups
+    """
+    __tablename__ = 'dbm_rollup_order_monthly'
+
+    id = Column(Integer, primary_key=True)
+    # first day of month
+    month = Column(Date)
+    advertiser_id = Column(Integer)
+    order_id = Column(Integer)
+
+    impressions = Column(Integer)
+    viewable_impressions = Column(Integer)
+    clicks = Column(Integer)
+    total_conversions = Column(Integer)
+    post_click_conversions = Column(Integer)
+    total_cost = Column(Numeric(14, 6))
+    media_cost = Column(Numeric(14, 6))
+
+    __table_args__ = (UniqueConstraint('month', 'order_id', name='unique_order_per_month'), )
+
+
+class AdvertiserDailyConversions(Base):
+    """
+    Rollup of ConversionPixels per advertiser, conversion and day, maintained by core.rollups
+    """
+    __tablename__ = 'dbm_rollup_advertiser_conversions_daily'
+
+    id = Column(Integer, primary_key=True)
+    date = Column(Date)
+    advertiser_id = Column(Integer)
+    conversion_id = Column(Integer)
+
+    total_conversions = Column(Integer)
+    post_click_conversions = Column(Integer)
+    post_click_revenue = Column(Numeric(14, 6))
+    post_view_revenue = Column(Numeric(14, 6))
+
+    __table_args__ = (UniqueConstraint('date', 'advertiser_id', 'conversion_id',
+                                       name='unique_advertiser_conversion_per_date'), )
+
+
+class BackfillCheckpoint(Base):
+    """
+    Date range shards of historical backfills which are already loaded
+    """
+    __tablename__ = 'dbm_backfill_checkpoints'
+
+    id = Column(Integer, primary_key=True)
+    query_id = Column(String(50))
+    start_date = Column(Date)
+    end_date = Column(Date)
+    rows = Column(Integer)
+    completed_at = Column(DateTime)
+
+    __table_args__ = (UniqueConstraint('query_id', 'start_date', 'end_date', name='unique_backfill_shard'), )
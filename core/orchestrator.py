@@ -0,0 +1,122 @@
+import logging
+import time
+from collections import namedtuple
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from core.loader import BulkLoader, DEFAULT_BATCH_SIZE
+from core.mappers import DIMENSIONS
+from core.metrics import metrics
+from core.pipeline import load_report, report_batches, report_rows
+from core.rollups import ROLLUPS
+from core.sinks import open_sinks
+from core.util import Backoff
+
+logger = logging.getLogger(__name__)
+
+# query_id: QueryID in DBM, mapper: row mapper from core.mappers, it also decides target tables
+Job = namedtuple('Job', ['query_id', 'mapper'])
+
+
+class Orchestrator():
+    """
+    Runs many DBM queries at once. All queries are started up front, polled together
+    and every finished report is downloaded and loaded in a worker thread,
+    so the whole run takes as long as the slowest query.
+    """
+
+    def __init__(self, dbm, engine, jobs, workers=4, timeout=3600, backoff=Backoff, batch_size=DEFAULT_BATCH_SIZE,
+                 sinks=(), columnar=False):
+        self.dbm = dbm
+        self.engine = engine
+        self.jobs = list(jobs)
+        self.workers = workers
+        self.timeout = timeout
+        # factory of core.util.Backoff, every query is polled on its own schedule
+        self.backoff = backoff
+        self.loader = BulkLoader(engine, batch_size=batch_size)
+        # outputs written alongside database, e.g. core.sinks.ParquetSink
+        self.sinks = sinks
+        # parse reports into column batches with mappings of job mappers, see core.pipeline.report_batches
+        self.columnar = columnar
+
+    def run(self, daterange, start_date=None, end_date=None, timezone='America/New_York'):
+        """
+        Run all queries, wait for their reports and load them.
+        Arguments are passed to DBMQuery.run_query.
+        :return: dict {query_id: {table name: number of rows written}}
+        """
+        for job in self.jobs:
+            logger.info("Running query {}...".format(job.query_id))
+            self.dbm.run_query(job.query_id, daterange, start_date=start_date, end_date=end_date, timezone=timezone)
+
+        futures = {}
+        deadline = time.time() + self.timeout
+        # first check after query's usual run time, see DBMQuery.wait_for_report
+        pending = {job: (min(time.time() + 0.8 * self.dbm.expected_duration(job.query_id), deadline), self.backoff())
+                   for job in self.jobs}
+
+        # API client is not thread safe, so it is used only from this thread,
+        # workers get ready URL to report file
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            while pending:
+                job = min(pending, key=lambda x: pending[x][0])
+                next_check, backoff = pending[job]
+                with metrics.timer('poll'):
+                    time.sleep(max(next_check - time.time(), 0))
+
+                metadata = self.dbm.fresh_report(job.query_id)
+                if metadata:
+                    logger.info("Query {} is ready, loading report...".format(job.query_id))
+                    futures[job.query_id] = pool.submit(self.load, job, metadata)
+                    del pending[job]
+                elif time.time() >= deadline:
+                    logger.error("Query {} did not finish in {} seconds".format(job.query_id, self.timeout))
+                    futures[job.query_id] = _failed(TimeoutError("Query ID {} timed out".format(job.query_id)))
+                    del pending[job]
+                else:
+                    pending[job] = (min(time.time() + backoff.next(), deadline), backoff)
+
+        return self._results(futures)
+
+    def load(self, job, metadata):
+        """
+        Download report and load it to database in single transaction.
+        If DBMQuery has report cache, report is downloaded there first.
+        :param job: Job
+        :param metadata: query metadata from DBMQuery.fresh_report
+        :return: dict {table name: number of rows written}
+        """
+        if self.columnar:
+            mapping = job.mapper.mapping
+            rows, transform = report_batches(self.dbm, job.query_id, metadata, mapping), mapping.batch_transform()
+        else:
+            rows, transform = report_rows(self.dbm, job.query_id, metadata, job.mapper.footer), None
+
+        with open_sinks(self.sinks, job.query_id) as writers, self.engine.begin() as connection:
+            counts = load_report(self.loader, connection, rows, job.mapper, DIMENSIONS, rollups=ROLLUPS,
+                                 writers=writers, transform=transform)
+
+        logger.info("Loaded query {}: {}".format(job.query_id, counts))
+        return counts
+
+    @staticmethod
+    def _results(futures):
+        results, failed = {}, []
+
+        for query_id, future in futures.items():
+            try:
+                results[query_id] = future.result()
+            except Exception:
+                logger.exception("Loading query {} failed".format(query_id))
+                failed.append(query_id)
+
+        if failed:
+            raise RuntimeError("Loading queries {} failed".format(", ".join(str(x) for x in failed)))
+
+        return results
+
+
+def _failed(exception):
+    future = Future()
+    future.set_exception(exception)
+    return future
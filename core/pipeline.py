@@ -0,0 +1,204 @@
+import logging
+import time
+
+from core.changes import ChangeDetector
+from core.columnar import parse_columns
+from core.dimensions import DimensionCache
+from core.loader import unique_columns
+from core.metrics import metrics
+from core.reconcile import StagedMerge
+from core.models import MetaNames
+from core.rollups import line_item_sources, refresh_rollups
+from core.util import iter_report_rows, report_chunks, stream_report
+
+logger = logging.getLogger(__name__)
+
+
+def report_rows(dbm, query_id, metadata, footer_column='Date'):
+    """
+    Returns rows of ready report, read through DBMQuery's report cache if it has one.
+    Does not call DBM API, so it can be used from worker threads.
+    :param dbm: DBMQuery
+    :param query_id: QueryID in DBM
+    :param metadata: query metadata from DBMQuery.fresh_report
+    :param footer_column: column which is empty in summary rows, e.g. `footer` of row mapper
+    :return: generator of OrderedDict rows
+    """
+    url = metadata['googleCloudStoragePathForLatestReport']
+    cache = getattr(dbm, 'cache', None)
+
+    if cache is None:
+        return stream_report(url, footer_column=footer_column)
+
+    path = cache.fetch(query_id, metadata['latestReportRunTimeMs'], url)
+    return iter_report_rows(cache.read(path), footer_column=footer_column)
+
+
+def report_batches(dbm, query_id, metadata, mapping):
+    """
+    Returns ready report as column batches for load_report's `transform`, see report_rows.
+    :param dbm: DBMQuery
+    :param query_id: QueryID in DBM
+    :param metadata: query metadata from DBMQuery.fresh_report
+    :param mapping: core.mapping.Mapping of report
+    :return: generator of core.columnar.ColumnBatch
+    """
+    url = metadata['googleCloudStoragePathForLatestReport']
+    cache = getattr(dbm, 'cache', None)
+
+    if cache is None:
+        chunks = report_chunks(url)
+    else:
+        chunks = cache.read(cache.fetch(query_id, metadata['latestReportRunTimeMs'], url))
+    return parse_columns(chunks, mapping.column_types(), footer_column=mapping.footer, skip=mapping.skip)
+
+
+def load_report(loader, connection, rows, mapper, dimensions=(), skip_unchanged=True, rollups=(), writers=(),
+                window=None, transform=None):
+    """
+    Map report rows to tables and upsert them.
+    Rows of fact tables are written in batches while report is still being read,
+    rows already stored with the same values are skipped (see core.changes.ChangeDetector).
+    Rows of dimension tables are collected and only new or changed ones are written at the end.
+    Afterwards rollups are recomputed for dates and line items of written rows only.
+    Time spent reading rows, mapping them and writing batches is recorded in core.metrics.
+    :param loader: core.loader.BulkLoader
+    :param connection: open connection, whole report is loaded in its transaction
+    :param rows: iterable of report rows, e.g. from DBMQuery.stream_query
+    :param mapper: callable(row) -> {model: values}, see core.mappers
+    :param dimensions: models handled with core.dimensions.DimensionCache
+    :param skip_unchanged: if False, all rows of fact tables are written
+    :param rollups: core.rollups.Rollup definitions refreshed in the same transaction, e.g. ROLLUPS
+    :param writers: other outputs of all fact rows from core.sinks.open_sinks, written while report is read.
+                    They are completed by open_sinks after the transaction is committed.
+    :param window: (first day, last day) of report which replaces stored rows of these days, e.g. from
+                   core.reconcile.window_dates. Fact rows are merged in SQL (see core.reconcile.StagedMerge)
+                   and stored rows of window missing in report are deleted.
+    :param transform: callable(ColumnBatch) -> {model: ColumnBatch} from core.mapping.Mapping.batch_transform.
+                      If set, `rows` are column batches (see report_batches), `mapper` is not used and
+                      fact rows are upserted as columns without being compared with stored rows.
+    :return: dict {table name: number of rows written}
+    """
+    if transform is not None and window:
+        raise ValueError("Window of dates is merged row by row, it can't be loaded with column transform")
+    return _load_report(loader, connection, rows, mapper, dimensions, skip_unchanged, rollups, writers, window,
+                        transform)
+
+
+def _load_columns(loader, connection, batches, transform, dimensions, rollups, writers, counts, touched):
+    # fact tables are upserted batch by batch, rows of dimension tables are yielded for load_report
+    started = time.perf_counter()
+    for batch in batches:
+        metrics.add('parse', seconds=time.perf_counter() - started, rows=len(batch))
+        with metrics.timer('clean'):
+            tables = transform(batch)
+        for model, columns in tables.items():
+            if model in dimensions:
+                for values in columns.rows():
+                    yield {model: values}
+                continue
+            for writer in writers:
+                for values in columns.rows():
+                    writer.write(model, values)
+            with metrics.timer('upsert', rows=len(columns)):
+                counts[model.__tablename__] = counts.get(model.__tablename__, 0) + \
+                    loader.upsert_columns(model, columns, connection)
+            if rollups:
+                dates, line_item_ids = touched.setdefault(model, (set(), set()))
+                dates.update(columns.to_pylist('date'))
+                line_item_ids.update(columns.to_pylist('line_item_id'))
+        started = time.perf_counter()
+    metrics.add('parse', seconds=time.perf_counter() - started, calls=1)
+
+
+def _mapped(row):
+    return row
+
+
+def _load_report(loader, connection, rows, mapper, dimensions, skip_unchanged, rollups, writers, window, transform):
+    batches = {}
+    detectors = {}
+    merges = {}
+    dimension_rows = {}
+    dimension_keys = {model: unique_columns(model.__table__)[0] for model in dimensions}
+    counts = {}
+    # model -> (dates, line item IDs) of written rows
+    touched = {}
+
+    if transform is None:
+        rows = metrics.timed_iter('parse', rows)
+    else:
+        rows, mapper = _load_columns(loader, connection, rows, transform, dimensions, rollups, writers, counts,
+                                     touched), _mapped
+
+    def flush(model):
+        with metrics.timer('upsert', rows=len(batches[model])):
+            counts[model.__tablename__] = counts.get(model.__tablename__, 0) + \
+                loader.upsert(model, batches[model], connection)
+        batches[model] = []
+
+    clean_seconds = 0
+    for row in rows:
+        started = time.perf_counter()
+        mapped = mapper(row)
+        clean_seconds += time.perf_counter() - started
+
+        for model, values in mapped.items():
+            if model in dimension_keys:
+                dimension_rows.setdefault(model, {})[values[dimension_keys[model]]] = values
+            else:
+                # sinks get all rows of report, they replace whole days
+                for writer in writers:
+                    writer.write(model, values)
+                if window:
+                    if model not in merges:
+                        merges[model] = StagedMerge(model, connection, *window, batch_size=loader.batch_size)
+                    merges[model].add(values)
+                    continue
+                if skip_unchanged:
+                    if model not in detectors:
+                        detectors[model] = ChangeDetector(model, connection)
+                        counts.setdefault(model.__tablename__, 0)
+                    if not detectors[model].is_changed(values):
+                        continue
+                batches.setdefault(model, []).append(values)
+                if rollups:
+                    dates, line_item_ids = touched.setdefault(model, (set(), set()))
+                    dates.add(values['date'])
+                    line_item_ids.add(values['line_item_id'])
+                if len(batches[model]) >= loader.batch_size:
+                    flush(model)
+
+    for model in batches:
+        flush(model)
+    metrics.add('clean', seconds=clean_seconds, calls=1)
+
+    for model, detector in detectors.items():
+        logger.info("{}: skipped {} unchanged rows".format(model.__tablename__, detector.skipped))
+
+    for model, merge in merges.items():
+        with metrics.timer('merge', rows=merge.staged):
+            counts[model.__tablename__] = merge.merge()
+        logger.info("{}: {} rows in report, {} inserted, {} updated, {} deleted".format(
+            model.__tablename__, merge.staged, merge.inserted, merge.updated, merge.deleted))
+        touched[model] = (merge.dates, merge.line_item_ids)
+
+    line_item_ids = set()
+    for model, values in dimension_rows.items():
+        new, changed = DimensionCache(model).load(connection).update(values.values())
+        with metrics.timer('upsert', rows=len(new) + len(changed)):
+            counts[model.__tablename__] = loader.upsert(model, new + changed, connection)
+        if model is MetaNames:
+            line_item_ids.update(row['line_item_id'] for row in new + changed)
+
+    # after dimensions, so rollups see line items of this report
+    if rollups:
+        with metrics.timer('rollups'):
+            # rows of other reports loaded before their line items were known, e.g. conversions
+            for model, (dates, ids) in line_item_sources(connection, line_item_ids, rollups).items():
+                touched_dates, touched_ids = touched.setdefault(model, (set(), set()))
+                touched_dates.update(dates)
+                touched_ids.update(ids)
+            refresh_rollups(connection, touched, rollups)
+
+    return counts
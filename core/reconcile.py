@@ -0,0 +1,167 @@
+"""
+Reconciliation of restated metrics. DBM restates conversions for several days after the fact,
+so a trailing window of days is reported again by one CUSTOM_DATES query and merged into stored rows.
+Report rows are staged in a temporary table and compared with stored rows in SQL,
+so only new, changed and vanished rows are written, with one set-based statement each.
+"""
+from datetime import date, timedelta
+
+from sqlalchemy import Column, MetaData, Table, UniqueConstraint, and_, exists, or_, select
+
+from core.loader import DEFAULT_BATCH_SIZE, chunked, unique_columns
+
+# days reported again by reconciliation
+DEFAULT_WINDOW_DAYS = 7
+
+# line items per statement looking for vanished rows
+LINE_ITEM_BATCH_SIZE = 500
+
+
+def window_dates(days=DEFAULT_WINDOW_DAYS, end=None):
+    """
+    Returns first and last day of trailing window.
+    :param days: number of days in window
+    :param end: last day, defaults to yesterday
+    :return: (first day, last day) tuple of datetime.date
+    """
+    if days < 1:
+        raise ValueError("Window must have at least one day, not {}".format(days))
+
+    end = end or date.today() - timedelta(days=1)
+    return end - timedelta(days=days - 1), end
+
+
+def _not_equal(staged, stored):
+    # NULL-safe inequality, NULL != NULL is not true in SQL
+    return or_(staged != stored, and_(staged.is_(None), stored.isnot(None)), and_(staged.isnot(None), stored.is_(None)))
+
+
+class StagedMerge():
+    """
+    Merges report rows of one fact table (BasicStats, ConversionPixels) for a window of dates.
+    Rows are staged in temporary table of the same columns, then stored rows are
+    updated where metrics differ, missing rows are inserted and rows of window dates
+    which are not in report any more are deleted. Only line items of the report are deleted from,
+    rows loaded by other queries into the same table (e.g. of other advertisers) are kept.
+    """
+
+    def __init__(self, model, connection, start, end, batch_size=DEFAULT_BATCH_SIZE, delete_missing=True):
+        """
+        :param model: fact table from core.models, its key must include `date`
+        :param connection: open connection, merge runs in its transaction
+        :param start: first day of window, datetime.date
+        :param end: last day of window (inclusive), datetime.date
+        :param batch_size: rows per INSERT into staging table
+        :param delete_missing: delete stored rows of window and report's line items which are not in report
+        """
+        self.model = model
+        self.table = model.__table__
+        self.connection = connection
+        self.start = start
+        self.end = end
+        self.batch_size = batch_size
+        self.delete_missing = delete_missing
+        self.keys = unique_columns(self.table)
+        if 'date' not in self.keys:
+            raise ValueError("{} has no date in its key, it can't be merged by dates".format(self.table.name))
+        self.metrics = [column.name for column in self.table.columns
+                        if not column.primary_key and column.name not in self.keys]
+
+        # temporary table is private to connection, so concurrent merges don't see each other's rows
+        columns = [Column(column.name, column.type) for column in self.table.columns if not column.primary_key]
+        self.staging = Table('{}_staging'.format(self.table.name), MetaData(), *columns,
+                             UniqueConstraint(*self.keys), prefixes=['TEMPORARY'])
+        self.staging.create(connection)
+
+        self.buffer = []
+        self.staged = 0
+        # line items in report, set in merge
+        self.staged_line_item_ids = []
+        self.inserted, self.updated, self.deleted = 0, 0, 0
+        # dates and line items of written rows, e.g. for core.rollups
+        self.dates, self.line_item_ids = set(), set()
+
+    def add(self, values):
+        """
+        Stage one report row.
+        :param values: dict of column values, e.g. from mapper
+        """
+        self.buffer.append(values)
+        if len(self.buffer) >= self.batch_size:
+            self._flush()
+
+    def merge(self):
+        """
+        Apply differences between staged and stored rows, then drop staging table.
+        :return: number of rows written (inserted, updated and deleted)
+        """
+        self._flush()
+        try:
+            self.staged_line_item_ids = [row[0] for row in self.connection.execute(
+                select([self.staging.c.line_item_id]).distinct())]
+            self._collect_changes()
+            self.updated = self._update()
+            self.inserted = self._insert()
+            # empty report is rather a failed query than a window without data
+            if self.delete_missing and self.staged:
+                self.deleted = self._delete()
+        finally:
+            self.staging.drop(self.connection)
+        return self.inserted + self.updated + self.deleted
+
+    def _flush(self):
+        for batch in chunked(self.buffer, self.batch_size):
+            # one executemany, staging table has no conflicts to resolve
+            self.connection.execute(self.staging.insert(), batch)
+            self.staged += len(batch)
+        self.buffer = []
+
+    def _match(self):
+        return and_(*[self.staging.c[key] == self.table.c[key] for key in self.keys])
+
+    def _differs(self):
+        return or_(*[_not_equal(self.staging.c[name], self.table.c[name]) for name in self.metrics])
+
+    def _vanished(self, line_item_ids):
+        # IN list instead of subquery, MySQL can't read temporary table twice in one statement
+        return and_(self.table.c.date.between(self.start, self.end),
+                    self.table.c.line_item_id.in_(line_item_ids),
+                    ~exists().where(self._match()))
+
+    def _collect_changes(self):
+        staged, stored = self.staging.c, self.table.c
+        changed = select([staged.date, staged.line_item_id]).select_from(
+            self.staging.outerjoin(self.table, self._match())).where(
+            or_(stored.id.is_(None), self._differs()) if self.metrics else stored.id.is_(None)).distinct()
+        queries = [changed]
+        if self.delete_missing and self.staged:
+            queries.extend(select([stored.date, stored.line_item_id]).where(self._vanished(batch)).distinct()
+                           for batch in chunked(self.staged_line_item_ids, LINE_ITEM_BATCH_SIZE))
+
+        for query in queries:
+            for day, line_item_id in self.connection.execute(query):
+                self.dates.add(day)
+                self.line_item_ids.add(line_item_id)
+
+    def _update(self):
+        if not self.metrics:
+            return 0
+
+        dialect = self.connection.dialect.name
+        if dialect in ('mysql', 'postgresql'):
+            # UPDATE ... JOIN / UPDATE ... FROM, MySQL can't read temporary table twice in one statement
+            statement = self.table.update().values({name: self.staging.c[name] for name in self.metrics}).where(
+                and_(self._match(), self._differs()))
+        else:
+            values = {name: select([self.staging.c[name]]).where(self._match()).as_scalar() for name in self.metrics}
+            statement = self.table.update().values(values).where(exists().where(and_(self._match(), self._differs())))
+        return self.connection.execute(statement).rowcount
+
+    def _insert(self):
+        names = self.keys + tuple(self.metrics)
+        query = select([self.staging.c[name] for name in names]).where(~exists().where(self._match()))
+        return self.connection.execute(self.table.insert().from_select(names, query)).rowcount
+
+    def _delete(self):
+        return sum(self.connection.execute(self.table.delete().where(self._vanished(batch))).rowcount
+                   for batch in chunked(self.staged_line_item_ids, LINE_ITEM_BATCH_SIZE))
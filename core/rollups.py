@@ -0,0 +1,178 @@
+"""
+Pre-aggregated rollup tables for dashboards. After each load only groups touched by written rows
+are recomputed from source table, so rollups stay exact even when DBM restates past days.
+"""
+from datetime import datetime, timedelta
+
+from sqlalchemy import and_, distinct, func, literal, select
+
+from core.loader import chunked
+from core.models import (MetaNames, BasicStats, ConversionPixels, AdvertiserDailyStats,
+                         InsertionOrderMonthlyStats, AdvertiserDailyConversions)
+
+# line items per query when looking up affected groups
+LOOKUP_BATCH_SIZE = 500
+
+
+def month_start(value):
+    return value.replace(day=1)
+
+
+def month_end(value):
+    return (month_start(value) + timedelta(days=32)).replace(day=1) - timedelta(days=1)
+
+
+class Rollup():
+    """
+    Rollup of fact table (BasicStats, ConversionPixels) joined with MetaNames on line_item_id.
+    """
+
+    def __init__(self, model, source, dimensions, key, metrics, period='day'):
+        """
+        :param model: rollup table from core.models
+        :param source: fact table from core.models
+        :param dimensions: dict {rollup column: column of source or MetaNames to group by}
+        :param key: rollup column taken from MetaNames which limits recomputed groups, e.g. advertiser_id
+        :param metrics: names of columns summed from source to rollup columns of the same name
+        :param period: 'day' (rollup column `date`) or 'month' (rollup column `month`, first day of month)
+        """
+        if period not in ('day', 'month'):
+            raise ValueError("{} is not a valid rollup period, use day or month".format(period))
+
+        self.model = model
+        self.table = model.__table__
+        self.source_model = source
+        self.source = source.__table__
+        self.dimensions = dimensions
+        self.key = key
+        self.metrics = metrics
+        self.period = period
+        self.period_column = self.table.c.date if period == 'day' else self.table.c.month
+
+    @property
+    def name(self):
+        return self.table.name
+
+    def periods(self, dates):
+        """
+        Returns rollup periods covering dates.
+        :param dates: iterable of datetime.date
+        :return: set of datetime.date (days or first days of months)
+        """
+        dates = {value.date() if isinstance(value, datetime) else value for value in dates}
+        return dates if self.period == 'day' else {month_start(value) for value in dates}
+
+    def refresh(self, connection, dates, line_item_ids):
+        """
+        Recompute groups affected by source rows of given dates and line items.
+        :param connection: open connection, preferably in the same transaction as the load
+        :param dates: dates of written source rows
+        :param line_item_ids: line items of written source rows
+        """
+        meta = MetaNames.__table__
+        key_column = self.dimensions[self.key]
+        keys = set()
+        for batch in chunked(line_item_ids, LOOKUP_BATCH_SIZE):
+            query = select([distinct(key_column)]).where(meta.c.line_item_id.in_(batch))
+            keys.update(row[0] for row in connection.execute(query))
+
+        if keys:
+            self._recompute(connection, self.periods(dates), keys)
+
+    def refresh_dates(self, connection, dates):
+        """
+        Recompute all groups of periods covering dates, e.g. after backfill of date range.
+        :param connection: open connection
+        :param dates: dates of written source rows
+        """
+        self._recompute(connection, self.periods(dates), None)
+
+    def rebuild(self, connection):
+        """
+        Recompute whole rollup from source table.
+        :param connection: open connection
+        """
+        connection.execute(self.table.delete())
+        dates = [row[0] for row in connection.execute(select([distinct(self.source.c.date)]))]
+        self._recompute(connection, self.periods(dates), None)
+
+    def _recompute(self, connection, periods, keys):
+        key_column = self.dimensions[self.key]
+        columns = list(self.dimensions) + self.metrics
+
+        for period in sorted(periods):
+            delete = self.table.delete().where(self.period_column == period)
+            if keys is not None:
+                delete = delete.where(self.table.c[self.key].in_(keys))
+            connection.execute(delete)
+
+            if self.period == 'day':
+                where = [self.source.c.date == period]
+            else:
+                where = [self.source.c.date >= period, self.source.c.date <= month_end(period)]
+            if keys is not None:
+                where.append(key_column.in_(keys))
+
+            dimensions = list(self.dimensions.values())
+            query = select([literal(period, self.period_column.type)] + dimensions +
+                           [func.sum(self.source.c[metric]) for metric in self.metrics]) \
+                .select_from(self.source.join(MetaNames.__table__,
+                                              self.source.c.line_item_id == MetaNames.__table__.c.line_item_id)) \
+                .where(and_(*where)) \
+                .group_by(*dimensions)
+
+            connection.execute(self.table.insert().from_select([self.period_column.name] + columns, query))
+
+
+BASIC_METRICS = ['impressions', 'viewable_impressions', 'clicks', 'total_conversions', 'post_click_conversions',
+                 'total_cost', 'media_cost']
+CONVERSION_METRICS = ['total_conversions', 'post_click_conversions', 'post_click_revenue', 'post_view_revenue']
+
+ROLLUPS = (
+    Rollup(AdvertiserDailyStats, BasicStats,
+           {'advertiser_id': MetaNames.__table__.c.advertiser_id},
+           key='advertiser_id', metrics=BASIC_METRICS, period='day'),
+    Rollup(InsertionOrderMonthlyStats, BasicStats,
+           {'advertiser_id': MetaNames.__table__.c.advertiser_id, 'order_id': MetaNames.__table__.c.order_id},
+           key='order_id', metrics=BASIC_METRICS, period='month'),
+    Rollup(AdvertiserDailyConversions, ConversionPixels,
+           {'advertiser_id': MetaNames.__table__.c.advertiser_id,
+            'conversion_id': ConversionPixels.__table__.c.conversion_id},
+           key='advertiser_id', metrics=CONVERSION_METRICS, period='day'),
+)
+
+
+def line_item_sources(connection, line_item_ids, rollups=ROLLUPS):
+    """
+    Returns stored source rows of line items, e.g. new in MetaNames. Rollups join MetaNames,
+    so rows loaded before their line item (e.g. conversions before basic stats) are missing in rollups
+    until they are refreshed for these line items.
+    :param connection: open connection
+    :param line_item_ids: line item IDs
+    :param rollups: Rollup definitions
+    :return: dict {source model: (set of dates, set of line item IDs)}, see refresh_rollups
+    """
+    touched = {}
+    line_item_ids = set(line_item_ids)
+    for rollup in rollups:
+        if rollup.source_model in touched or not line_item_ids:
+            continue
+        dates = set()
+        for batch in chunked(line_item_ids, LOOKUP_BATCH_SIZE):
+            query = select([distinct(rollup.source.c.date)]).where(rollup.source.c.line_item_id.in_(batch))
+            dates.update(row[0] for row in connection.execute(query))
+        touched[rollup.source_model] = (dates, line_item_ids)
+    return touched
+
+
+def refresh_rollups(connection, touched, rollups=ROLLUPS):
+    """
+    Refresh rollups of source tables written by a load.
+    :param connection: open connection
+    :param touched: dict {source model: (set of dates, set of line item IDs)}, see core.pipeline.load_report
+    :param rollups: Rollup definitions
+    """
+    for rollup in rollups:
+        for model, (dates, line_item_ids) in touched.items():
+            if model.__table__ is rollup.source and dates:
+                rollup.refresh(connection, dates, line_item_ids)
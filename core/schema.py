@@ -0,0 +1,121 @@
+"""
+Schema maintenance of existing databases: indexes added to models after tables were created
+and MySQL RANGE partitioning of stats tables by month.
+"""
+from datetime import date
+
+from sqlalchemy import func, inspect, select, text
+
+from core.models import BasicStats, ConversionPixels
+
+# tables partitioned by month of `date`
+PARTITIONED_TABLES = (BasicStats, ConversionPixels)
+
+# partition for rows after the last month, split when new months are added
+MAX_PARTITION = 'pmax'
+
+
+def missing_indexes(connection, tables):
+    """
+    Returns indexes declared in models which do not exist in database.
+    Base.metadata.create_all creates them only with new tables.
+    :param connection: open connection
+    :param tables: tables from core.models, e.g. Base.metadata.sorted_tables
+    :return: list of sqlalchemy.Index
+    """
+    inspector = inspect(connection)
+    missing = []
+    for table in tables:
+        existing = {index['name'] for index in inspector.get_indexes(table.name)}
+        missing.extend(index for index in table.indexes if index.name not in existing)
+    return missing
+
+
+def next_month(value):
+    return date(value.year + value.month // 12, value.month % 12 + 1, 1)
+
+
+def month_partitions(start, end):
+    """
+    Returns monthly partitions covering dates from start to end.
+    :param start: datetime.date
+    :param end: datetime.date
+    :return: list of (partition name, first day of next month)
+    """
+    partitions = []
+    month = date(start.year, start.month, 1)
+    while month <= end:
+        partitions.append(('p{:%Y%m}'.format(month), next_month(month)))
+        month = next_month(month)
+    return partitions
+
+
+def _partition_definitions(partitions):
+    definitions = ["PARTITION {} VALUES LESS THAN ('{}')".format(name, bound.isoformat())
+                   for name, bound in partitions]
+    definitions.append('PARTITION {} VALUES LESS THAN (MAXVALUE)'.format(MAX_PARTITION))
+    return ', '.join(definitions)
+
+
+def partition_table_sql(table, start, end):
+    """
+    Returns statements partitioning table by month.
+    MySQL requires partitioning column in every unique key, so `date` is added to primary key.
+    :param table: table name
+    :param start: first date in table
+    :param end: last date partitions are created for, later rows go to MAX_PARTITION
+    :return: list of SQL statements
+    """
+    return ['ALTER TABLE {} DROP PRIMARY KEY, ADD PRIMARY KEY (id, date)'.format(table),
+            'ALTER TABLE {} PARTITION BY RANGE COLUMNS(date) ({})'.format(
+                table, _partition_definitions(month_partitions(start, end)))]
+
+
+def add_partitions_sql(table, existing, end):
+    """
+    Returns statements splitting MAX_PARTITION into months up to end.
+    :param table: table name
+    :param existing: names of existing partitions
+    :param end: last date partitions are created for
+    :return: list of SQL statements, empty if partitions already exist
+    """
+    months = sorted(name for name in existing if name != MAX_PARTITION)
+    last = date(int(months[-1][1:5]), int(months[-1][5:7]), 1)
+    partitions = month_partitions(next_month(last), end)
+    if not partitions:
+        return []
+
+    return ['ALTER TABLE {} REORGANIZE PARTITION {} INTO ({})'.format(
+        table, MAX_PARTITION, _partition_definitions(partitions))]
+
+
+def existing_partitions(connection, table):
+    """
+    Returns names of table's partitions in MySQL.
+    :param connection: open connection
+    :param table: table name
+    :return: list of names, empty if table is not partitioned
+    """
+    query = text('SELECT PARTITION_NAME FROM information_schema.PARTITIONS '
+                 'WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = :table AND PARTITION_NAME IS NOT NULL')
+    return [row[0] for row in connection.execute(query, table=table)]
+
+
+def partition_sql(connection, model, end):
+    """
+    Returns statements which partition table of model, or add partitions to it, up to end.
+    :param connection: open connection to MySQL
+    :param model: one of PARTITIONED_TABLES
+    :param end: last date partitions are created for, e.g. a few months ahead
+    :return: list of SQL statements
+    """
+    if connection.dialect.name != 'mysql':
+        raise NotImplementedError("Partitioning is not supported for {}".format(connection.dialect.name))
+
+    table = model.__table__
+    existing = existing_partitions(connection, table.name)
+    if existing:
+        return add_partitions_sql(table.name, existing, end)
+
+    start = connection.execute(select([func.min(table.c.date)])).scalar() or end
+    return partition_table_sql(table.name, start, end)
@@ -0,0 +1,79 @@
+"""
+Setup shared by report scripts: logging, DBMQuery, database engine and sinks configured in .env
+(see .env-sample), and export of stage metrics when script is done.
+"""
+import logging
+import os
+
+from decouple import config
+from sqlalchemy import create_engine
+
+from core.cache import DEFAULT_MAX_SIZE, ReportCache
+from core.loader import DEFAULT_BATCH_SIZE
+from core.metrics import configure_logging, instrument_engine, metrics
+from core.models import Base
+from core.sinks import ParquetSink
+from core.util import DBMQuery
+
+logger = logging.getLogger(__name__)
+
+
+class Script():
+    """
+    Configuration of one script run, read from environment or .env file.
+    Relative paths in configuration are relative to script's directory.
+    Logging is configured when script starts, call finish() at the end of successful run.
+    """
+
+    def __init__(self, job, directory):
+        """
+        :param job: name of the script, label of its metrics, e.g. basic-stats
+        :param directory: directory of the script, e.g. os.path.dirname(os.path.abspath(__file__))
+        """
+        self.job = job
+        self.directory = directory
+        self.batch_size = config('BATCH_SIZE', default=DEFAULT_BATCH_SIZE, cast=int)
+        self.log_format = config('LOG_FORMAT', default='text')
+        configure_logging(self.log_format)
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    def dbm(self, **kwargs):
+        """
+        Returns DBMQuery with query history and report cache of this directory.
+        :param kwargs: other arguments of DBMQuery, e.g. api_rate
+        :return: DBMQuery
+        """
+        return DBMQuery(self.path(config('API_KEY_FILE')),
+                        history_file=self.path(config('QUERY_HISTORY_FILE', default='query-history.json')),
+                        cache=ReportCache(self.path(config('REPORT_CACHE_DIR', default='.report-cache')),
+                                          max_size=config('REPORT_CACHE_SIZE', default=DEFAULT_MAX_SIZE, cast=int)),
+                        **kwargs)
+
+    def engine(self):
+        """
+        Returns engine of DB_URI with every statement counted and timed in core.metrics.
+        Tables which don't exist yet are created.
+        :return: sqlalchemy.engine.Engine
+        """
+        engine = create_engine(config('DB_URI'), echo=config('SQL_ECHO', default=False, cast=bool))
+        logger.info("Connecting to DB: {!r}".format(engine.url))
+        instrument_engine(engine)
+        Base.metadata.create_all(engine)
+        return engine
+
+    def sinks(self):
+        """
+        Returns outputs written alongside database: Parquet files for analytics if PARQUET_DIR is set.
+        :return: list of sinks from core.sinks
+        """
+        parquet_dir = config('PARQUET_DIR', default='')
+        return [ParquetSink(self.path(parquet_dir))] if parquet_dir else []
+
+    def finish(self):
+        """
+        Log time, rows, bytes and DB round-trips of every stage of the run,
+        also as Prometheus textfile if METRICS_TEXTFILE is set.
+        """
+        metrics.export(logger, config('METRICS_TEXTFILE', default=None), job=self.job)
@@ -0,0 +1,187 @@
+"""
+Additional outputs of core.pipeline.load_report, written in the same pass over report as SQL load.
+"""
+import os
+from contextlib import contextmanager
+from datetime import datetime
+
+from sqlalchemy import Date, Integer, Numeric, String
+
+from core.mapping import to_int
+from core.metrics import metrics
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+# rows buffered per partition before they are written as one row group
+ROW_GROUP_SIZE = 64 * 1024
+
+
+def _to_int(value):
+    return value if value is None or isinstance(value, int) else to_int(value)
+
+
+def _to_float(value):
+    return None if value is None else float(value)
+
+
+@contextmanager
+def open_sinks(sinks, query_id=None):
+    """
+    Open writers of sinks for one load, e.g. for core.pipeline.load_report.
+    Database transaction of the load goes inside this block, so writers are completed
+    only after it was committed and dropped if the load or the commit fails.
+    :param sinks: e.g. [ParquetSink]
+    :param query_id: QueryID in DBM of loaded report, loads of other queries are kept
+    :return: list of writers
+    """
+    writers = [sink.open(query_id) for sink in sinks]
+    try:
+        yield writers
+    except BaseException:
+        for writer in writers:
+            writer.abort()
+        raise
+
+    for writer in writers:
+        with metrics.timer('sinks'):
+            metrics.add('sinks', rows=writer.close())
+
+
+class ParquetSink():
+    """
+    Writes rows of fact tables (models with `date` column) to Parquet files partitioned by table and date:
+    <directory>/<table name>/date=YYYY-MM-DD/query=<QueryID>.parquet, readable as Hive-partitioned dataset.
+    Every load replaces files of its query in partitions of dates in its report, so re-loading a day
+    is idempotent and queries writing the same table and day keep each other's rows.
+    Dimension tables are small and stay in SQL only.
+    """
+
+    def __init__(self, directory, row_group_size=ROW_GROUP_SIZE, compression='snappy'):
+        """
+        :param directory: root directory of dataset
+        :param row_group_size: rows per row group, at most that many rows per partition are kept in memory
+        :param compression: Parquet compression codec
+        """
+        if pyarrow is None:
+            raise ImportError("pyarrow is required for Parquet export, install it with: pip install pyarrow")
+
+        self.directory = directory
+        self.row_group_size = row_group_size
+        self.compression = compression
+
+    def open(self, query_id=None):
+        """
+        Returns writer for one load. Writers of concurrent loads are independent.
+        :param query_id: QueryID in DBM of loaded report, file name in partitions; data.parquet if None
+        :return: ParquetSinkWriter
+        """
+        return ParquetSinkWriter(self, query_id)
+
+
+class ParquetSinkWriter():
+    """
+    Streams rows of one load to Parquet in row groups. Files are written under temporary names
+    and replace files of the same query only when writer is closed.
+    """
+
+    def __init__(self, sink, query_id=None):
+        self.sink = sink
+        self.name = 'data.parquet' if query_id is None else 'query={}.parquet'.format(query_id)
+        if os.sep in self.name:
+            raise ValueError("{} is not a valid QueryID".format(query_id))
+        # (model, date) -> buffered rows
+        self.buffers = {}
+        # (model, date) -> (pyarrow.parquet.ParquetWriter, temporary path, path)
+        self.writers = {}
+        self.schemas = {}
+        self.rows = 0
+
+    def write(self, model, values):
+        """
+        Add row of model, models without `date` column are ignored.
+        :param model: model from core.models
+        :param values: dict of column values, e.g. from mapper
+        """
+        if 'date' not in values:
+            return
+
+        day = values['date']
+        key = (model, day.date() if isinstance(day, datetime) else day)
+        buffer = self.buffers.setdefault(key, [])
+        buffer.append(values)
+        if len(buffer) >= self.sink.row_group_size:
+            self._flush(key)
+
+    def close(self):
+        """
+        Write remaining rows and replace files of this query in partitions.
+        :return: number of rows written
+        """
+        for key in list(self.buffers):
+            self._flush(key)
+
+        for writer, temporary, path in self.writers.values():
+            writer.close()
+            os.replace(temporary, path)
+        self.writers = {}
+        return self.rows
+
+    def abort(self):
+        """
+        Drop written files, e.g. when SQL load failed. Existing files are left as they were.
+        """
+        for writer, temporary, path in self.writers.values():
+            writer.close()
+            os.remove(temporary)
+        self.writers, self.buffers = {}, {}
+
+    def _schema(self, model):
+        if model not in self.schemas:
+            fields, converters = [], []
+            for column in model.__table__.columns:
+                # id is database's own, date is in partition path
+                if column.primary_key or column.name == 'date':
+                    continue
+                if isinstance(column.type, Integer):
+                    type, converter = pyarrow.int64(), _to_int
+                elif isinstance(column.type, Numeric):
+                    type, converter = pyarrow.float64(), _to_float
+                elif isinstance(column.type, Date):
+                    type, converter = pyarrow.date32(), None
+                elif isinstance(column.type, String):
+                    type, converter = pyarrow.string(), None
+                else:
+                    raise ValueError("{}.{}: {} is not supported in Parquet export".format(
+                        model.__tablename__, column.name, column.type))
+                fields.append(pyarrow.field(column.name, type))
+                converters.append((column.name, converter))
+            self.schemas[model] = (pyarrow.schema(fields), converters)
+        return self.schemas[model]
+
+    def _flush(self, key):
+        rows = self.buffers.pop(key)
+        if not rows:
+            return
+
+        model, day = key
+        schema, converters = self._schema(model)
+        columns = [[row.get(name) for row in rows] if converter is None else
+                   [converter(row.get(name)) for row in rows] for name, converter in converters]
+        table = pyarrow.Table.from_arrays([pyarrow.array(values, type=field.type)
+                                           for values, field in zip(columns, schema)], schema=schema)
+
+        if key not in self.writers:
+            partition = os.path.join(self.sink.directory, model.__tablename__, 'date={}'.format(day.isoformat()))
+            os.makedirs(partition, exist_ok=True)
+            path = os.path.join(partition, self.name)
+            # hidden files are skipped by Parquet readers
+            temporary = os.path.join(partition, '.{}.{}.tmp'.format(self.name, id(self)))
+            writer = pyarrow.parquet.ParquetWriter(temporary, schema, compression=self.sink.compression)
+            self.writers[key] = (writer, temporary, path)
+
+        self.writers[key][0].write_table(table, row_group_size=self.sink.row_group_size)
+        self.rows += len(rows)
@@ -1,13 +1,67 @@
 from datetime import datetime
-from httplib2 import Http
+from functools import lru_cache
+import hashlib
 import json
 import re
 import csv
+import codecs
 import io
-import pytz
-import requests
-from oauth2client.service_account import ServiceAccountCredentials
-from googleapiclient.discovery import build
+import os
+import random
+import threading
+import time
+
+from core.metrics import metrics
+
+# googleapiclient, oauth2client, httplib2, pytz and requests take most of startup time,
+# so they are imported only by functions which need them
+
+# bytes read from HTTP body at once when streaming reports
+STREAM_CHUNK_SIZE = 64 * 1024
+# bytes read from HTTP body at once when saving reports to disk
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+# max number of keep-alive connections kept per host
+HTTP_POOL_SIZE = 10
+
+# API requests sent in one batch HTTP request, see DBMQuery.execute_batch
+API_BATCH_SIZE = 50
+
+# reports finished this long before run request are still treated as fresh (clock skew)
+CLOCK_SKEW_MS = 5 * 1000
+
+# query metadata set by DBM, not accepted by createquery
+QUERY_READ_ONLY_METADATA = ('running', 'latestReportRunTimeMs', 'googleCloudStoragePathForLatestReport',
+                            'googleDrivePathForLatestReport', 'reportCount')
+
+# formats of dates in DBM reports, tried in this order
+DATE_FORMATS = ('%Y/%m/%d', '%Y-%m-%d', '%Y.%m.%d', '%Y/%d/%m')
+# '%Y/%d/%m' is only a fallback for values which are not valid '%Y/%m/%d' dates,
+# so it can't be tried first for next values
+STICKY_DATE_FORMATS = DATE_FORMATS[:3]
+# distinct date strings remembered by clean_date_value
+DATE_CACHE_SIZE = 4096
+# everything except digits and decimal point in money values
+CURRENCY_JUNK = re.compile('[^.0-9]+')
+# the same, but keeps newlines separating values cleaned in one go
+CURRENCY_JUNK_LINES = re.compile('[^.0-9\n]+')
+
+API_NAME = 'doubleclickbidmanager'
+API_VERSION = 'v1'
+API_SCOPE = ['https://www.googleapis.com/auth/doubleclickbidmanager']
+DISCOVERY_URL = 'https://www.googleapis.com/discovery/v1/apis/{api}/{version}/rest'
+# discovery documents and query listings are stored here between runs
+CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'dbm-statistics')
+# discovery documents are refreshed once a week
+DISCOVERY_CACHE_DIR = CACHE_DIR
+DISCOVERY_CACHE_TTL = 7 * 24 * 3600
+# query listing is fetched from DBM again after that many seconds, see DBMQuery.get_queries
+QUERY_LIST_TTL = 10 * 60
+
+_http_session = None
+# process-wide caches shared by all DBMQuery instances
+_credentials = {}
+_discovery_documents = {}
+_cache_lock = threading.Lock()
 
 
 class DBMQuery():
@@ -15,15 +69,49 @@ class DBMQuery():
     Additional layer for simplifying mundane interactions with DBM API.
     """
 
-    def __init__(self, auth_json):
+    # RateLimiter of API calls, e.g. to stay within quota of service account
+    rate_limiter = None
+
+    def __init__(self, auth_json, history_file=None, cache=None, discovery_cache_dir=DISCOVERY_CACHE_DIR,
+                 query_list_dir=CACHE_DIR, api_rate=None):
         self.auth_json = auth_json
-        self.scope = ['https://www.googleapis.com/auth/doubleclickbidmanager']
-        self.credentials = ServiceAccountCredentials.from_json_keyfile_name(self.auth_json, self.scope)
-        self.http_auth = self.credentials.authorize(Http())
+        # core.cache.ReportCache, reports are downloaded only once if set
+        self.cache = cache
+        # when queries were last run (ms since epoch) and how long they usually take (s)
+        self.run_times = {}
+        self.history = QueryHistory(history_file)
+        self.scope = API_SCOPE
+        self.discovery_cache_dir = discovery_cache_dir
+        # directory of cached query listing, see get_queries
+        self.query_list_dir = query_list_dir
+        # max API calls per second of this instance, unlimited if None
+        if api_rate:
+            self.rate_limiter = RateLimiter(api_rate)
+        self._client = None
+
+    @property
+    def client(self):
+        """
+        Google's API client class, built on first API call.
+        """
+        if self._client is None:
+            from googleapiclient.discovery import build, build_from_document
+            from httplib2 import Http
+
+            # credentials and their access token are shared, Http is not thread safe so every instance has its own
+            self.credentials = get_credentials(self.auth_json, self.scope)
+            self.http_auth = self.credentials.authorize(Http())
 
-        # client is Google's API client class
-        self.client = build('doubleclickbidmanager', 'v1', http=self.http_auth)
+            if self.discovery_cache_dir:
+                document = get_discovery_document(API_NAME, API_VERSION, self.discovery_cache_dir)
+                self._client = build_from_document(document, http=self.http_auth)
+            else:
+                self._client = build(API_NAME, API_VERSION, http=self.http_auth)
+        return self._client
 
+    @client.setter
+    def client(self, client):
+        self._client = client
 
     def run_query(self, query_id, daterange, start_date=None, end_date=None, timezone='America/New_York'):
         """
@@ -35,6 +123,15 @@ class DBMQuery():
         :param timezone: Canonical timezone code for report data time. Defaults to America/New_York.
         :return: json response from DBM
         """
+        return self._execute(self.run_query_request(query_id, daterange, start_date, end_date, timezone))
+
+    def run_query_request(self, query_id, daterange, start_date=None, end_date=None, timezone='America/New_York',
+                          body=None):
+        """
+        The same as run_query, but returns request which is not executed yet, e.g. for execute_batch.
+        :param body: runquery body used as is instead of other arguments, e.g. from queries/runquery_yesterday.json
+        :return: googleapiclient.http.HttpRequest
+        """
         DATE_RANGE = ("ALL_TIME",
                       "CURRENT_DAY",
                       "CUSTOM_DATES",
@@ -57,6 +154,7 @@ class DBMQuery():
                       )
 
         def date_to_miliseconds(date):
+            import pytz
             try:
                 utc = pytz.timezone(timezone) #assert that we're using correct timezone for DBM
                 miliseconds = round(datetime.timestamp(utc.localize(date)) * 1000)
@@ -66,6 +164,11 @@ class DBMQuery():
                                  " date object.".format(str))
 
 
+        if body is not None:
+            self.run_times[str(query_id)] = int(time.time() * 1000)
+            self.invalidate_query_list()
+            return self.client.queries().runquery(queryId=query_id, body=body)
+
         if daterange in DATE_RANGE:
             body = {
                 "dataRange": daterange,
@@ -78,51 +181,171 @@ class DBMQuery():
                     "reportDataEndTimeMs": date_to_miliseconds(end_date)
                 })
 
-            return self.client.queries().runquery(queryId=query_id, body=body).execute()
+            self.run_times[str(query_id)] = int(time.time() * 1000)
+            self.invalidate_query_list()
+            return self.client.queries().runquery(queryId=query_id, body=body)
 
         else:
             raise ValueError("{} is not within approved dateranges. "
                              "Check https://developers.google.com/bid-manager/v1/queries for more information".format(daterange))
 
 
-    def list_queries(self):
+    def list_queries(self, title=None, data_range=None, running=None, max_age=QUERY_LIST_TTL):
         """
-        List available created queries in DBM
-        :param client: QueryID in DBM
+        List available created queries in DBM, see get_queries for filters
         :return: print queries to stdout
         """
-        query = self.client.queries().listqueries().execute()
+        queries = self.get_queries(title, data_range, running, max_age)
 
-        try:
-            print("Query ID", "Name", "Data Range", "Last run date", "Is running?", sep=" | ")
-            for q in query['queries']:
-                print(q['queryId'],
-                      q['metadata']['title'],
-                      q['metadata']['dataRange'],
-                      datetime.fromtimestamp(int(q['metadata']['latestReportRunTimeMs']) / 1000.0).strftime(
-                          '%Y-%m-%d %H:%M:%S'),
-                      q['metadata']['running'],
-                      sep=" | ")
-        except KeyError:
+        if not queries:
+            if title or data_range or running is not None:
+                print("No queries match the filters.")
+                return
             print("No queries are created for this account. Use -c to create new one.")
             exit(0)
 
+        lines = [" | ".join(("Query ID", "Name", "Data Range", "Last run date", "Is running?"))]
+        for q in queries:
+            last_run = datetime.fromtimestamp(int(q['latestReportRunTimeMs']) / 1000.0).strftime(
+                '%Y-%m-%d %H:%M:%S') if q['latestReportRunTimeMs'] else '-'
+            lines.append(" | ".join((str(q['queryId']), q['title'], q['dataRange'], last_run, str(q['running']))))
+        print("\n".join(lines))
+
+    def get_queries(self, title=None, data_range=None, running=None, max_age=QUERY_LIST_TTL):
+        """
+        Returns summaries of queries in DBM. Listing is kept in `query_list_dir` and fetched
+        from DBM again when it is older than max_age or when queries were run, created or deleted.
+        :param title: only queries with this text in title, case-insensitive
+        :param data_range: only queries with this data range, e.g. PREVIOUS_DAY
+        :param running: only running (True) or finished (False) queries
+        :param max_age: max age of cached listing in seconds, 0 always fetches it
+        :return: list of dicts {queryId, title, dataRange, latestReportRunTimeMs, running}
+        """
+        queries = self._read_query_list(max_age)
+        if queries is None:
+            queries = self._fetch_query_list()
+            self._write_query_list(queries)
+
+        if title:
+            title = title.lower()
+            queries = [q for q in queries if title in q['title'].lower()]
+        if data_range:
+            queries = [q for q in queries if q['dataRange'] == data_range.upper()]
+        if running is not None:
+            queries = [q for q in queries if q['running'] == running]
+        return queries
+
+    def invalidate_query_list(self):
+        """
+        Drop cached listing of queries, e.g. after query was run or deleted.
+        """
+        path = self._query_list_path()
+        if path and os.path.exists(path):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def _fetch_query_list(self):
+        queries, page_token = [], None
+        while True:
+            # pageToken is only sent when DBM returned nextPageToken, v1 returns all queries at once
+            kwargs = {'pageToken': page_token} if page_token else {}
+            response = self._execute(self.client.queries().listqueries(**kwargs))
+            for q in response.get('queries', []):
+                metadata = q.get('metadata', {})
+                queries.append({'queryId': q['queryId'],
+                                'title': metadata.get('title', ''),
+                                'dataRange': metadata.get('dataRange', ''),
+                                'latestReportRunTimeMs': metadata.get('latestReportRunTimeMs'),
+                                'running': metadata.get('running', False)})
+            page_token = response.get('nextPageToken')
+            if not page_token:
+                return queries
+
+    def _query_list_path(self):
+        if not self.query_list_dir:
+            return None
+        # listing of every API key is kept apart
+        key = hashlib.sha1(os.path.abspath(self.auth_json or '').encode('utf-8')).hexdigest()[:16]
+        return os.path.join(self.query_list_dir, 'queries-{}.json'.format(key))
+
+    def _read_query_list(self, max_age):
+        path = self._query_list_path()
+        try:
+            if path and time.time() - os.path.getmtime(path) < max_age:
+                with open(path) as file:
+                    return json.load(file)
+        except (OSError, ValueError):
+            pass
+        return None
+
+    def _write_query_list(self, queries):
+        path = self._query_list_path()
+        if not path:
+            return
+        try:
+            os.makedirs(self.query_list_dir, exist_ok=True)
+            write_file(path, json.dumps(queries))
+        except OSError:
+            # listing is only a cache
+            pass
+
     def create_query(self, file):
         """
         Create new query from json.
         :param file: json with query parameters
         :return: empty Http response
         """
+        return self._execute(self.create_query_request(file))
+
+    def create_query_request(self, file):
+        """
+        The same as create_query, but returns request which is not executed yet, e.g. for execute_batch.
+        :return: googleapiclient.http.HttpRequest
+        """
         try:
-            with open(file) as file:
-                body = json.load(file)
+            with open(file) as json_file:
+                body = json.load(json_file)
         except AttributeError:
-            raise AttributeError("{} is not a file, please specify path to json file".format(body))
+            raise AttributeError("{} is not a file, please specify path to json file".format(file))
         except json.decoder.JSONDecodeError:
-            raise TypeError("{} is not a json file".format(body))
+            raise TypeError("{} is not a json file".format(file))
+
+        self.invalidate_query_list()
+        return self.client.queries().createquery(body=body)
+
+    def clone_query(self, query_id, title=None):
+        """
+        Create one-time copy of existing query, e.g. to run it for many date ranges at once.
+        :param query_id: QueryID in DBM
+        :param title: title of new query, defaults to title of cloned query with " (copy)"
+        :return: json response from DBM with new query
+        """
+        query = self.get_query(query_id)
+        metadata = {key: value for key, value in query['metadata'].items() if key not in QUERY_READ_ONLY_METADATA}
+        metadata['title'] = title or "{} (copy)".format(metadata.get('title', query_id))
+
+        body = {'metadata': metadata,
+                'params': query['params'],
+                'schedule': {'frequency': 'ONE_TIME'}}
+        if 'timezoneCode' in query:
+            body['timezoneCode'] = query['timezoneCode']
 
-        return self.client.queries().createquery(body=body).execute()
+        self.invalidate_query_list()
+        return self._execute(self.client.queries().createquery(body=body))
 
+    def get_query(self, query_id):
+        """
+        Returns query with its metadata from DBM
+        :param query_id: QueryID in DBM
+        :return: json response from DBM
+        """
+        query = self._execute(self.client.queries().getquery(queryId=query_id))
+
+        if not query:
+            raise ValueError("Query ID {} does not exist in DBM. Have you run query before downloading it?".format(query_id))
+        return query
 
     def get_query_url_to_file(self, query_id):
         """
@@ -130,23 +353,94 @@ class DBMQuery():
         :param query_id: QueryID in DBM
         :return: URL to file
         """
-        query = self.client.queries().getquery(queryId=query_id).execute()
+        query = self.get_query(query_id)
 
-        if not query:
-            raise ValueError("Query ID {} does not exist in DBM. Have you run query before downloading it?".format(query_id))
-        elif query['metadata']['running']:
+        if query['metadata']['running']:
             raise RuntimeWarning("Query ID {} is still running!".format(query_id))
         else:
             return query['metadata']['googleCloudStoragePathForLatestReport']
 
-    def download_query(self, query_id, type='dict'):
+    def report_ready(self, query_id):
+        """
+        Check once if report of query run with run_query is ready.
+        Report generated before run_query was called is not treated as ready.
+        :param query_id: QueryID in DBM
+        :return: URL to file, None if query is still running or report is stale
+        """
+        metadata = self.fresh_report(query_id)
+        return metadata['googleCloudStoragePathForLatestReport'] if metadata else None
+
+    def fresh_report(self, query_id):
+        """
+        The same as report_ready, but returns whole query metadata.
+        :param query_id: QueryID in DBM
+        :return: dict with query metadata, None if query is still running or report is stale
+        """
+        metadata = self.get_query(query_id)['metadata']
+        run_time = self.run_times.get(str(query_id))
+
+        if metadata['running']:
+            return None
+        if run_time and int(metadata.get('latestReportRunTimeMs', 0)) < run_time - CLOCK_SKEW_MS:
+            return None
+
+        if run_time:
+            self.history.record(query_id, time.time() - run_time / 1000.0)
+            self.run_times.pop(str(query_id), None)
+        return metadata
+
+    def expected_duration(self, query_id):
+        """
+        Returns how long query usually runs, based on previous runs.
+        :param query_id: QueryID in DBM
+        :return: seconds, 0 if query was not timed yet
+        """
+        return self.history.expected_duration(query_id)
+
+    def wait_for_report(self, query_id, timeout=3600, initial_delay=None, backoff=None):
+        """
+        Wait until fresh report of query run with run_query is ready.
+        First check happens after query's usual run time, next ones are spaced
+        with exponential backoff with jitter.
+        :param query_id: QueryID in DBM
+        :param timeout: seconds to wait before raising TimeoutError
+        :param initial_delay: seconds before first check, defaults to most of expected_duration
+        :param backoff: Backoff with intervals between checks
+        :return: URL to file
+        """
+        deadline = time.time() + timeout
+        backoff = backoff or Backoff()
+        if initial_delay is None:
+            initial_delay = 0.8 * self.expected_duration(query_id)
+        with metrics.timer('poll'):
+            time.sleep(min(initial_delay, timeout))
+
+        while True:
+            url = self.report_ready(query_id)
+            if url:
+                return url
+
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                raise TimeoutError("Query ID {} did not finish in {} seconds".format(query_id, timeout))
+            with metrics.timer('poll'):
+                time.sleep(min(backoff.next(), remaining))
+
+    def download_query(self, query_id, type='dict', footer_column='Date'):
         """
         Returns Http request's raw data
         :param query_id: QueryID in DBM
-        :param type: raw - request.raw; csv_dict = csv.DictReader
-        :return: raw = binary, dict = OrderedDict; else None
+        :param type: raw - request.raw; csv_dict = csv.DictReader; stream = generator of rows read in chunks
+        :param footer_column: column which is empty in summary rows, for type='stream'
+        :return: raw = binary, dict = OrderedDict, stream = generator of OrderedDict; else None
         """
-        file = requests.get(self.get_query_url_to_file(query_id))
+        if type == 'stream':
+            return self.stream_query(query_id, footer_column=footer_column)
+
+        if self.cache is not None:
+            return self._read_cached_report(query_id, type)
+
+        file = get_http_session().get(self.get_query_url_to_file(query_id))
 
         if type == 'binary':
             return file.content
@@ -155,37 +449,579 @@ class DBMQuery():
         else:
             return None
 
+    def cache_report(self, query_id, **kwargs):
+        """
+        Download latest report of query to report cache, unless it is already there.
+        :param query_id: QueryID in DBM
+        :param kwargs: passed to core.util.download_to_file, e.g. progress
+        :return: path to cached report
+        """
+        metadata = self.get_query(query_id)['metadata']
+
+        if metadata['running']:
+            raise RuntimeWarning("Query ID {} is still running!".format(query_id))
+
+        return self.cache.fetch(query_id, metadata['latestReportRunTimeMs'],
+                                metadata['googleCloudStoragePathForLatestReport'], **kwargs)
+
+    def _read_cached_report(self, query_id, type):
+        path = self.cache_report(query_id)
+
+        if type == 'binary':
+            with open(path, 'rb') as file:
+                return file.read()
+        elif type == 'dict':
+            return csv.DictReader(iter_lines(self.cache.read(path)))
+        else:
+            return None
+
+    def stream_query(self, query_id, chunk_size=STREAM_CHUNK_SIZE, encoding='utf-8', footer_column='Date'):
+        """
+        Download report in chunks and parse it on the fly. Summary and metadata rows
+        at the end of report are not downloaded, so memory usage does not depend on report size.
+        Raises RuntimeWarning right away if query is still running.
+        :param query_id: QueryID in DBM
+        :param chunk_size: number of bytes read from response at once
+        :param encoding: report file encoding
+        :param footer_column: column which is empty in summary rows, e.g. `footer` of row mapper
+        :return: generator of OrderedDict rows
+        """
+        if self.cache is not None:
+            return iter_report_rows(self.cache.read(self.cache_report(query_id), chunk_size), encoding, footer_column)
+
+        return stream_report(self.get_query_url_to_file(query_id), chunk_size=chunk_size, encoding=encoding,
+                             footer_column=footer_column)
+
     def delete_query(self, query_id):
         """
         Delete query ID in DBM with its associated reports.
         :param query_id: QueryID in DBM
         """
-        return self.client.queries().deletequery(queryId=query_id).execute()
+        return self._execute(self.delete_query_request(query_id))
+
+    def delete_query_request(self, query_id):
+        """
+        The same as delete_query, but returns request which is not executed yet, e.g. for execute_batch.
+        :return: googleapiclient.http.HttpRequest
+        """
+        self.invalidate_query_list()
+        return self.client.queries().deletequery(queryId=query_id)
+
+    def execute_batch(self, requests, batch_size=API_BATCH_SIZE):
+        """
+        Execute many API requests in few HTTP requests, using batch endpoint of the API.
+        Failure of one request does not stop the others.
+        :param requests: dict {key: request}, e.g. from run_query_request
+        :param batch_size: requests sent in one HTTP request
+        :return: dict {key: json response from DBM or exception}
+        """
+        keys = {str(number): key for number, key in enumerate(requests)}
+        results = {}
+
+        def callback(request_id, response, exception):
+            results[keys[request_id]] = exception if exception is not None else response
+
+        items = list(zip(keys, requests.values()))
+        for offset in range(0, len(items), batch_size):
+            batch = self.client.new_batch_http_request(callback=callback)
+            for request_id, request in items[offset:offset + batch_size]:
+                batch.add(request, request_id=request_id)
+            if self.rate_limiter:
+                # quota is counted per request, not per batch
+                self.rate_limiter.wait(len(items[offset:offset + batch_size]))
+            try:
+                with metrics.timer('api'):
+                    batch.execute()
+            except Exception as exception:
+                # whole batch failed, e.g. connection error
+                for request_id, request in items[offset:offset + batch_size]:
+                    results.setdefault(keys[request_id], exception)
+
+        return results
+
+    def _execute(self, request):
+        if self.rate_limiter:
+            self.rate_limiter.wait()
+        # every API call is timed as stage 'api', see core.metrics
+        with metrics.timer('api'):
+            return request.execute()
+
+
+class QueryHistory():
+    """
+    How long queries usually run, kept in JSON file between runs.
+    Thread safe, so it can be shared by DBMQuery instances of many threads.
+    """
+
+    def __init__(self, path=None):
+        """
+        :param path: JSON file, history is kept in memory only if None
+        """
+        self.path = path
+        self.lock = threading.Lock()
+        self.durations = {}
+        if path and os.path.exists(path):
+            with open(path) as file:
+                self.durations = json.load(file)
+
+    def expected_duration(self, query_id):
+        """
+        :return: seconds, 0 if query was not timed yet
+        """
+        with self.lock:
+            return self.durations.get(str(query_id), 0)
+
+    def record(self, query_id, seconds):
+        """
+        Add run time of query and write history to file.
+        :param query_id: QueryID in DBM
+        :param seconds: how long query ran
+        """
+        with self.lock:
+            # moving average, so one slow night does not shift expectations too much
+            previous = self.durations.get(str(query_id))
+            self.durations[str(query_id)] = seconds if previous is None else 0.7 * previous + 0.3 * seconds
+
+            if self.path:
+                write_file(self.path, json.dumps(self.durations))
+
+
+class Backoff():
+    """
+    Exponentially growing intervals with random jitter, for polling DBM API.
+    """
+
+    def __init__(self, initial=5, maximum=300, factor=2, jitter=0.5):
+        self.interval = initial
+        self.maximum = maximum
+        self.factor = factor
+        self.jitter = jitter
+
+    def next(self):
+        """
+        Returns next interval in seconds, somewhere in (1 - jitter) * interval ... interval
+        """
+        interval = self.interval * random.uniform(1 - self.jitter, 1)
+        self.interval = min(self.interval * self.factor, self.maximum)
+        return interval
+
+
+class RateLimiter():
+    """
+    Spaces calls evenly, so no more than `rate` calls per second are made. Thread safe.
+    """
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate
+        self.next_call = 0
+        self.lock = threading.Lock()
+
+    def wait(self, calls=1):
+        """
+        Block until next call is allowed.
+        :param calls: number of calls made at once, e.g. requests in one batch
+        """
+        with self.lock:
+            now = time.time()
+            delay = self.next_call - now
+            self.next_call = max(now, self.next_call) + self.interval * calls
+
+        if delay > 0:
+            time.sleep(delay)
+
+
+def write_file(path, text):
+    """
+    Write text file under temporary name and rename it, so readers never see half-written file.
+    Temporary name is unique per process and thread, concurrent writers don't replace each other's half-written file.
+    :param path: path to file
+    :param text: file content
+    """
+    temporary = '{}.{}.{}.tmp'.format(path, os.getpid(), threading.get_ident())
+    with open(temporary, 'w') as file:
+        file.write(text)
+    os.replace(temporary, path)
+
+
+"""
+Process-wide caches of API client parts
+"""
+
+def get_credentials(auth_json, scope=API_SCOPE):
+    """
+    Returns service account credentials, key file is read once per process.
+    :param auth_json: path to API key in JSON
+    :param scope: list of OAuth scopes
+    :return: ServiceAccountCredentials
+    """
+    key = (os.path.abspath(auth_json), tuple(scope))
+
+    with _cache_lock:
+        if key not in _credentials:
+            from oauth2client.service_account import ServiceAccountCredentials
+            _credentials[key] = ServiceAccountCredentials.from_json_keyfile_name(auth_json, scope)
+        return _credentials[key]
+
+
+def get_discovery_document(api, version, cache_dir=DISCOVERY_CACHE_DIR, ttl=DISCOVERY_CACHE_TTL, session=None):
+    """
+    Returns API discovery document, fetched from Google at most once per `ttl` seconds
+    and parsed once per process. Stale document is used if it can't be refreshed.
+    :param api: API name, e.g. doubleclickbidmanager
+    :param version: API version, e.g. v1
+    :param cache_dir: directory for cached documents
+    :param ttl: max age of cached document in seconds
+    :param session: requests.Session, defaults to shared session from get_http_session
+    :return: dict
+    """
+    import requests
+
+    key = (api, version)
+    if key in _discovery_documents:
+        return _discovery_documents[key]
+
+    path = os.path.join(cache_dir, '{}-{}.json'.format(api, version))
+    fresh = os.path.exists(path) and time.time() - os.path.getmtime(path) < ttl
+
+    if not fresh:
+        try:
+            response = (session or get_http_session()).get(DISCOVERY_URL.format(api=api, version=version))
+            response.raise_for_status()
+            os.makedirs(cache_dir, exist_ok=True)
+            write_file(path, response.text)
+        except (requests.exceptions.RequestException, OSError):
+            if not os.path.exists(path):
+                raise
+
+    with open(path) as file:
+        document = json.load(file)
+
+    with _cache_lock:
+        return _discovery_documents.setdefault(key, document)
+
+
+"""
+Additional functions for downloading reports
+"""
+
+def get_http_session():
+    """
+    Returns process-wide requests.Session, so connections to Google Cloud Storage
+    are kept alive and reused between downloads.
+    :return: requests.Session
+    """
+    global _http_session
+
+    if _http_session is None:
+        import requests
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        _http_session = session
+
+    return _http_session
+
+
+def download_to_file(url, path, session=None, chunk_size=DOWNLOAD_CHUNK_SIZE, retries=3, progress=None):
+    """
+    Download file in chunks to temporary `<path>.part` file and rename it to `path` when complete.
+    Partial file left by broken download is resumed with HTTP Range request, unless file on server
+    has changed since (checked with its ETag / Last-Modified header).
+    :param url: URL to file, e.g. from DBMQuery.get_query_url_to_file
+    :param path: destination path
+    :param session: requests.Session, defaults to shared session from get_http_session
+    :param chunk_size: number of bytes read from response at once
+    :param retries: how many times broken connection is resumed before giving up
+    :param progress: callable(downloaded bytes, total bytes or None, MB/s) called after every chunk
+    :return: path
+    """
+    import requests
+
+    session = session or get_http_session()
+    part = path + '.part'
+
+    with metrics.timer('download'):
+        for attempt in range(retries + 1):
+            try:
+                _download_part(url, part, session, chunk_size, progress)
+                break
+            except (requests.exceptions.ConnectionError, requests.exceptions.ChunkedEncodingError):
+                if attempt == retries:
+                    raise
+
+    os.replace(part, path)
+    if os.path.exists(part + '.validator'):
+        os.remove(part + '.validator')
+    return path
+
+
+def _download_part(url, part, session, chunk_size, progress):
+    validator_file = part + '.validator'
+    offset = os.path.getsize(part) if os.path.exists(part) else 0
+    validator = None
+    if offset and os.path.exists(validator_file):
+        with open(validator_file) as file:
+            validator = file.read()
+
+    # byte offsets only make sense for file as stored, not transcoded on the fly
+    headers = {'Accept-Encoding': 'identity'}
+    if offset and validator:
+        headers.update({'Range': 'bytes={}-'.format(offset), 'If-Range': validator})
+
+    response = session.get(url, headers=headers, stream=True)
+    try:
+        if response.status_code == 416:
+            # nothing left to download - partial file is already complete
+            if response.headers.get('Content-Range', '').endswith('/{}'.format(offset)):
+                return
+            os.remove(part)
+            return _download_part(url, part, session, chunk_size, progress)
+
+        response.raise_for_status()
+
+        if response.status_code != 206:
+            # server sent whole file, either it has changed or we had nothing to resume
+            offset = 0
+
+        validator = response.headers.get('ETag') or response.headers.get('Last-Modified')
+        if validator:
+            with open(validator_file, 'w') as file:
+                file.write(validator)
+        elif os.path.exists(validator_file):
+            os.remove(validator_file)
+
+        length = response.headers.get('Content-Length')
+        total = offset + int(length) if length is not None else None
+        downloaded = offset
+        started = time.time()
+
+        try:
+            with open(part, 'ab' if offset else 'wb') as file:
+                for chunk in response.iter_content(chunk_size):
+                    file.write(chunk)
+                    downloaded += len(chunk)
+                    if progress:
+                        elapsed = max(time.time() - started, 1e-6)
+                        progress(downloaded, total, (downloaded - offset) / elapsed / 1024 / 1024)
+        finally:
+            metrics.add('download', bytes=downloaded - offset)
+    finally:
+        response.close()
+
+
+def report_chunks(url, session=None, chunk_size=STREAM_CHUNK_SIZE):
+    """
+    Open report file and return generator of its chunks of bytes, e.g. for core.columnar.parse_columns.
+    Connection is opened right away, so HTTP errors are raised before iteration starts.
+    :param url: URL to file, e.g. from DBMQuery.get_query_url_to_file
+    :param session: requests.Session, defaults to shared session from get_http_session
+    :param chunk_size: number of bytes read from response at once
+    :return: generator of bytes
+    """
+    response = (session or get_http_session()).get(url, stream=True)
+    response.raise_for_status()
+
+    def chunks():
+        # downloaded while parsed, so only bytes are counted - time is part of parsing
+        size = 0
+        try:
+            for chunk in response.iter_content(chunk_size):
+                size += len(chunk)
+                yield chunk
+        finally:
+            metrics.add('download', calls=1, bytes=size)
+            # drops the rest of the body if we stopped at summary rows
+            response.close()
+
+    return chunks()
+
+
+def stream_report(url, session=None, chunk_size=STREAM_CHUNK_SIZE, encoding='utf-8', footer_column='Date'):
+    """
+    Open report file and return generator parsing it in chunks, see DBMQuery.stream_query.
+    Connection is opened right away, so HTTP errors are raised before iteration starts.
+    :param url: URL to file, e.g. from DBMQuery.get_query_url_to_file
+    :param session: requests.Session, defaults to shared session from get_http_session
+    :param chunk_size: number of bytes read from response at once
+    :param encoding: report file encoding
+    :param footer_column: column which is empty in summary rows
+    :return: generator of OrderedDict rows
+    """
+    chunks = report_chunks(url, session, chunk_size)
+
+    def rows():
+        try:
+            for row in iter_report_rows(chunks, encoding, footer_column):
+                yield row
+        finally:
+            chunks.close()
+
+    return rows()
+
+
+"""
+Additional functions for parsing reports
+"""
+
+def iter_lines(chunks, encoding='utf-8'):
+    """
+    Decode chunks of bytes incrementally and split them into lines.
+    Multibyte characters and lines split between chunks are glued back together.
+    :param chunks: iterable of bytes
+    :param encoding: encoding of chunks
+    :return: generator of lines with line endings preserved
+    """
+    decoder = codecs.getincrementaldecoder(encoding)()
+    tail = ''
+
+    for chunk in chunks:
+        lines = (tail + decoder.decode(chunk)).split('\n')
+        tail = lines.pop()
+        for line in lines:
+            yield line + '\n'
+
+    tail += decoder.decode(b'', final=True)
+    if tail:
+        yield tail
+
+
+class ReportParser():
+    """
+    Push parser of DBM csv reports: chunks of bytes go in as they arrive, parsed rows come out.
+    Parsing stops at summary rows, which have empty `footer_column`.
+    """
+
+    def __init__(self, encoding='utf-8', footer_column='Date'):
+        self.decoder = codecs.getincrementaldecoder(encoding)()
+        self.footer_column = footer_column
+        self.fieldnames = None
+        self.done = False
+
+        # incomplete last line and complete lines of record with newline inside quoted value
+        self.tail = ''
+        self.pending = []
+        self.quotes = 0
+
+    def feed(self, chunk):
+        """
+        Parse next chunk of report.
+        :param chunk: bytes
+        :return: list of OrderedDict rows completed by this chunk
+        """
+        if self.done:
+            return []
+
+        lines = (self.tail + self.decoder.decode(chunk)).split('\n')
+        self.tail = lines.pop()
+        return self._parse(line + '\n' for line in lines)
+
+    def close(self):
+        """
+        Parse what is left after the last chunk.
+        :return: list of OrderedDict rows
+        """
+        if self.done:
+            return []
+
+        tail = self.tail + self.decoder.decode(b'', final=True)
+        rows = self._parse([tail] if tail else [])
+        if self.pending and not self.done:
+            # unterminated quoted value, parsed the way csv module would do it
+            rows += self._rows(self.pending)
+
+        self.tail, self.pending, self.done = '', [], True
+        return rows
+
+    def _parse(self, lines):
+        records = []
+        for line in lines:
+            self.pending.append(line)
+            self.quotes += line.count('"')
+            # even number of quotes means record is complete, escaped quotes come in pairs
+            if self.quotes % 2 == 0:
+                records.extend(self.pending)
+                self.pending, self.quotes = [], 0
+
+        return self._rows(records) if records else []
+
+    def _rows(self, lines):
+        reader = csv.DictReader(lines, fieldnames=self.fieldnames)
+        rows = []
+        for row in reader:
+            if row.get(self.footer_column) == '':
+                self.done = True
+                break
+            rows.append(row)
+
+        self.fieldnames = reader.fieldnames
+        return rows
+
+
+def iter_report_rows(chunks, encoding='utf-8', footer_column='Date'):
+    """
+    Parse DBM csv report from chunks of bytes, stopping at summary rows.
+    Every csv report ends with summary and metadata rows which have empty `footer_column`.
+    :param chunks: iterable of bytes
+    :param encoding: encoding of chunks
+    :param footer_column: column which is empty in summary rows
+    :return: generator of OrderedDict rows
+    """
+    parser = ReportParser(encoding, footer_column)
+
+    for chunk in chunks:
+        for row in parser.feed(chunk):
+            yield row
+        if parser.done:
+            return
+
+    for row in parser.close():
+        yield row
 
 
 """
 Additional functions for formatting data
 """
 
+_last_date_format = DATE_FORMATS[0]
+
+
+@lru_cache(maxsize=DATE_CACHE_SIZE)
 def clean_date_value(str):
     """
     Clean date string and return datetime object.
+    Results are cached and format which worked last time is tried first.
     :param str: YYYY/MM/DD
     :return: datetime object
     """
+    global _last_date_format
+
     try:
-        return datetime.strptime(str, '%Y/%m/%d')
+        return datetime.strptime(str, _last_date_format)
     except ValueError:
+        pass
+
+    for format in DATE_FORMATS:
         try:
-            return datetime.strptime(str, '%Y-%m-%d')
-        except ValueError:
-            try:
-                return datetime.strptime(str, '%Y.%m.%d')
-            except ValueError:
-                try:
-                    return datetime.strptime(str, '%Y/%d/%m')
-                except ValueError as e:
-                    raise ValueError(e)
+            value = datetime.strptime(str, format)
+        except ValueError as e:
+            error = e
+            continue
+
+        if format in STICKY_DATE_FORMATS:
+            _last_date_format = format
+        return value
+
+    raise ValueError(error)
+
+
+def clean_date_values(values):
+    """
+    Clean iterable of date strings, see clean_date_value.
+    :param values: iterable of str
+    :return: list of datetime objects
+    """
+    return [clean_date_value(value) for value in values]
 
 
 def clean_currency_value(str):
@@ -194,7 +1030,17 @@ def clean_currency_value(str):
     :param str
     :return: float
     """
-    pattern = re.compile('[^.0-9]+')
-    match = re.sub(pattern, '', str)
+    return float(CURRENCY_JUNK.sub('', str))
 
-    return float(match)
\ No newline at end of file
+
+def clean_currency_values(values):
+    """
+    Clean iterable of money values with one regex pass over all of them.
+    :param values: iterable of str
+    :return: list of floats
+    """
+    values = list(values)
+    if not values:
+        # ''.split('\n') would give one empty value
+        return []
+    return [float(value) for value in CURRENCY_JUNK_LINES.sub('', '\n'.join(values)).split('\n')]
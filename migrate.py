@@ -0,0 +1,44 @@
+import argparse
+import logging
+import os
+from datetime import date, timedelta
+
+from sqlalchemy.schema import CreateIndex
+
+from core.models import Base
+from core.schema import PARTITIONED_TABLES, missing_indexes, partition_sql
+from core.script import Script
+
+CWD = os.path.dirname(os.path.abspath(__file__))
+script = Script('migrate', CWD)
+logger = logging.getLogger(__name__)
+
+# parse arguments from CLI
+parser = argparse.ArgumentParser(description="Bring schema of existing database up to date with core.models")
+parser.add_argument('command', choices=('indexes', 'partitions'),
+                    help='indexes: create indexes missing in existing tables; '
+                         'partitions: partition stats tables by month (MySQL only), run monthly to add new months')
+parser.add_argument('-m', '--months-ahead', type=int, default=3, help='Months of partitions created in advance')
+parser.add_argument('--dry-run', action='store_true', help='Only print SQL statements')
+args = parser.parse_args()
+
+# tables are created if they don't exist. If they do, SQL Alchemy skips creation
+engine = script.engine()
+
+with engine.connect() as connection:
+    if args.command == 'indexes':
+        statements = [CreateIndex(index) for index in missing_indexes(connection, Base.metadata.sorted_tables)]
+    else:
+        end = date.today() + timedelta(days=31 * args.months_ahead)
+        statements = [statement for model in PARTITIONED_TABLES for statement in partition_sql(connection, model, end)]
+
+    if not statements:
+        logger.info("Schema is up to date")
+
+    # on big tables each statement may run for a long time, MySQL rebuilds the whole table
+    for statement in statements:
+        logger.info(str(statement.compile(dialect=engine.dialect) if hasattr(statement, 'compile') else statement))
+        if not args.dry_run:
+            connection.execute(statement)
+
+script.finish()
@@ -0,0 +1,33 @@
+import os
+import logging
+from datetime import datetime, timedelta
+
+from decouple import config
+
+from core.mappers import basic_stats_mapper, conversion_stats_mapper
+from core.orchestrator import Job, Orchestrator
+from core.script import Script
+
+CWD = os.path.dirname(os.path.abspath(__file__))
+script = Script('nightly-stats', CWD)
+logger = logging.getLogger(__name__)
+
+# run all queries with data from previous day at once and load them as they finish
+daterange = datetime.today() - timedelta(days=1)
+
+dbm = script.dbm()
+jobs = [Job(config('QUERY_BASIC_STATS'), basic_stats_mapper),
+        Job(config('QUERY_CONVERSION_STATS'), conversion_stats_mapper)]
+
+# tables are created if they don't exist. If they do, SQL Alchemy skips creation
+engine = script.engine()
+
+orchestrator = Orchestrator(dbm, engine, jobs,
+                            workers=config('WORKERS', default=4, cast=int),
+                            batch_size=script.batch_size,
+                            sinks=script.sinks(),
+                            columnar=config('COLUMNAR', default=False, cast=bool))
+results = orchestrator.run('CUSTOM_DATES', start_date=daterange, end_date=daterange, timezone="Europe/Warsaw")
+logger.info("Finished: {}".format(results))
+
+script.finish()
@@ -0,0 +1,61 @@
+import argparse
+import os
+import logging
+from datetime import datetime
+
+from decouple import config
+
+from core.loader import BulkLoader
+from core.mappers import DIMENSIONS, basic_stats_mapper, conversion_stats_mapper
+from core.pipeline import load_report
+from core.reconcile import window_dates
+from core.rollups import ROLLUPS
+from core.sinks import open_sinks
+from core.script import Script
+
+CWD = os.path.dirname(os.path.abspath(__file__))
+script = Script('reconcile', CWD)
+logger = logging.getLogger(__name__)
+
+MAPPERS = {'basic': ('QUERY_BASIC_STATS', basic_stats_mapper),
+           'conversion': ('QUERY_CONVERSION_STATS', conversion_stats_mapper)}
+
+
+def parse_date(value):
+    return datetime.strptime(value, '%Y-%m-%d').date()
+
+
+# parse arguments from CLI
+parser = argparse.ArgumentParser(description="Report trailing days again with one query and merge restated "
+                                             "metrics, e.g. conversions, into stored rows.")
+parser.add_argument('report', nargs='?', choices=MAPPERS, default='conversion', help='Which report to reconcile')
+parser.add_argument('-n', '--days', type=int, default=config('RECONCILE_DAYS', default=7, cast=int),
+                    help='Days in window')
+parser.add_argument('--end', type=parse_date, help='Last day of window, YYYY-MM-DD. Defaults to yesterday')
+args = parser.parse_args()
+
+setting, mapper = MAPPERS[args.report]
+start, end = window_dates(args.days, args.end)
+
+dbm = script.dbm()
+query_id = config(setting)
+
+# 1. run query once for the whole window
+logger.info("Running query {} with data from {} to {}...".format(query_id, start, end))
+dbm.run_query(query_id, 'CUSTOM_DATES', start_date=datetime.combine(start, datetime.min.time()),
+              end_date=datetime.combine(end, datetime.min.time()), timezone="Europe/Warsaw")
+dbm.wait_for_report(query_id)
+report = dbm.download_query(query_id, type='stream', footer_column=mapper.footer)
+
+# 2. merge report into stored rows, only restated, new and vanished rows are written
+engine = script.engine()
+sinks = script.sinks()
+loader = BulkLoader(engine, batch_size=script.batch_size)
+
+with open_sinks(sinks, query_id) as writers, engine.begin() as connection:
+    counts = load_report(loader, connection, report, mapper, DIMENSIONS, rollups=ROLLUPS, writers=writers,
+                         window=(start, end))
+
+logger.info("Written rows: {}".format(counts))
+
+script.finish()
@@ -0,0 +1,34 @@
+import argparse
+import logging
+import os
+
+from core.rollups import ROLLUPS
+from core.script import Script
+
+CWD = os.path.dirname(os.path.abspath(__file__))
+script = Script('rollups', CWD)
+logger = logging.getLogger(__name__)
+
+ROLLUP_NAMES = {rollup.name: rollup for rollup in ROLLUPS}
+
+# parse arguments from CLI
+parser = argparse.ArgumentParser(description="Rebuild rollup tables from scratch. "
+                                             "Normally they are refreshed incrementally after each load.")
+parser.add_argument('rollup', nargs='*', help='Rollup tables to rebuild, all if none given. '
+                                               'One of: {}'.format(', '.join(sorted(ROLLUP_NAMES))))
+args = parser.parse_args()
+
+for name in args.rollup:
+    if name not in ROLLUP_NAMES:
+        parser.error("{} is not a rollup table".format(name))
+
+# tables are created if they don't exist. If they do, SQL Alchemy skips creation
+engine = script.engine()
+
+for name in args.rollup or sorted(ROLLUP_NAMES):
+    logger.info("Rebuilding {}...".format(name))
+    # each rollup in its own transaction, readers see either old or new rollup
+    with engine.begin() as connection:
+        ROLLUP_NAMES[name].rebuild(connection)
+
+script.finish()
@@ -0,0 +1,61 @@
+import argparse
+import logging
+import os
+import sys
+from datetime import datetime, timedelta
+
+from decouple import config
+
+from core.accounts import ShardedRunner, load_manifest
+from core.cache import DEFAULT_MAX_SIZE
+from core.script import Script
+
+CWD = os.path.dirname(os.path.abspath(__file__))
+logger = logging.getLogger(__name__)
+
+
+def main():
+    script = Script('sharded-stats', CWD)
+
+    # parse arguments from CLI
+    parser = argparse.ArgumentParser(description="Load previous day of many DBM accounts at once, "
+                                                 "every account with its own credentials, quota and database.")
+    parser.add_argument('manifest', nargs='?', default=config('ACCOUNTS_MANIFEST', default='accounts.yaml'),
+                        help='YAML file with accounts, see accounts-sample.yaml')
+    parser.add_argument('-a', '--account', action='append', help='Run only this account, can be repeated')
+    # empty PROCESSES, as in .env-sample, means one process per account
+    parser.add_argument('-p', '--processes', type=int,
+                        default=config('PROCESSES', default='', cast=lambda value: int(value) if value else None),
+                        help='Accounts run at once, defaults to number of accounts')
+    args = parser.parse_args()
+
+    accounts = load_manifest(script.path(args.manifest))
+    if args.account:
+        unknown = set(args.account) - {account.name for account in accounts}
+        if unknown:
+            parser.error("unknown accounts: {}".format(", ".join(sorted(unknown))))
+        accounts = [account for account in accounts if account.name in args.account]
+
+    # run all queries of all accounts with data from previous day
+    daterange = datetime.today() - timedelta(days=1)
+
+    runner = ShardedRunner(accounts, processes=args.processes,
+                           state_dir=script.path(config('ACCOUNTS_STATE_DIR', default='.accounts')),
+                           batch_size=script.batch_size,
+                           cache_size=config('REPORT_CACHE_SIZE', default=DEFAULT_MAX_SIZE, cast=int),
+                           log_format=script.log_format)
+    results = runner.run('CUSTOM_DATES', start_date=daterange, end_date=daterange, timezone="Europe/Warsaw")
+    failed = runner.failed(results)
+    logger.info("Finished {} accounts, {} failed".format(len(results), len(failed)))
+
+    # stage metrics of all accounts
+    script.finish()
+
+    if failed:
+        logger.error("Failed accounts: {}".format(", ".join(failed)))
+        sys.exit(1)
+
+
+# accounts run in spawned processes, which import this module again
+if __name__ == '__main__':
+    main()
@@ -1,6 +1,47 @@
+import asyncio
+import json
+import logging
+import os
+import shutil
+import threading
+import tempfile
+import time
 import unittest
-from datetime import datetime
-from core.util import DBMQuery, clean_currency_value, clean_date_value
+from unittest import mock
+from datetime import date, datetime, timedelta
+
+import requests
+from sqlalchemy import Column, Integer, MetaData, Table, UniqueConstraint, create_engine, event, select
+
+from benchmarks.local_dbm import LocalDBMQuery, LocalStorage
+from benchmarks.reports import write_report
+from core.accounts import Account, ShardedRunner, load_manifest
+from core.aio import AsyncDBMQuery, AsyncRateLimiter, run_queries
+from core.backfill import Backfill, shard_dates
+from core.batch import QueryBatch
+from core.cache import ReportCache, iter_file_chunks
+from core.changes import ChangeDetector
+from core.columnar import ColumnBatch, parse_columns
+from core.dimensions import DimensionCache
+from core.loader import BulkLoader, chunked, unique_columns
+from core.mapping import Mapping
+from core.mappers import DIMENSIONS, MAPPINGS, basic_stats_mapper, conversion_stats_mapper
+from core.metrics import JsonFormatter, Metrics, instrument_engine, metrics
+from core.models import Base, BasicStats, ConversionPixels, MetaNames
+from core.orchestrator import Job, Orchestrator
+from core.pipeline import load_report, report_rows
+from core.reconcile import window_dates
+from core.rollups import ROLLUPS, Rollup
+from core.sinks import ParquetSink, open_sinks
+from core.schema import add_partitions_sql, missing_indexes, partition_table_sql
+from core.script import Script
+from core.util import Backoff, DBMQuery, QueryHistory, RateLimiter, clean_currency_value, clean_currency_values, \
+    clean_date_value, clean_date_values, download_to_file, get_discovery_document, iter_report_rows, write_file
+
+try:
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
 
 
 class CleanCurrenyValueTest(unittest.TestCase):
@@ -53,6 +94,13 @@ class CleanCurrenyValueTest(unittest.TestCase):
         target = 100.001
         self.assertEqual(clean_currency_value(value), target)
 
+    def test_batch(self):
+        """Does batch API clean all values the same way?"""
+
+        values = ['1 234 567', '1,234,567', 'PLN100.001', u'\u20AC100.001']
+        self.assertEqual(clean_currency_values(values), [clean_currency_value(x) for x in values])
+        self.assertEqual(clean_currency_values([]), [])
+
 
 class CleanDateValueTest(unittest.TestCase):
     """
@@ -91,5 +139,1371 @@ class CleanDateValueTest(unittest.TestCase):
 
         self.assertEqual(clean_date_value(value), target)
 
+    def test_fallback_format_is_not_sticky(self):
+        """Is %Y/%m/%d still preferred after value parsed with %Y/%d/%m?"""
+
+        self.assertEqual(clean_date_value('2018/31/01'), datetime(2018, 1, 31))
+        self.assertEqual(clean_date_value('2018/02/01'), datetime(2018, 2, 1))
+
+    def test_batch(self):
+        """Does batch API clean all values?"""
+
+        self.assertEqual(clean_date_values(['2018-01-01', '2018.01.02', '2018-01-01']),
+                         [datetime(2018, 1, 1), datetime(2018, 1, 2), datetime(2018, 1, 1)])
+
+    def test_invalid(self):
+        """Does invalid date raise ValueError?"""
+
+        with self.assertRaises(ValueError):
+            clean_date_value('2018-13-45')
+
+
+class IterReportRowsTest(unittest.TestCase):
+    """
+    Test streaming csv parsing from core.util
+    """
+
+    report = (u'Date,Line Item,Impressions\n'
+              u'2018/01/01,"Zażółć, gęślą",10\n'
+              u'2018/01/01,"Multi\nline",20\n'
+              u',,30\n'
+              u'Report Time:,2018/01/02,\n').encode('utf-8')
+
+    def chunks(self, size):
+        return (self.report[i:i + size] for i in range(0, len(self.report), size))
+
+    def test_chunk_boundaries(self):
+        """Are rows parsed the same regardless of where chunks split lines and characters?"""
+
+        for size in (1, 3, 7, len(self.report)):
+            rows = list(iter_report_rows(self.chunks(size)))
+            self.assertEqual([row['Line Item'] for row in rows], [u'Zażółć, gęślą', u'Multi\nline'])
+
+    def test_stops_at_summary(self):
+        """Does parsing stop at summary row without reading the rest of report?"""
+
+        chunks = self.chunks(1)
+        self.assertEqual(len(list(iter_report_rows(chunks))), 2)
+        self.assertTrue(any(True for _ in chunks))
+
+
+class ReportCacheTest(unittest.TestCase):
+    """
+    Test core.cache.ReportCache
+    """
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.cache = ReportCache(self.dir, max_size=20)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_fetch_once(self):
+        """Is report downloaded only once per run and read back through memory map?"""
+
+        storage = FakeStorage(b'Date,Clicks\n2018/01/01,1\n,\n', fail_first=False)
+
+        path = self.cache.fetch(1, 1000, 'http://storage/report.csv', session=storage)
+        self.assertEqual(self.cache.fetch(1, 1000, 'http://storage/report.csv', session=storage), path)
+        self.assertEqual(len(storage.requests), 1)
+
+        rows = list(iter_report_rows(self.cache.read(path, chunk_size=3)))
+        self.assertEqual(rows, [{'Date': '2018/01/01', 'Clicks': '1'}])
+        self.assertEqual(self.cache.latest(1), path)
+
+    def test_evict_least_recently_used(self):
+        """Are least recently used reports removed when cache is too big?"""
+
+        for run_time in (1, 2, 3):
+            with open(self.cache.path(1, run_time), 'wb') as file:
+                file.write(b'0123456789')
+            os.utime(self.cache.path(1, run_time), (run_time, run_time))
+        self.cache.get(1, 1)
+
+        self.cache.evict()
+
+        self.assertEqual(sorted(os.listdir(self.dir)), ['1-1.csv', '1-3.csv'])
+
+
+class FakeDiscoverySession():
+    """
+    Stand-in for requests.Session serving one discovery document
+    """
+
+    def __init__(self, text):
+        self.text = text
+        self.requests = []
+
+    def get(self, url):
+        self.requests.append(url)
+        return FakeResponse(self.text.encode('utf-8'))
+
+
+class DiscoveryDocumentTest(unittest.TestCase):
+    """
+    Test caching of API discovery documents from core.util
+    """
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_fetched_once(self):
+        """Is discovery document fetched once and then served from disk and memory?"""
+
+        session = FakeDiscoverySession('{"name": "testapi"}')
+
+        document = get_discovery_document('testapi', 'v1', self.dir, session=session)
+        self.assertEqual(document, {'name': 'testapi'})
+        self.assertEqual(get_discovery_document('testapi', 'v1', self.dir, session=session), document)
+        self.assertEqual(len(session.requests), 1)
+        self.assertEqual(os.listdir(self.dir), ['testapi-v1.json'])
+
+    def test_concurrent_writers(self):
+        """Do writers of the same cache file in parallel threads leave one complete file?"""
+
+        path = os.path.join(self.dir, 'testapi-v1.json')
+        texts = [json.dumps({'writer': writer, 'padding': 'x' * 100000}) for writer in range(8)]
+        errors = []
+
+        def write(text):
+            try:
+                for _ in range(20):
+                    write_file(path, text)
+            except OSError as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=write, args=(text,)) for text in texts]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+        self.assertEqual(os.listdir(self.dir), ['testapi-v1.json'])
+        with open(path) as file:
+            self.assertIn(file.read(), texts)
+
+
+class BackoffTest(unittest.TestCase):
+    """
+    Test polling intervals from core.util.Backoff
+    """
+
+    def test_grows_to_maximum(self):
+        """Do intervals grow exponentially within jitter and stop at maximum?"""
+
+        backoff = Backoff(initial=1, maximum=8, factor=2, jitter=0.5)
+        for upper in (1, 2, 4, 8, 8):
+            interval = backoff.next()
+            self.assertTrue(upper * 0.5 <= interval <= upper)
+
+
+class FakeQueries():
+    """
+    Stand-in for googleapiclient queries() resource returning prepared getquery responses
+    """
+
+    def __init__(self, responses):
+        self.responses = list(responses)
+
+    def getquery(self, queryId):
+        response = self.responses.pop(0)
+        return type('Request', (), {'execute': lambda self: response})()
+
+
+class WaitForReportTest(unittest.TestCase):
+    """
+    Test DBMQuery.wait_for_report without calling DBM API
+    """
+
+    def dbm(self, responses, history=None):
+        dbm = DBMQuery.__new__(DBMQuery)
+        dbm.run_times, dbm.history = {}, history or QueryHistory()
+        queries = FakeQueries(responses)
+        dbm.client = type('Client', (), {'queries': lambda self: queries})()
+        return dbm
+
+    @staticmethod
+    def metadata(running, run_time_ms, url='gs://report.csv'):
+        return {'metadata': {'running': running, 'latestReportRunTimeMs': str(run_time_ms),
+                             'googleCloudStoragePathForLatestReport': url}}
+
+    def test_skips_stale_report(self):
+        """Is report generated before run_query ignored until fresh one is ready?"""
+
+        now_ms = int(time.time() * 1000)
+        dbm = self.dbm([self.metadata(False, now_ms - 3600 * 1000, 'stale'),
+                        self.metadata(True, now_ms - 3600 * 1000, 'stale'),
+                        self.metadata(False, now_ms, 'fresh')])
+        dbm.run_times['1'] = now_ms
+
+        url = dbm.wait_for_report(1, initial_delay=0, backoff=Backoff(initial=0))
+
+        self.assertEqual(url, 'fresh')
+        self.assertIn('1', dbm.history.durations)
+
+    def test_shared_history(self):
+        """Is history shared by clients of many threads recorded and written without errors?"""
+
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'history.json')
+        history = QueryHistory(path)
+        now_ms = int(time.time() * 1000)
+        errors = []
+
+        def work(thread):
+            query_ids = ['{}-{}'.format(thread, x) for x in range(50)]
+            dbm = self.dbm([self.metadata(False, now_ms)] * len(query_ids), history)
+            for query_id in query_ids:
+                dbm.run_times[query_id] = now_ms
+                try:
+                    dbm.fresh_report(query_id)
+                except Exception as exception:
+                    errors.append(exception)
+
+        threads = [threading.Thread(target=work, args=(x,)) for x in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+        with open(path) as file:
+            self.assertEqual(len(json.load(file)), 400)
+        self.assertEqual(len(QueryHistory(path).durations), 400)
+
+    def test_timeout(self):
+        """Is TimeoutError raised when query runs past deadline?"""
+
+        dbm = self.dbm([self.metadata(True, 0)] * 3)
+        with self.assertRaises(TimeoutError):
+            dbm.wait_for_report(1, timeout=0, initial_delay=0)
+
+
+class FakeResponse():
+    """
+    Minimal stand-in for streamed requests.Response
+    """
+
+    def __init__(self, body, status_code=200, headers=None, fail_after=None):
+        self.body = body
+        self.text = body.decode('utf-8')
+        self.status_code = status_code
+        self.headers = dict(headers or {}, **{'Content-Length': str(len(body))})
+        self.fail_after = fail_after
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.exceptions.HTTPError(self.status_code)
+
+    def iter_content(self, chunk_size):
+        for i in range(0, len(self.body), chunk_size):
+            if self.fail_after is not None and i >= self.fail_after:
+                raise requests.exceptions.ConnectionError("connection dropped")
+            yield self.body[i:i + chunk_size]
+
+    def close(self):
+        pass
+
+
+class FakeStorage():
+    """
+    Serves one file with Range / If-Range support and drops first connection midway
+    """
+
+    def __init__(self, body, etag='"v1"', fail_first=True):
+        self.body = body
+        self.etag = etag
+        self.fail_first = fail_first
+        self.requests = []
+
+    def get(self, url, headers=None, stream=False):
+        headers = headers or {}
+        self.requests.append(headers)
+        fail_after = 4 if self.fail_first and len(self.requests) == 1 else None
+
+        if 'Range' in headers and headers.get('If-Range') == self.etag:
+            offset = int(headers['Range'][len('bytes='):-1])
+            return FakeResponse(self.body[offset:], 206, {'ETag': self.etag}, fail_after)
+        return FakeResponse(self.body, 200, {'ETag': self.etag}, fail_after)
+
+
+class DownloadToFileTest(unittest.TestCase):
+    """
+    Test resumable downloads from core.util
+    """
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'report.csv')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_resume_after_broken_connection(self):
+        """Is broken download resumed from partial file and renamed when complete?"""
+
+        storage = FakeStorage(b'0123456789abcdef')
+        download_to_file('http://storage/report.csv', self.path, session=storage, chunk_size=2)
+
+        with open(self.path, 'rb') as file:
+            self.assertEqual(file.read(), storage.body)
+        self.assertEqual(storage.requests[1]['Range'], 'bytes=4-')
+        self.assertEqual(os.listdir(self.dir), ['report.csv'])
+
+    def test_restart_when_file_changed(self):
+        """Is partial file discarded when file on server has changed?"""
+
+        storage = FakeStorage(b'0123456789abcdef')
+        with self.assertRaises(requests.exceptions.ConnectionError):
+            download_to_file('http://storage/report.csv', self.path, session=storage, chunk_size=2, retries=0)
+
+        storage.body, storage.etag = b'changed report', '"v2"'
+        download_to_file('http://storage/report.csv', self.path, session=storage, chunk_size=2)
+
+        with open(self.path, 'rb') as file:
+            self.assertEqual(file.read(), b'changed report')
+
+
+class ParseColumnsTest(unittest.TestCase):
+    """
+    Test columnar parsing from core.columnar with every backend available here
+    """
+
+    report = (u'Date,Line Item ID,Clicks,Media Cost (Advertiser Currency)\n'
+              u'2018/30/01,1,10,PLN1.50\n'
+              u'2018/31/01,2,12.0,"\u20AC1,234.5"\n'
+              u',,22,\n').encode('utf-8')
+    types = {'Date': 'date', 'Line Item ID': 'int', 'Clicks': 'int',
+             'Media Cost (Advertiser Currency)': 'currency'}
+
+    def backends(self):
+        from core import columnar
+        return ['array'] + [name for name, module in (('numpy', columnar.numpy), ('arrow', columnar.pyarrow))
+                            if module is not None]
+
+    def test_parse(self):
+        """Are columns typed and cleaned in bulk, with date format detected per column?"""
+
+        for backend in self.backends():
+            batches = list(parse_columns([self.report], self.types, batch_size=1, backend=backend))
+            self.assertEqual(len(batches), 2)
+
+            batch = batches[1]
+            self.assertEqual(batch.to_pylist('Date'), [date(2018, 1, 31)])
+            self.assertEqual(batch.to_pylist('Clicks'), [12])
+            self.assertEqual(batch.to_pylist('Media Cost (Advertiser Currency)'), [1234.5])
+
+    def test_upsert_columns(self):
+        """Can column batches be loaded directly?"""
+
+        engine = create_engine('sqlite://')
+        Base.metadata.create_all(engine)
+
+        for batch in parse_columns([self.report], self.types):
+            batch = batch.rename({'date': 'Date', 'line_item_id': 'Line Item ID', 'clicks': 'Clicks',
+                                  'media_cost': 'Media Cost (Advertiser Currency)'})
+            BulkLoader(engine).upsert_columns(BasicStats, batch)
+
+        self.assertEqual(engine.execute('select sum(clicks) from dbm_basic_stats').scalar(), 22)
+
+
+class BulkLoaderTest(unittest.TestCase):
+    """
+    Test core.loader.BulkLoader against in-memory SQLite
+    """
+
+    def setUp(self):
+        self.engine = create_engine('sqlite://')
+        Base.metadata.create_all(self.engine)
+        self.loader = BulkLoader(self.engine, batch_size=2)
+
+    def stats_row(self, line_item_id, clicks):
+        return dict(date=date(2018, 1, 1), line_item_id=line_item_id, currency='PLN',
+                    impressions=100, viewable_impressions=50, clicks=clicks,
+                    total_conversions=1, post_click_conversions=1, total_cost=1.5, media_cost=1.0)
+
+    def test_chunked(self):
+        """Does chunked split iterable into lists of given size?"""
+
+        self.assertEqual(list(chunked(range(5), 2)), [[0, 1], [2, 3], [4]])
+
+    def test_unique_columns(self):
+        """Is upsert key taken from the only unique constraint or the named one, and ambiguity rejected?"""
+
+        def table(**info):
+            return Table('test', MetaData(), Column('a', Integer), Column('b', Integer),
+                         UniqueConstraint('a', name='unique_a'), UniqueConstraint('a', 'b', name='unique_ab'),
+                         info=info)
+
+        self.assertEqual(unique_columns(BasicStats.__table__), ('date', 'line_item_id'))
+        self.assertEqual(unique_columns(table(upsert_key='unique_ab')), ('a', 'b'))
+        self.assertRaises(ValueError, unique_columns, table())
+        self.assertRaises(ValueError, unique_columns, table(upsert_key='unique_b'))
+
+    def test_upsert_is_idempotent(self):
+        """Does loading the same day twice update rows instead of violating unique constraint?"""
+
+        rows = [self.stats_row(line_item_id, 1) for line_item_id in range(5)]
+        self.assertEqual(self.loader.upsert(BasicStats, rows), 5)
+
+        rows = [self.stats_row(line_item_id, 2) for line_item_id in range(5)]
+        self.loader.upsert(BasicStats, rows)
+
+        clicks = [row.clicks for row in self.engine.execute(BasicStats.__table__.select())]
+        self.assertEqual(clicks, [2] * 5)
+
+    def test_upsert_duplicates_in_batch(self):
+        """Does the last row win when the same key appears twice in one batch?"""
+
+        rows = [dict(line_item_id=1, line_item_name='old'), dict(line_item_id=1, line_item_name='new')]
+        self.assertEqual(self.loader.upsert(MetaNames, rows), 1)
+
+        names = [row.line_item_name for row in self.engine.execute(MetaNames.__table__.select())]
+        self.assertEqual(names, ['new'])
+
+    def test_upsert_columns(self):
+        """Are column batches upserted in chunks with the last row of duplicate key winning?"""
+
+        batch = ColumnBatch({'line_item_id': [1, 2, 3, 1, 4], 'line_item_name': ['a', 'b', 'c', 'd', 'e']})
+        self.assertEqual(self.loader.upsert_columns(MetaNames, batch), 4)
+        self.loader.upsert_columns(MetaNames, ColumnBatch({'line_item_id': [2], 'line_item_name': ['f']}))
+
+        names = self.engine.execute(select([MetaNames.line_item_id, MetaNames.line_item_name]).order_by(
+            MetaNames.line_item_id)).fetchall()
+        self.assertEqual([tuple(row) for row in names], [(1, 'd'), (2, 'f'), (3, 'c'), (4, 'e')])
+
+
+class DimensionCacheTest(unittest.TestCase):
+    """
+    Test core.dimensions.DimensionCache
+    """
+
+    def setUp(self):
+        self.engine = create_engine('sqlite://')
+        Base.metadata.create_all(self.engine)
+        BulkLoader(self.engine).upsert(MetaNames, [dict(line_item_id=1, line_item_name='first'),
+                                                   dict(line_item_id=2, line_item_name='second')])
+        self.cache = DimensionCache(MetaNames).load(self.engine)
+
+    def test_load(self):
+        """Are existing line items loaded with their values?"""
+
+        self.assertEqual(len(self.cache), 2)
+        self.assertIn(1, self.cache)
+        self.assertEqual(self.cache.get(2)['line_item_name'], 'second')
+
+    def test_update_new_and_changed(self):
+        """Are rows split into new and changed while unchanged ones are skipped?"""
+
+        new, changed = self.cache.update([dict(line_item_id=1, line_item_name='first'),
+                                          dict(line_item_id=2, line_item_name='renamed'),
+                                          dict(line_item_id=3, line_item_name='third')])
+
+        self.assertEqual([row['line_item_id'] for row in new], [3])
+        self.assertEqual([row['line_item_id'] for row in changed], [2])
+        self.assertEqual(self.cache.inserted, {3})
+        self.assertFalse(self.cache.is_changed(dict(line_item_id=2, line_item_name='renamed')))
+
+
+def basic_stats_row(line_item_id, clicks=1, line_item='Line Item'):
+    return {'Date': '2018/01/01', 'Advertiser': 'Advertiser', 'Advertiser ID': '1',
+            'Insertion Order': 'Order', 'Insertion Order ID': '2', 'Line Item': line_item,
+            'Line Item ID': str(line_item_id), 'Advertiser Currency': 'PLN', 'Impressions': '100',
+            'Active View: Viewable Impressions': '50', 'Clicks': str(clicks), 'Total Conversions': '1',
+            'Post-Click Conversions': '0', 'Total Media Cost (Advertiser Currency)': 'PLN1.50',
+            'Media Cost (Advertiser Currency)': 'PLN1.00'}
+
+
+class LoadReportTest(unittest.TestCase):
+    """
+    Test core.pipeline.load_report with basic stats mapper
+    """
+
+    def setUp(self):
+        self.engine = create_engine('sqlite://')
+        Base.metadata.create_all(self.engine)
+        self.loader = BulkLoader(self.engine, batch_size=2)
+
+    def load(self, rows):
+        with self.engine.begin() as connection:
+            return load_report(self.loader, connection, rows, basic_stats_mapper, DIMENSIONS)
+
+    def test_load_and_reload(self):
+        """Are only changed stats and line items written on reload?"""
+
+        counts = self.load([basic_stats_row(x) for x in range(5)])
+        self.assertEqual(counts, {'dbm_basic_stats': 5, 'dbm_meta_names': 5})
+
+        counts = self.load([basic_stats_row(0, line_item='Renamed'), basic_stats_row(1, clicks=7)] +
+                           [basic_stats_row(x) for x in range(2, 5)])
+        self.assertEqual(counts, {'dbm_basic_stats': 1, 'dbm_meta_names': 1})
+        self.assertEqual(self.engine.execute('select count(*) from dbm_basic_stats').scalar(), 5)
+        self.assertEqual(self.engine.execute('select sum(clicks) from dbm_basic_stats').scalar(), 11)
+
+    def test_write_all(self):
+        """Are all rows written when change detection is off?"""
+
+        self.load([basic_stats_row(x) for x in range(5)])
+        with self.engine.begin() as connection:
+            counts = load_report(self.loader, connection, [basic_stats_row(x) for x in range(5)],
+                                 basic_stats_mapper, DIMENSIONS, skip_unchanged=False)
+        self.assertEqual(counts['dbm_basic_stats'], 5)
+
+    def test_columnar(self):
+        """Does loading column batches store the same rows as loading mapped rows?"""
+
+        directory = tempfile.mkdtemp()
+        path = write_report(os.path.join(directory, 'basic.csv'), 'basic', rows=50, line_items=7)
+        mapping = MAPPINGS['basic_stats']
+        columns_engine = create_engine('sqlite://')
+        Base.metadata.create_all(columns_engine)
+
+        counts = self.load(iter_report_rows(iter_file_chunks(path)))
+        with columns_engine.begin() as connection:
+            batches = parse_columns(iter_file_chunks(path), mapping.column_types(), footer_column=mapping.footer,
+                                    skip=mapping.skip, batch_size=20)
+            column_counts = load_report(BulkLoader(columns_engine, batch_size=2), connection, batches, None,
+                                        DIMENSIONS, transform=mapping.batch_transform())
+        shutil.rmtree(directory)
+
+        self.assertEqual(column_counts, counts)
+        for query in ('select count(*), sum(clicks), sum(media_cost) from dbm_basic_stats',
+                      'select count(*) from dbm_meta_names'):
+            self.assertEqual(tuple(columns_engine.execute(query).first()), tuple(self.engine.execute(query).first()))
+
+
+def conversion_stats_row(day, line_item_id, conversions=1, revenue='1.5'):
+    return {'Date': '2018/01/{:02d}'.format(day), 'Line Item ID': str(line_item_id), 'DV360 Activity': 'Purchase',
+            'DV360 Activity ID': '9', 'Total Conversions': '{}.0'.format(conversions),
+            'Post-Click Conversions': '0.0', 'CM Post-Click Revenue': revenue, 'CM Post-View Revenue': '0'}
+
+
+class ReconcileTest(unittest.TestCase):
+    """
+    Test merging of restated days with core.reconcile
+    """
+
+    def setUp(self):
+        self.engine = create_engine('sqlite://')
+        Base.metadata.create_all(self.engine)
+        self.loader = BulkLoader(self.engine, batch_size=2)
+
+    def load(self, rows, window=None):
+        with self.engine.begin() as connection:
+            return load_report(self.loader, connection, rows, conversion_stats_mapper, DIMENSIONS, window=window)
+
+    def test_window_dates(self):
+        """Does window end on given day and include it?"""
+
+        self.assertEqual(window_dates(3, date(2018, 1, 10)), (date(2018, 1, 8), date(2018, 1, 10)))
+        with self.assertRaises(ValueError):
+            window_dates(0)
+
+    def test_merge_restated_days(self):
+        """Are only restated, new and vanished rows of window written?"""
+
+        self.load([conversion_stats_row(day, line_item) for day in range(1, 5) for line_item in (1, 2)])
+
+        restated = [conversion_stats_row(2, 1), conversion_stats_row(2, 2, conversions=3, revenue='4.5'),
+                    conversion_stats_row(3, 1), conversion_stats_row(3, 3), conversion_stats_row(4, 1),
+                    conversion_stats_row(4, 2)]
+        counts = self.load(restated, window=(date(2018, 1, 2), date(2018, 1, 4)))
+
+        # 2nd restated, 3rd: line item 2 vanished, 3 is new
+        self.assertEqual(counts['dbm_conversion_stats'], 3)
+        table = ConversionPixels.__table__
+        stored = self.engine.execute(select([table.c.date, table.c.line_item_id, table.c.total_conversions,
+                                             table.c.post_click_revenue]).order_by(table.c.date,
+                                                                                   table.c.line_item_id)).fetchall()
+        self.assertEqual([tuple(row[:3]) for row in stored],
+                         [(date(2018, 1, 1), 1, 1), (date(2018, 1, 1), 2, 1), (date(2018, 1, 2), 1, 1),
+                          (date(2018, 1, 2), 2, 3), (date(2018, 1, 3), 1, 1), (date(2018, 1, 3), 3, 1),
+                          (date(2018, 1, 4), 1, 1), (date(2018, 1, 4), 2, 1)])
+        self.assertEqual(float(stored[3][3]), 4.5)
+
+        self.assertEqual(self.load(restated, window=(date(2018, 1, 2), date(2018, 1, 4)))['dbm_conversion_stats'], 0)
+
+    def test_other_queries_are_kept(self):
+        """Are rows of line items loaded by other queries kept when their rows are not in report?"""
+
+        self.load([conversion_stats_row(day, line_item) for day in (1, 2) for line_item in (0, 1, 2, 10, 11, 12)])
+        report = [conversion_stats_row(1, line_item) for line_item in (10, 11, 12)] + \
+            [conversion_stats_row(2, line_item) for line_item in (10, 11)]
+        counts = self.load(report, window=(date(2018, 1, 1), date(2018, 1, 2)))
+
+        # only line item 12 of 2nd vanished from report
+        self.assertEqual(counts['dbm_conversion_stats'], 1)
+        table = ConversionPixels.__table__
+        stored = self.engine.execute(select([table.c.date, table.c.line_item_id]).order_by(
+            table.c.date, table.c.line_item_id)).fetchall()
+        self.assertEqual([(row[0].day, row[1]) for row in stored],
+                         [(1, 0), (1, 1), (1, 2), (1, 10), (1, 11), (1, 12), (2, 0), (2, 1), (2, 2), (2, 10), (2, 11)])
+
+
+class RollupTest(unittest.TestCase):
+    """
+    Test core.rollups refreshed by core.pipeline.load_report
+    """
+
+    def setUp(self):
+        self.engine = create_engine('sqlite://')
+        Base.metadata.create_all(self.engine)
+        self.loader = BulkLoader(self.engine)
+
+    def load(self, rows):
+        with self.engine.begin() as connection:
+            load_report(self.loader, connection, rows, basic_stats_mapper, DIMENSIONS, rollups=ROLLUPS)
+
+    def rollup(self, table):
+        query = 'select advertiser_id, clicks from {} order by advertiser_id'.format(table)
+        return [tuple(row) for row in self.engine.execute(query)]
+
+    def test_incremental(self):
+        """Are only affected advertisers recomputed, with the same result as rebuild?"""
+
+        rows = [basic_stats_row(x) for x in range(4)]
+        rows[3].update({'Advertiser ID': '9', 'Insertion Order ID': '8', 'Date': '2018/01/02'})
+        self.load(rows)
+        self.assertEqual(self.rollup('dbm_rollup_advertiser_daily'), [(1, 3), (9, 1)])
+        self.assertEqual(self.rollup('dbm_rollup_order_monthly'), [(1, 3), (9, 1)])
+
+        # restated day of advertiser 1, advertiser 9 is left alone
+        self.engine.execute('update dbm_rollup_advertiser_daily set clicks = 100 where advertiser_id = 9')
+        self.load([basic_stats_row(0, clicks=5)])
+        self.assertEqual(self.rollup('dbm_rollup_advertiser_daily'), [(1, 7), (9, 100)])
+        self.assertEqual(self.rollup('dbm_rollup_order_monthly'), [(1, 7), (9, 1)])
+
+        with self.engine.begin() as connection:
+            for rollup in ROLLUPS:
+                rollup.rebuild(connection)
+        self.assertEqual(self.rollup('dbm_rollup_advertiser_daily'), [(1, 7), (9, 1)])
+        self.assertEqual(self.rollup('dbm_rollup_order_monthly'), [(1, 7), (9, 1)])
+
+    def test_conversions_before_line_items(self):
+        """Are conversions loaded before their line items added to rollup when line items are loaded?"""
+
+        with self.engine.begin() as connection:
+            load_report(self.loader, connection, [conversion_stats_row(1, 1, conversions=2),
+                                                  conversion_stats_row(1, 5)],
+                        conversion_stats_mapper, DIMENSIONS, rollups=ROLLUPS)
+        query = 'select date, advertiser_id, total_conversions from dbm_rollup_advertiser_conversions_daily'
+        self.assertEqual(self.engine.execute(query).fetchall(), [])
+
+        self.load([basic_stats_row(1)])
+        self.assertEqual([(row[1], row[2]) for row in self.engine.execute(query)], [(1, 2)])
+
+
+class SchemaTest(unittest.TestCase):
+    """
+    Test core.schema
+    """
+
+    def test_missing_indexes(self):
+        """Are indexes missing in existing tables found?"""
+
+        engine = create_engine('sqlite://')
+        Base.metadata.create_all(engine)
+        engine.execute('DROP INDEX index_li_history')
+
+        with engine.connect() as connection:
+            missing = missing_indexes(connection, Base.metadata.sorted_tables)
+        self.assertEqual([index.name for index in missing], ['index_li_history'])
+
+    def test_partitions(self):
+        """Are monthly partitions created and extended up to the end date?"""
+
+        statements = partition_table_sql('stats', date(2017, 11, 15), date(2018, 1, 1))
+        self.assertIn("PARTITION p201711 VALUES LESS THAN ('2017-12-01'), "
+                      "PARTITION p201712 VALUES LESS THAN ('2018-01-01'), "
+                      "PARTITION p201801 VALUES LESS THAN ('2018-02-01'), "
+                      "PARTITION pmax VALUES LESS THAN (MAXVALUE)", statements[1])
+
+        self.assertEqual(add_partitions_sql('stats', ['p201712', 'p201801', 'pmax'], date(2018, 1, 31)), [])
+        self.assertEqual(add_partitions_sql('stats', ['p201712', 'p201801', 'pmax'], date(2018, 2, 1)),
+                         ["ALTER TABLE stats REORGANIZE PARTITION pmax INTO ("
+                          "PARTITION p201802 VALUES LESS THAN ('2018-03-01'), "
+                          "PARTITION pmax VALUES LESS THAN (MAXVALUE))"])
+
+
+class SyntheticReportTest(unittest.TestCase):
+    """
+    Test benchmarks.reports read through benchmarks.local_dbm
+    """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_stream_report(self):
+        """Are all generated rows read and mapped, without summary and 'Total' rows?"""
+
+        for report, mapper in (('basic', basic_stats_mapper), ('conversion', conversion_stats_mapper)):
+            path = write_report(os.path.join(self.directory, report + '.csv'), report, rows=250, line_items=20,
+                                conversions=5)
+
+            with LocalStorage(self.directory) as storage:
+                dbm = LocalDBMQuery(storage, {7: path})
+                dbm.run_query(7, 'PREVIOUS_DAY')
+                dbm.wait_for_report(7, initial_delay=0)
+                rows = [mapper(row) for row in dbm.stream_query(7)]
+
+            self.assertEqual(len([row for row in rows if row]), 250)
+
+    def test_footer(self):
+        """Do reports stop at summary rows of mapping's footer column, not Date?"""
+
+        report = (u'Date,Advertiser ID,Advertiser\n'
+                  u'2018/01/01,1,First\n'
+                  u'2018/01/01,2,Second\n'
+                  u'2018/01/01,,\n'
+                  u'Report Time:,3,Summary\n')
+        with open(os.path.join(self.directory, 'report.csv'), 'w') as file:
+            file.write(report)
+        mapper = Mapping('advertisers', {'MetaNames': {'advertiser_id': {'column': 'Advertiser ID', 'type': 'int'},
+                                                       'advertiser_name': 'Advertiser'}},
+                         footer='Advertiser ID').row_mapper()
+
+        with LocalStorage(self.directory) as storage:
+            dbm = LocalDBMQuery(storage, {7: 'report.csv'})
+            metadata = dbm.get_query(7)['metadata']
+            streamed = list(dbm.stream_query(7, footer_column=mapper.footer))
+            rows = list(report_rows(dbm, 7, metadata, mapper.footer))
+
+        cached = type('CachedDBMQuery', (), {'cache': FakeReportCache({
+            metadata['googleCloudStoragePathForLatestReport']: report.encode('utf-8')})})()
+        for result in (streamed, rows, list(report_rows(cached, 7, metadata, mapper.footer))):
+            self.assertEqual([mapper(row)[MetaNames]['advertiser_id'] for row in result], [1, 2])
+
+
+class QueryListTest(unittest.TestCase):
+    """
+    Test cached listing of queries in DBMQuery.get_queries
+    """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_cached_listing(self):
+        """Are all pages listed once, filtered from cache and fetched again after query was run?"""
+
+        with LocalStorage(self.directory) as storage:
+            dbm = LocalDBMQuery(storage, {x: 'report.csv' for x in range(250)}, delay=60,
+                                query_list_dir=self.directory)
+
+            self.assertEqual(len(dbm.get_queries()), 250)
+            self.assertEqual(dbm.client.calls, 3)
+
+            self.assertEqual([q['queryId'] for q in dbm.get_queries(title='QUERY 12')],
+                             ['12', '120', '121', '122', '123', '124', '125', '126', '127', '128', '129'])
+            self.assertEqual(dbm.get_queries(data_range='last_7_days'), [])
+            self.assertEqual(dbm.get_queries(running=True), [])
+            self.assertEqual(dbm.client.calls, 3)
+
+            dbm.run_query(7, 'PREVIOUS_DAY')
+            self.assertEqual([q['queryId'] for q in dbm.get_queries(running=True)], ['7'])
+            self.assertEqual(dbm.client.calls, 7)
+
+    def test_batch_invalidates_listing(self):
+        """Is cached listing fetched again after batch delete and batch run with body?"""
+
+        with LocalStorage(self.directory) as storage:
+            dbm = LocalDBMQuery(storage, {x: 'report.csv' for x in range(10)}, query_list_dir=self.directory)
+            batch = QueryBatch(lambda: LocalDBMQuery(storage, {}, query_list_dir=self.directory), batch_size=5)
+
+            dbm.get_queries()
+            self.assertEqual(dbm.client.calls, 1)
+
+            batch.delete(['1', '2'])
+            dbm.get_queries()
+            self.assertEqual(dbm.client.calls, 2)
+
+            batch.run(['3'], body={'dataRange': 'PREVIOUS_DAY'})
+            dbm.get_queries()
+            self.assertEqual(dbm.client.calls, 3)
+
+
+class MetricsTest(unittest.TestCase):
+    """
+    Test core.metrics
+    """
+
+    def test_load_stages(self):
+        """Are rows, upserts and DB round-trips of a load recorded?"""
+
+        engine = instrument_engine(create_engine('sqlite://'), registry=metrics)
+        Base.metadata.create_all(engine)
+        metrics.reset()
+        with engine.begin() as connection:
+            load_report(BulkLoader(engine, batch_size=2), connection, [basic_stats_row(x) for x in range(5)],
+                        basic_stats_mapper, DIMENSIONS)
+
+        stages = metrics.snapshot()
+        self.assertEqual(stages['parse']['rows'], 5)
+        self.assertEqual(stages['upsert']['rows'], 10)
+        self.assertGreaterEqual(stages['sql']['queries'], 4)
+
+    def test_export(self):
+        """Are stages written as Prometheus textfile and JSON log records?"""
+
+        registry = Metrics()
+        registry.add('download', seconds=1.5, calls=1, bytes=1024)
+        directory = tempfile.mkdtemp()
+        path = os.path.join(directory, 'dbm.prom')
+
+        with self.assertLogs('metrics-test') as logs:
+            registry.export(logging.getLogger('metrics-test'), path, job='basic "stats"')
+        with open(path) as file:
+            text = file.read()
+        shutil.rmtree(directory)
+
+        self.assertIn('dbm_stage_bytes{job="basic \\"stats\\"",stage="download"} 1024', text)
+        record = json.loads(JsonFormatter().format(logs.records[0]))
+        self.assertEqual((record['stage'], record['seconds']), ('download', 1.5))
+
+
+class MappingTest(unittest.TestCase):
+    """
+    Test core.mapping compiled from core/mappings.yaml
+    """
+
+    def test_batch_transform(self):
+        """Does column batch transform give the same values as row mapper?"""
+
+        directory = tempfile.mkdtemp()
+        path = write_report(os.path.join(directory, 'conversion.csv'), 'conversion', rows=100, line_items=5,
+                            conversions=4)
+        mapping = MAPPINGS['conversion_stats']
+        mapper, transform = mapping.row_mapper(), mapping.batch_transform()
+
+        rows = [mapper(row) for row in iter_report_rows(iter_file_chunks(path))]
+        rows = [row[ConversionPixels] for row in rows if row]
+        batches = [transform(batch)[ConversionPixels] for batch in parse_columns(
+            iter_file_chunks(path), mapping.column_types(), backend='array', skip=mapping.skip)]
+        shutil.rmtree(directory)
+
+        self.assertEqual([value for batch in batches for value in batch.to_pylist('conversion_id')],
+                         [row['conversion_id'] for row in rows])
+        self.assertEqual([value for batch in batches for value in batch.to_pylist('post_click_revenue')],
+                         [row['post_click_revenue'] for row in rows])
+
+    def test_invalid(self):
+        """Are unknown models, columns and types rejected?"""
+
+        for tables in ({'Stats': {'date': 'Date'}}, {'BasicStats': {'day': 'Date'}},
+                       {'BasicStats': {'date': {'column': 'Date', 'type': 'datetime'}}}):
+            self.assertRaises(ValueError, Mapping, 'test', tables)
+
+
+@unittest.skipIf(pyarrow is None, "pyarrow is not installed")
+class ParquetSinkTest(unittest.TestCase):
+    """
+    Test core.sinks.ParquetSink written by core.pipeline.load_report
+    """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.engine = create_engine('sqlite://')
+        Base.metadata.create_all(self.engine)
+        self.sink = ParquetSink(self.directory, row_group_size=2)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def load(self, rows, query_id=None):
+        with open_sinks([self.sink], query_id) as writers, self.engine.begin() as connection:
+            load_report(BulkLoader(self.engine), connection, rows, basic_stats_mapper, DIMENSIONS, writers=writers)
+
+    def test_partitions(self):
+        """Are all rows written in row groups to partition of their date and replaced on reload?"""
+
+        rows = [basic_stats_row(x) for x in range(5)] + [dict(basic_stats_row(9), Date='2018/01/02')]
+        self.load(rows)
+        self.load(rows[:3])
+
+        day = pyarrow.parquet.ParquetFile(os.path.join(self.directory, 'dbm_basic_stats', 'date=2018-01-01',
+                                                       'data.parquet'))
+        self.assertEqual((day.metadata.num_rows, day.metadata.num_row_groups), (3, 2))
+        dataset = pyarrow.parquet.read_table(os.path.join(self.directory, 'dbm_basic_stats'))
+        self.assertEqual(sorted(dataset.column('line_item_id').to_pylist()), [0, 1, 2, 9])
+        self.assertEqual(dataset.column('total_cost').to_pylist()[0], 1.5)
+
+    def test_queries_share_partition(self):
+        """Do two queries writing the same table and day keep each other's rows, as in SQL?"""
+
+        self.load([basic_stats_row(x) for x in range(3)], query_id='1')
+        self.load([basic_stats_row(x) for x in range(10, 13)], query_id='2')
+        self.load([basic_stats_row(x, clicks=7) for x in range(3)], query_id='1')
+
+        partition = os.path.join(self.directory, 'dbm_basic_stats', 'date=2018-01-01')
+        self.assertEqual(sorted(os.listdir(partition)), ['query=1.parquet', 'query=2.parquet'])
+        dataset = pyarrow.parquet.read_table(os.path.join(self.directory, 'dbm_basic_stats'))
+        self.assertEqual(dataset.num_rows, self.engine.execute('select count(*) from dbm_basic_stats').scalar())
+        self.assertEqual(sorted(zip(dataset.column('line_item_id').to_pylist(), dataset.column('clicks').to_pylist())),
+                         [(0, 7), (1, 7), (2, 7), (10, 1), (11, 1), (12, 1)])
+
+    def test_abort(self):
+        """Are files dropped when loading fails?"""
+
+        rows = [basic_stats_row(x) for x in range(5)] + [{'Date': '2018/01/01'}]
+        self.assertRaises(KeyError, self.load, rows)
+        self.assertEqual([files for path, directories, files in os.walk(self.directory) if files], [])
+
+    def test_failed_commit(self):
+        """Are partitions left as they were when the transaction fails to commit?"""
+
+        self.load([basic_stats_row(x) for x in range(5)])
+
+        def fail(connection):
+            raise RuntimeError("commit failed")
+
+        event.listen(self.engine, 'commit', fail)
+        self.assertRaises(RuntimeError, self.load, [basic_stats_row(x) for x in range(2)])
+        event.remove(self.engine, 'commit', fail)
+
+        partition = os.path.join(self.directory, 'dbm_basic_stats', 'date=2018-01-01')
+        self.assertEqual(os.listdir(partition), ['data.parquet'])
+        self.assertEqual(pyarrow.parquet.ParquetFile(os.path.join(partition, 'data.parquet')).metadata.num_rows, 5)
+
+
+class ChangeDetectorTest(unittest.TestCase):
+    """
+    Test core.changes against stored conversion stats
+    """
+
+    def setUp(self):
+        self.engine = create_engine('sqlite://')
+        Base.metadata.create_all(self.engine)
+        BulkLoader(self.engine).upsert(ConversionPixels, [self.row(1, 2.5)])
+
+    @staticmethod
+    def row(conversion_id, revenue):
+        return dict(date=datetime(2018, 1, 1), line_item_id=1, conversion_id=conversion_id, total_conversions='3',
+                    post_click_conversions=1, post_click_revenue=revenue, post_view_revenue='0')
+
+    def test_filter(self):
+        """Are rows equal to stored ones skipped regardless of value types?"""
+
+        with self.engine.connect() as connection:
+            detector = ChangeDetector(ConversionPixels, connection)
+            rows = [self.row(1, '2.500000'), self.row(1, 2.75), self.row(2, 1), self.row(2, 1)]
+            changed = list(detector.filter(rows))
+
+        self.assertEqual([(row['conversion_id'], row['post_click_revenue']) for row in changed], [(1, 2.75), (2, 1)])
+        self.assertEqual(detector.skipped, 2)
+
+
+class FakeDBMQuery():
+    """
+    Stand-in for DBMQuery where each query finishes after given number of polls
+    """
+
+    def __init__(self, polls):
+        self.polls = dict(polls)
+        self.started = []
+
+    def run_query(self, query_id, daterange, **kwargs):
+        self.started.append(query_id)
+
+    def expected_duration(self, query_id):
+        return 0
+
+    def fresh_report(self, query_id):
+        self.polls[query_id] -= 1
+        if self.polls[query_id] > 0:
+            return None
+        return {'googleCloudStoragePathForLatestReport': query_id}
+
+
+class OrchestratorTest(unittest.TestCase):
+    """
+    Test core.orchestrator.Orchestrator
+    """
+
+    def test_run(self):
+        """Are all queries started before polling and each report loaded once it is ready?"""
+
+        dbm = FakeDBMQuery({'slow': 3, 'fast': 1})
+        orchestrator = Orchestrator(dbm, create_engine('sqlite://'), [Job('slow', None), Job('fast', None)],
+                                    backoff=lambda: Backoff(initial=0))
+        loaded = []
+        orchestrator.load = lambda job, metadata: loaded.append(job.query_id) or {'rows': 1}
+
+        results = orchestrator.run('PREVIOUS_DAY')
+
+        self.assertEqual(dbm.started, ['slow', 'fast'])
+        self.assertEqual(loaded, ['fast', 'slow'])
+        self.assertEqual(results, {'slow': {'rows': 1}, 'fast': {'rows': 1}})
+
+
+
+class ScriptTest(unittest.TestCase):
+    """
+    Test core.script.Script configured from environment
+    """
+
+    def test_setup(self):
+        """Are DBMQuery, engine and sinks built from configuration and metrics exported when script finishes?"""
+
+        directory = tempfile.mkdtemp()
+        environment = {'API_KEY_FILE': 'key.json', 'REPORT_CACHE_DIR': 'cache', 'DB_URI': 'sqlite://',
+                       'PARQUET_DIR': 'parquet', 'BATCH_SIZE': '10',
+                       'METRICS_TEXTFILE': os.path.join(directory, 'metrics.prom')}
+        with mock.patch.dict(os.environ, environment):
+            script = Script('test', directory)
+            dbm, engine, sinks = script.dbm(), script.engine(), script.sinks()
+            engine.execute('select 1')
+            script.finish()
+        with open(os.path.join(directory, 'metrics.prom')) as file:
+            textfile = file.read()
+        shutil.rmtree(directory)
+
+        self.assertIn('job="test"', textfile)
+
+        self.assertEqual(script.batch_size, 10)
+        self.assertEqual((dbm.auth_json, dbm.cache.directory), (os.path.join(directory, 'key.json'),
+                                                                os.path.join(directory, 'cache')))
+        self.assertIn('dbm_basic_stats', engine.table_names())
+        self.assertEqual([sink.directory for sink in sinks], [os.path.join(directory, 'parquet')])
+
+class FakeReportCache():
+    """
+    Stand-in for ReportCache serving prepared reports by URL
+    """
+
+    def __init__(self, reports):
+        self.reports = reports
+
+    def fetch(self, query_id, run_time_ms, url):
+        return url
+
+    def read(self, path):
+        return [self.reports[path]]
+
+
+class FakeBackfillDBMQuery():
+    """
+    Stand-in for DBMQuery where every run finishes immediately with report for its date range
+    """
+
+    def __init__(self, fail_on=None, max_clones=None):
+        self.fail_on = fail_on
+        self.max_clones = max_clones
+        self.ranges = {}
+        self.reports = {}
+        self.cache = FakeReportCache(self.reports)
+        self.deleted = []
+        self.clones = 0
+
+    def clone_query(self, query_id, title=None):
+        if self.clones == self.max_clones:
+            raise RuntimeError("Quota exceeded")
+        self.clones += 1
+        return {'queryId': 'clone-{}'.format(self.clones)}
+
+    def run_query(self, query_id, daterange, start_date=None, end_date=None, timezone=None):
+        self.ranges[query_id] = (start_date.date(), end_date.date())
+
+    def expected_duration(self, query_id):
+        return 0
+
+    def fresh_report(self, query_id):
+        start, end = self.ranges[query_id]
+        url = '{}/{}'.format(start, end)
+        day = start
+        lines = ['Date,Advertiser,Advertiser ID,Insertion Order,Insertion Order ID,Line Item,Line Item ID,'
+                 'Advertiser Currency,Impressions,Active View: Viewable Impressions,Clicks,Total Conversions,'
+                 'Post-Click Conversions,Total Media Cost (Advertiser Currency),Media Cost (Advertiser Currency)']
+        while day <= end:
+            if day == self.fail_on:
+                lines.append('not a date,A,1,O,2,LI,3,PLN,1,1,1,1,1,1,1')
+            lines.append('{},A,1,O,2,LI,3,PLN,1,1,1,1,1,1,1'.format(day.strftime('%Y/%m/%d')))
+            day += timedelta(days=1)
+        self.reports[url] = ('\n'.join(lines + [',,,,,,,,,,,,,,']) + '\n').encode('utf-8')
+        return {'googleCloudStoragePathForLatestReport': url, 'latestReportRunTimeMs': '1'}
+
+    def delete_query(self, query_id):
+        self.deleted.append(query_id)
+
+
+class BackfillTest(unittest.TestCase):
+    """
+    Test core.backfill against SQLite file shared by worker threads
+    """
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.engine = create_engine('sqlite:///' + os.path.join(self.dir, 'test.db'))
+        Base.metadata.create_all(self.engine)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_shard_dates(self):
+        """Is date range split into weeks with shorter last shard?"""
+
+        self.assertEqual(shard_dates(date(2018, 1, 1), date(2018, 1, 10), 'week'),
+                         [(date(2018, 1, 1), date(2018, 1, 7)), (date(2018, 1, 8), date(2018, 1, 10))])
+
+    def test_resume(self):
+        """Are failed shards retried on next run while loaded ones are skipped?"""
+
+        dbm = FakeBackfillDBMQuery(fail_on=date(2018, 1, 3))
+        backfill = Backfill(dbm, self.engine, 'query', basic_stats_mapper, concurrency=2, api_rate=1000)
+
+        with self.assertRaises(RuntimeError):
+            backfill.run(date(2018, 1, 1), date(2018, 1, 4))
+        self.assertEqual(len(backfill.completed_shards()), 3)
+        self.assertEqual(dbm.deleted, ['clone-1'])
+
+        dbm.fail_on = None
+        self.assertEqual(list(backfill.run(date(2018, 1, 1), date(2018, 1, 4))), [(date(2018, 1, 3), date(2018, 1, 3))])
+        self.assertEqual(self.engine.execute('select count(*) from dbm_basic_stats').scalar(), 4)
+
+    def test_failed_clone(self):
+        """Are clones created before a failed one deleted?"""
+
+        dbm = FakeBackfillDBMQuery(max_clones=2)
+        backfill = Backfill(dbm, self.engine, 'query', basic_stats_mapper, concurrency=4, api_rate=1000)
+
+        with self.assertRaises(RuntimeError):
+            backfill.run(date(2018, 1, 1), date(2018, 1, 4))
+        self.assertEqual(dbm.deleted, ['clone-1', 'clone-2'])
+        self.assertEqual(backfill.completed_shards(), set())
+
+    def test_rollups_after_shards(self):
+        """Are rollups refreshed once for all loaded shards instead of in every shard's transaction?"""
+
+        dbm = FakeBackfillDBMQuery(fail_on=date(2018, 1, 3))
+        backfill = Backfill(dbm, self.engine, 'query', basic_stats_mapper, concurrency=2, api_rate=1000)
+
+        with mock.patch.object(Rollup, 'refresh', side_effect=AssertionError("refreshed by shard")):
+            with self.assertRaises(RuntimeError):
+                backfill.run(date(2018, 1, 1), date(2018, 1, 4))
+            monthly = 'select month, impressions from dbm_rollup_order_monthly'
+            self.assertEqual(self.engine.execute(monthly).fetchall(), [('2018-01-01', 3)])
+
+            dbm.fail_on = None
+            backfill.run(date(2018, 1, 1), date(2018, 1, 4))
+        self.assertEqual(self.engine.execute(monthly).fetchall(), [('2018-01-01', 4)])
+        self.assertEqual(self.engine.execute('select count(*) from dbm_rollup_advertiser_daily').scalar(), 4)
+
+
+class FakeThreadDBMQuery():
+    """
+    Stand-in for DBMQuery which finishes every query immediately and records thread of every call
+    """
+
+    threads = set()
+
+    def __init__(self, auth_json, cache=None):
+        self.run_times, self.history = {}, QueryHistory()
+        self.cache = cache
+
+    def expected_duration(self, query_id):
+        return 0
+
+    def run_query(self, query_id, daterange, **kwargs):
+        FakeThreadDBMQuery.threads.add((threading.get_ident(), id(self)))
+        self.run_times[query_id] = 1
+
+    def fresh_report(self, query_id):
+        assert query_id in self.run_times
+        return {'latestReportRunTimeMs': '1'}
+
+    def cache_report(self, query_id):
+        return query_id
+
+
+class AsyncDBMQueryTest(unittest.TestCase):
+    """
+    Test core.aio without calling DBM API
+    """
+
+    def test_rate_limiter(self):
+        """Are calls spaced by rate limiter?"""
+
+        async def calls():
+            limiter = AsyncRateLimiter(100)
+            started = time.monotonic()
+            for _ in range(5):
+                await limiter.wait()
+            return time.monotonic() - started
+
+        self.assertGreaterEqual(asyncio.run(calls()), 0.04)
+
+    def test_run_queries(self):
+        """Are queries run concurrently with one client per thread and reports streamed?"""
+
+        reports = {'q{}'.format(x): 'Date,Clicks\n2018/01/01,{}\n,\n'.format(x).encode('utf-8') for x in range(20)}
+        cache = FakeReportCache(reports)
+        cache.read = lambda path, chunk_size: [reports[path][:5], reports[path][5:]]
+
+        async def handler(query_id, rows):
+            return [row['Clicks'] async for row in rows]
+
+        async def run():
+            dbm = AsyncDBMQuery('key.json', concurrency=4, rate=1000, factory=FakeThreadDBMQuery, cache=cache)
+            try:
+                return await run_queries(dbm, sorted(reports), handler, 'PREVIOUS_DAY')
+            finally:
+                dbm.close()
+
+        results = asyncio.run(run())
+
+        self.assertEqual(results, [[query_id[1:]] for query_id in sorted(reports)])
+        self.assertLessEqual(len({thread for thread, client in FakeThreadDBMQuery.threads}), 4)
+        self.assertEqual(len(FakeThreadDBMQuery.threads), len({client for thread, client in FakeThreadDBMQuery.threads}))
+
+
+class QueryBatchTest(unittest.TestCase):
+    """
+    Test core.batch against benchmarks.local_dbm
+    """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.clients = []
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def factory(self):
+        dbm = LocalDBMQuery(None, {})
+        self.clients.append(dbm.client)
+        return dbm
+
+    def test_run_in_batches(self):
+        """Are queries run in batch requests from bounded pool of clients?"""
+
+        query_ids = [str(x) for x in range(120)]
+        results = QueryBatch(self.factory, workers=2, batch_size=50).run(query_ids, 'PREVIOUS_DAY')
+
+        self.assertEqual(list(results), query_ids)
+        self.assertEqual(list(results.values()), [{}] * 120)
+        self.assertLessEqual(len(self.clients), 2)
+        self.assertEqual(sum(client.batches for client in self.clients), 3)
+        self.assertEqual(sum(client.calls for client in self.clients), 120)
+
+    def test_create_from_directory(self):
+        """Are queries created from JSON files in directory and failures reported per file?"""
+
+        for name, content in (('a.json', '{"metadata": {"title": "a"}}'), ('b.json', 'not json'),
+                              ('notes.txt', '')):
+            with open(os.path.join(self.directory, name), 'w') as file:
+                file.write(content)
+
+        results = QueryBatch(self.factory, batch_size=1).create([self.directory])
+
+        self.assertEqual(sorted(results), [os.path.join(self.directory, 'a.json'),
+                                           os.path.join(self.directory, 'b.json')])
+        self.assertEqual(results[os.path.join(self.directory, 'a.json')]['metadata'], {'title': 'a'})
+        self.assertIsInstance(results[os.path.join(self.directory, 'b.json')], TypeError)
+        self.assertEqual(sum(client.batches for client in self.clients), 0)
+
+
+def fake_account_target(account, run_kwargs, options):
+    """
+    Stand-in for core.accounts.run_account, account named 'broken' fails, 'crashed' kills its process
+    and accounts named 'slow-...' take a while
+    """
+    if account.name == 'broken':
+        raise RuntimeError("invalid credentials")
+    if account.name == 'crashed':
+        os._exit(1)
+    if account.name.startswith('slow-'):
+        time.sleep(0.3)
+    metrics.reset()
+    metrics.add('api', calls=len(account.queries))
+    return {query_id: {'daterange': run_kwargs['daterange']} for report, query_id in account.queries}, \
+        metrics.snapshot()
+
+
+class ShardedRunnerTest(unittest.TestCase):
+    """
+    Test core.accounts with fake account runs
+    """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def manifest(self, text):
+        path = os.path.join(self.directory, 'accounts.yaml')
+        with open(path, 'w') as file:
+            file.write(text)
+        return path
+
+    def test_load_manifest(self):
+        """Are accounts read with defaults, paths relative to manifest and invalid reports rejected?"""
+
+        accounts = load_manifest(self.manifest(
+            "api_rate: 2\naccounts:\n"
+            "  - {name: a, credentials: a.json, db_uri: 'sqlite://', queries: {basic: [1, 2], conversion: 3}}\n"
+            "  - {name: b, credentials: b.json, db_uri: 'sqlite://', queries: {basic: [4]}, api_rate: 5}\n"))
+
+        self.assertEqual([account.name for account in accounts], ['a', 'b'])
+        self.assertEqual(accounts[0].credentials, os.path.join(self.directory, 'a.json'))
+        self.assertEqual(accounts[0].queries, [('basic', '1'), ('basic', '2'), ('conversion', '3')])
+        self.assertEqual([account.api_rate for account in accounts], [2, 5])
+
+        with self.assertRaises(ValueError):
+            load_manifest(self.manifest(
+                "accounts:\n  - {name: a, credentials: a.json, db_uri: 'sqlite://', queries: {other: [1]}}\n"))
+
+    def test_failure_is_isolated(self):
+        """Do other accounts finish and report metrics when one of them fails?"""
+
+        accounts = [Account(name, 'key.json', 'sqlite://', [('basic', name + '-1'), ('basic', name + '-2')], 1, 1,
+                            None) for name in ('a', 'broken', 'b')]
+        runner = ShardedRunner(accounts, processes=2, state_dir=self.directory, target=fake_account_target)
+
+        metrics.reset()
+        results = runner.run('PREVIOUS_DAY')
+
+        self.assertEqual(results['a'], {'a-1': {'daterange': 'PREVIOUS_DAY'}, 'a-2': {'daterange': 'PREVIOUS_DAY'}})
+        self.assertEqual(list(results['b']), ['b-1', 'b-2'])
+        self.assertIsInstance(results['broken'], RuntimeError)
+        self.assertEqual(runner.failed(results), ['broken'])
+        self.assertEqual(metrics.snapshot()['api']['calls'], 4)
+        metrics.reset()
+
+    def test_crash_is_isolated(self):
+        """Do other accounts finish when process of one account dies?"""
+
+        accounts = [Account(name, 'key.json', 'sqlite://', [('basic', name + '-1')], 1, 1, None)
+                    for name in ('crashed', 'slow-a', 'slow-b', 'c')]
+        runner = ShardedRunner(accounts, processes=3, state_dir=self.directory, target=fake_account_target)
+
+        results = runner.run('PREVIOUS_DAY')
+        metrics.reset()
+
+        self.assertEqual(runner.failed(results), ['crashed'])
+        self.assertEqual([list(results[name]) for name in ('slow-a', 'slow-b', 'c')],
+                         [['slow-a-1'], ['slow-b-1'], ['c-1']])
+
+    def test_rate_limit(self):
+        """Are API calls of DBMQuery spaced by its rate limit?"""
+
+        dbm = LocalDBMQuery(None, {})
+        dbm.rate_limiter = RateLimiter(50)
+        started = time.monotonic()
+        for query_id in range(4):
+            dbm.delete_query(query_id)
+        self.assertGreaterEqual(time.monotonic() - started, 0.06)
+
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file